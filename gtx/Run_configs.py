@@ -67,6 +67,24 @@ class Configuration():
             "test_data_file": f"data/knowmix/{self.DB}_{self.DB_size}/{self.DB}_UnifiedUniKGenc/test",
             "run_name":f"{self.TASK_NAME}_{self.RUN_NAME}"
         }
+        # Token budget per batch (text tokens + KG nodes + summary tokens), which replaces the fixed batch sizes
+        if config.get('max_tokens'):
+            self.TRAINING_CONFIG['max_tokens_per_batch'] = config['max_tokens']
+        # Negative pairs of the alignment loss only repeat the cross-modality layers
+        if config.get('virtual_negatives'):
+            self.TRAINING_CONFIG['virtual_negatives'] = True
+        # Masked LM / LP corruption runs on the model device after the batch transfer
+        if config.get('device_masking'):
+            self.TRAINING_CONFIG['device_masking'] = True
+        # Batches collated ahead by a background thread (queue depth / wait time are logged)
+        if config.get('prefetch_batches'):
+            self.TRAINING_CONFIG['dataloader_prefetch_batches'] = config['prefetch_batches']
+        # ErrDetect graphs of clean dbs are corrupted on the fly from this table
+        if config.get('corruption_table'):
+            self.TRAINING_CONFIG['corruption_table'] = os.path.join(self.EXP_PATH, config['corruption_table'])
+        # Lightning checkpoint a training run resumes from, mid-epoch for streaming datasets
+        if config.get('resume_from_checkpoint'):
+            self.TRAINING_CONFIG['resume_from_checkpoint'] = os.path.join(self.EXP_PATH, config['resume_from_checkpoint'])
 
     def get_configuration(self):
         SRC_PATH = os.path.join(self.EXP_PATH, 'src/main.py')
@@ -97,6 +115,8 @@ class Configuration():
             Config['hidden_dropout_prob'] = self.config['dropout']
             Config['cross_att_type'] = 'single' if self.config['model']=='single' else 'cross'
             Config['encoder_type'] = self.Encoder_Type
+            Config['attention_backend'] = self.config.get('attention_backend', 'eager')
+            Config['kg_message_passing'] = self.config.get('kg_message_passing', 'dense')
             Config['lit2word_path'] = self.TRAINING_CONFIG['train_data_file'].replace("train","lit2word")
               
             if self.config['scratch'] and self.config['task_number']==2:
@@ -170,6 +190,8 @@ class Configuration():
                         Config = json.load(f)
                     # add features
                     Config['encoder_type'] = self.Encoder_Type
+                    Config['attention_backend'] = self.config.get('attention_backend', 'eager')
+                    Config['kg_message_passing'] = self.config.get('kg_message_passing', 'dense')
                     Config['attention_probs_dropout_prob'] = self.config['dropout']
                     Config['hidden_dropout_prob'] = self.config['dropout']
                     Config['cross_att_type'] = 'single' if self.config['model']=='single' else 'cross'
@@ -47,7 +47,23 @@ for preset in [
                 'note' : preset['note'],
                 'dropout' : 0.1,
                 'n_negatives' : 1,
+                # virtual_negatives : encode each sample once, only the cross-modality layers see the negative pairs
+                'virtual_negatives' : False,
+                # device_masking : mask tokens / nodes on the model device instead of in the DataLoader workers
+                'device_masking' : False,
+                # corruption_table : path (under EXP_PATH) of the table ErrDetect corrupts clean graphs from on the fly
+                'corruption_table' : None,
+                # prefetch_batches : batches collated ahead by a background thread, 0 to collate between steps
+                'prefetch_batches' : 0,
+                # attention_backend : eager / sdpa (fused scaled_dot_product_attention) / chunked (queries by chunks)
+                'attention_backend' : 'eager',
+                # kg_message_passing : dense (adjacency masked attention) / sparse (attention over the edge lists)
+                'kg_message_passing' : 'dense',
                 'use_tpu' : TPU,
+                # max_tokens : token budget per batch (text tokens + KG nodes + summary tokens) instead of train_bsize / eval_bsize
+                'max_tokens' : None,
+                # resume_from_checkpoint : path (under EXP_PATH) of a Lightning checkpoint to resume training from
+                'resume_from_checkpoint' : None,
             }
             # Training configs
             if _task == 0:
@@ -103,6 +103,17 @@ class GTXConfig(PretrainedConfig):
         output_hidden_states (:obj:`bool`, `optional`, defaults to :obj:`False`):
             Whether or not the model should return the hidden states from the vision, language, and cross-modality
             layers should be returned.
+        attention_backend (:obj:`str`, `optional`, defaults to :obj:`"eager"`):
+            How the self- and cross-attention layers compute attention: :obj:`"eager"` (explicit scores and softmax),
+            :obj:`"sdpa"` (:obj:`torch.nn.functional.scaled_dot_product_attention`, fused kernels) or
+            :obj:`"chunked"` (queries processed by chunks of :obj:`attention_chunk_size`, so that only a chunk of the
+            scores is held at once). Layers asked for their attention probabilities fall back to :obj:`"eager"`.
+        attention_chunk_size (:obj:`int`, `optional`, defaults to 512):
+            Number of queries per chunk of the :obj:`"chunked"` backend.
+        kg_message_passing (:obj:`str`, `optional`, defaults to :obj:`"dense"`):
+            How the relational (GAT) layers attend over the graph: :obj:`"dense"` masks a full (N x N) attention with
+            the adjacency, :obj:`"sparse"` only scores the edges (``kg_edge_index``) with a softmax over the edges of
+            each node, so that work and memory grow with the number of edges. Not supported with KnowMix layers.
     """
 
     model_type = "gtx"
@@ -140,6 +151,9 @@ class GTXConfig(PretrainedConfig):
         visual_feat_loss=True,
         output_attentions=False,
         output_hidden_states=False,
+        attention_backend="eager",
+        attention_chunk_size=512,
+        kg_message_passing="dense",
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -173,4 +187,7 @@ class GTXConfig(PretrainedConfig):
         self.visual_feat_loss = visual_feat_loss
         self.output_hidden_states = output_hidden_states
         self.output_attentions = self.output_attentions
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
+        self.kg_message_passing = kg_message_passing
         self.num_hidden_layers = {"vision": r_layers, "cross_encoder": x_layers, "language": l_layers}
\ No newline at end of file
@@ -75,6 +75,9 @@ def get_trainer_config(args):
         "callbacks":callbacks,
         # "check_val_every_n_epoch":50,
         "val_check_interval":1.0 if args.task in ["Pre"] else 0.5,
+        "resume_from_checkpoint":args.resume_from_checkpoint,
+        # Length grouped / token budget batches are split between ranks by the sampler itself (the test loader gets its DistributedSampler from the DataModule)
+        "replace_sampler_ddp":not (args.group_by_length or (args.max_tokens_per_batch is not None)),
     }
     if not args.do_eval:
         config["val_check_interval"]=1e10
@@ -90,6 +93,7 @@ def main():
     model_args, data_args, training_args = parser.parse_args_into_dataclasses()
     data_args.knowmix = training_args.knowmix
     data_args.task = training_args.task
+    data_args.seed = training_args.seed
 
     # Set seed
     pl.seed_everything(training_args.seed)
@@ -289,7 +289,7 @@ class GTXEmbeddings(nn.Module):
         self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None, inputs_embeds=None):
+    def forward(self, input_ids, token_type_ids=None, inputs_embeds=None, past_length=0, position_ids=None):
         if input_ids is not None:
             input_shape = input_ids.size()
             device = input_ids.device
@@ -298,8 +298,10 @@ class GTXEmbeddings(nn.Module):
             device = inputs_embeds.device
         seq_length = input_shape[1]
 
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=device)
-        position_ids = position_ids.unsqueeze(0).expand(input_shape)
+        if position_ids is None:
+            # Positions follow the `past_length` ones already encoded (incremental decoding)
+            position_ids = torch.arange(past_length, past_length + seq_length, dtype=torch.long, device=device)
+            position_ids = position_ids.unsqueeze(0).expand(input_shape)
 
         if token_type_ids is None and self.token_type_embeddings is not None:
             token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=position_ids.device)
@@ -317,6 +319,17 @@ class GTXEmbeddings(nn.Module):
         embeddings = self.dropout(embeddings)
         return embeddings
 
+ATTENTION_BACKENDS = ('eager', 'sdpa', 'chunked')
+
+def additive_attention_mask(attention_mask, dtype):
+    """
+    Boolean masks (True where attention is allowed) as the additive -10000 masks of the rest of the model, in the
+    dtype of the scores.
+    """
+    if attention_mask.dtype == torch.bool:
+        return (~attention_mask).to(dtype) * -10000.0
+    return attention_mask.to(dtype)
+
 class GTXAttention(nn.Module):
     def __init__(self, config, ctx_dim=None):
         super().__init__()
@@ -338,6 +351,13 @@ class GTXAttention(nn.Module):
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+        self.attention_backend = config.attention_backend if 'attention_backend' in vars(config).keys() else 'eager'
+        self.attention_chunk_size = config.attention_chunk_size if 'attention_chunk_size' in vars(config).keys() else 512
+        if self.attention_backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Unknown attention backend {self.attention_backend}, must be one of {', '.join(ATTENTION_BACKENDS)}")
+        if (self.attention_backend == 'sdpa') and not hasattr(F, 'scaled_dot_product_attention'):
+            raise ValueError("The sdpa attention backend requires torch>=2.0")
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (
             self.num_attention_heads,
@@ -346,18 +366,10 @@ class GTXAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, context, attention_mask=None, output_attentions=False):
-        # notifier.warning(hidden_states.size())
-        # notifier.warning(attention_mask.size())
-        # notifier.warning(context.size())
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(context)
-        mixed_value_layer = self.value(context)
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
+    def key_value(self, context):
+        return self.transpose_for_scores(self.key(context)), self.transpose_for_scores(self.value(context))
 
+    def eager_attention(self, query_layer, key_layer, value_layer, attention_mask=None):
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -372,7 +384,74 @@ class GTXAttention(nn.Module):
         # seem a bit unusual, but is taken from the original Transformer paper.
         attention_probs = self.dropout(attention_probs)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+        return torch.matmul(attention_probs, value_layer), attention_probs
+
+    def sparse_attention(self, hidden_states, context, edge_index):
+        """
+        Attention of every node over its neighbours only, from the edges ``edge_index`` (row, target node, source node)
+        instead of a dense (N x N) mask: scores are computed per edge and normalized by a softmax over the edges of
+        each target node (segment softmax), so that work and memory grow with the number of edges. Same outputs as the
+        masked dense attention for nodes with at least one edge, nodes without any (padding) receive no message.
+        """
+        batch_size, num_nodes = hidden_states.shape[:2]
+        shape = (batch_size * num_nodes, self.num_attention_heads, self.attention_head_size)
+        query_layer = self.query(hidden_states).view(shape)
+        key_layer = self.key(context).view(shape)
+        value_layer = self.value(context).view(shape)
+        target = edge_index[:, 0] * num_nodes + edge_index[:, 1]
+        source = edge_index[:, 0] * num_nodes + edge_index[:, 2]
+
+        attention_scores = (query_layer[target] * key_layer[source]).sum(-1) / math.sqrt(self.attention_head_size)
+        # Softmax over the edges of each target node, shifted by their max
+        index = target.unsqueeze(1).expand_as(attention_scores)
+        max_scores = attention_scores.detach().new_full(shape[:2], float('-inf')).scatter_reduce(0, index, attention_scores.detach(), reduce='amax')
+        attention_probs = (attention_scores - max_scores[target]).exp()
+        attention_probs = attention_probs / attention_probs.new_zeros(shape[:2]).index_add(0, target, attention_probs)[target]
+        attention_probs = self.dropout(attention_probs)
+
+        context_layer = value_layer.new_zeros(shape).index_add(0, target, attention_probs.unsqueeze(-1) * value_layer[source])
+        return context_layer.view(batch_size, num_nodes, self.head_size), attention_probs
+
+    def forward(self, hidden_states, context, attention_mask=None, output_attentions=False, edge_index=None, past_key_value=None):
+        # notifier.warning(hidden_states.size())
+        # notifier.warning(attention_mask.size())
+        # notifier.warning(context.size())
+        if edge_index is not None:
+            # Attention probabilities are then given per edge, (num_edges, num_heads)
+            context_layer, attention_probs = self.sparse_attention(hidden_states, context, edge_index)
+            return (context_layer, attention_probs) if output_attentions else (context_layer,)
+
+        mixed_query_layer = self.query(hidden_states)
+        query_layer = self.transpose_for_scores(mixed_query_layer)
+        # `past_key_value` keeps the keys / values of incremental decoding (see `GTXKeyValueCache`)
+        if (past_key_value is not None) and past_key_value.static:
+            key_layer, value_layer = past_key_value.get()
+        else:
+            key_layer, value_layer = self.key_value(context)
+            if past_key_value is not None:
+                key_layer, value_layer = past_key_value.update(key_layer, value_layer)
+
+        if attention_mask is not None:
+            attention_mask = additive_attention_mask(attention_mask, query_layer.dtype)
+        attention_probs = None
+        if output_attentions or (self.attention_backend == 'eager'):
+            context_layer, attention_probs = self.eager_attention(query_layer, key_layer, value_layer, attention_mask)
+        elif (self.attention_backend == 'sdpa') and ((attention_mask is None) or (attention_mask.dim() <= 4)):
+            context_layer = F.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+        else:
+            # Chunks of queries only hold (chunk_size x Lk) scores at once
+            chunks = list()
+            for start in range(0, query_layer.size(2), self.attention_chunk_size):
+                chunk_mask = attention_mask
+                if (attention_mask is not None) and (attention_mask.size(-2) > 1):
+                    chunk_mask = attention_mask[..., start:start+self.attention_chunk_size, :]
+                chunks.append(self.eager_attention(query_layer[:, :, start:start+self.attention_chunk_size], key_layer, value_layer, chunk_mask)[0])
+            context_layer = torch.cat(chunks, dim=2)
+
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
@@ -409,9 +488,9 @@ class GTXCrossAttentionLayer(nn.Module):
         self.att = GTXAttention(config)
         self.output = GTXAttentionOutput(config)
 
-    def forward(self, input_tensor, ctx_tensor, ctx_att_mask=None, KnowMix_indices=None, output_attentions=False):
+    def forward(self, input_tensor, ctx_tensor, ctx_att_mask=None, KnowMix_indices=None, output_attentions=False, past_key_value=None):
         if KnowMix_indices is None:
-            output = self.att(input_tensor, ctx_tensor, ctx_att_mask, output_attentions=output_attentions)
+            output = self.att(input_tensor, ctx_tensor, ctx_att_mask, output_attentions=output_attentions, past_key_value=past_key_value)
         else:
             if isinstance(KnowMix_indices,int):
                 output = self.att(input_tensor[:,KnowMix_indices].unsqueeze(1), ctx_tensor, ctx_att_mask, output_attentions=output_attentions)
@@ -430,13 +509,15 @@ class GTXSelfAttentionLayer(nn.Module):
         self.self = GTXAttention(config)
         self.output = GTXAttentionOutput(config)
 
-    def forward(self, input_tensor, attention_mask, output_attentions=False):
+    def forward(self, input_tensor, attention_mask, output_attentions=False, edge_index=None, past_key_value=None):
         # Self attention attends to itself, thus keys and querys are the same (input_tensor).
         output = self.self(
             input_tensor,
             input_tensor,
             attention_mask,
             output_attentions=output_attentions,
+            edge_index=edge_index,
+            past_key_value=past_key_value,
         )
         if output_attentions:
             attention_probs = output[1]
@@ -476,8 +557,8 @@ class GTXLayer(nn.Module):
         self.intermediate = GTXIntermediate(config)
         self.output = GTXOutput(config)
 
-    def forward(self, hidden_states, attention_mask=None, output_attentions=False):
-        outputs = self.attention(hidden_states, attention_mask, output_attentions=output_attentions)
+    def forward(self, hidden_states, attention_mask=None, output_attentions=False, edge_index=None, past_key_value=None):
+        outputs = self.attention(hidden_states, attention_mask, output_attentions=output_attentions, edge_index=edge_index, past_key_value=past_key_value)
         attention_output = outputs[0]
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
@@ -581,6 +662,22 @@ class GTXXLayer(nn.Module):
 
         return lang_output, visual_output
 
+    def unilm_visual_step(self, visual_feats, visual_attention_mask):
+        """
+        Graph side of the ``unilm`` layer, which does not attend to the text.
+        """
+        visual_att_output = self.visn_self_att(visual_feats, visual_attention_mask, output_attentions=False)[0]
+        return self.visn_output(self.visn_inter(visual_att_output), visual_att_output)
+
+    def unilm_lang_step(self, lang_feats, lang_attention_mask, visual_padding_mask, past_key_values):
+        """
+        Text side of the ``unilm`` layer for the positions being decoded, the keys / values of the graph and of the
+        previous positions coming from ``past_key_values`` (``cross`` and ``self`` attention caches).
+        """
+        lang_att_output = self.cross_attention(lang_feats, None, ctx_att_mask=visual_padding_mask, past_key_value=past_key_values['cross'])
+        lang_att_output = self.lang_self_att(lang_att_output[0], lang_attention_mask, output_attentions=False, past_key_value=past_key_values['self'])[0]
+        return self.lang_output(self.lang_inter(lang_att_output), lang_att_output)
+
     def forward(
         self,
         lang_feats,
@@ -781,6 +878,8 @@ class GTXEncoder(nn.Module):
         self.x_layers = nn.ModuleList([GTXXLayer(config) for _ in range(self.num_x_layers)])
         if ("lit" in self.config.KnowMix) or ("abs" in self.config.KnowMix) or ("summary" in self.config.KnowMix) or ("adm" in self.config.KnowMix):
             notifier.critical(f"Use Knowledge Mixup Layer on {config.KnowMix} nodes")
+            if getattr(config, 'kg_message_passing', 'dense') == 'sparse':
+                raise ValueError("Sparse message passing is not supported by the Knowledge Mixup Layers")
             self.r_layers = nn.ModuleList([GTXKnowMixLayer(config) for _ in range(self.num_r_layers)])
         else:
             notifier.critical("Use Standard GAT Layer")
@@ -833,16 +932,17 @@ class GTXEncoder(nn.Module):
         kg_feats,
         kg_attention_mask,
         kg_padding_mask,
+        kg_edge_index=None,
         kg_ext_input_ids=None,
         kg_ext_attention_mask=None,
         kg_ext_sum_input_ids=None,
         kg_ext_sum_attention_mask=None,
+        cross_lang_index=None,
+        cross_kg_index=None,
         output_attentions=None,
     ):
 
-        kg_hidden_states = ()
         language_hidden_states = ()
-        kg_attentions = () if output_attentions or self.config.output_attentions else None
         language_attentions = () if output_attentions or self.config.output_attentions else None
         cross_encoder_attentions = {'txt->kg':(),'kg->txt':()} if output_attentions or self.config.output_attentions else None
         
@@ -865,13 +965,76 @@ class GTXEncoder(nn.Module):
                     language_attentions = language_attentions + (l_outputs[1],)
 
         # Run relational layers
+        kg_feats, kg_hidden_states, kg_attentions = self.encode_kg(
+            kg_feats,
+            kg_attention_mask,
+            kg_edge_index=kg_edge_index,
+            kg_ext_input_ids=kg_ext_input_ids,
+            kg_ext_attention_mask=kg_ext_attention_mask,
+            kg_ext_sum_input_ids=kg_ext_sum_input_ids,
+            kg_ext_sum_attention_mask=kg_ext_sum_attention_mask,
+            output_attentions=output_attentions,
+        )
+
+        # Pair the texts and graphs encoded once each (e.g. with the negatives of the alignment loss)
+        if cross_lang_index is not None:
+            lang_feats, lang_attention_mask = lang_feats[cross_lang_index], lang_attention_mask[cross_lang_index]
+        if cross_kg_index is not None:
+            kg_feats, kg_padding_mask = kg_feats[cross_kg_index], kg_padding_mask[cross_kg_index]
+
+        # Run cross-modality layers
+        for layer_module in self.x_layers:
+            x_outputs = layer_module(
+                lang_feats,
+                lang_attention_mask,
+                kg_feats,
+                kg_padding_mask,
+                kg_padding_mask,
+                output_attentions=output_attentions,
+            )
+            lang_feats, kg_feats = x_outputs[:2]
+            kg_hidden_states = kg_hidden_states + (kg_feats,)
+            language_hidden_states = language_hidden_states + (lang_feats,)
+            if cross_encoder_attentions is not None:
+                cross_encoder_attentions = {k:cross_encoder_attentions[k] + (x_outputs[2][k],) for k in cross_encoder_attentions}
+        kg_encoder_outputs = (
+            kg_hidden_states,
+            kg_attentions if output_attentions else None,
+        )
+        lang_encoder_outputs = (
+            language_hidden_states,
+            language_attentions if output_attentions else None,
+        )
+        return (
+            kg_encoder_outputs,
+            lang_encoder_outputs,
+            cross_encoder_attentions if output_attentions else None,
+        )
+
+    def encode_kg(
+        self,
+        kg_feats,
+        kg_attention_mask,
+        kg_edge_index=None,
+        kg_ext_input_ids=None,
+        kg_ext_attention_mask=None,
+        kg_ext_sum_input_ids=None,
+        kg_ext_sum_attention_mask=None,
+        output_attentions=None,
+    ):
+        """
+        Relational layers, which only see the graph.
+        """
+        kg_hidden_states = ()
+        kg_attentions = () if output_attentions or self.config.output_attentions else None
+
         ## Process the KG attention mask
         if kg_ext_attention_mask is not None:
             if len(kg_ext_attention_mask.shape) == 2:
                 extended_kg_ext_attention_mask = kg_ext_attention_mask.unsqueeze(1).unsqueeze(2)
             elif len(kg_ext_attention_mask.shape) == 3:
                 extended_kg_ext_attention_mask = kg_ext_attention_mask.unsqueeze(1)    
-            extended_kg_ext_attention_mask = extended_kg_ext_attention_mask.to(dtype=lang_attention_mask.dtype)
+            extended_kg_ext_attention_mask = extended_kg_ext_attention_mask.to(dtype=kg_attention_mask.dtype)
             extended_kg_ext_attention_mask = (1.0 - extended_kg_ext_attention_mask) * -10000.0
         else:
             extended_kg_ext_attention_mask = None
@@ -880,7 +1043,7 @@ class GTXEncoder(nn.Module):
                 extended_kg_ext_sum_attention_mask = kg_ext_sum_attention_mask.unsqueeze(1).unsqueeze(2)
             elif len(kg_ext_sum_attention_mask.shape) == 3:
                 extended_kg_ext_sum_attention_mask = kg_ext_sum_attention_mask.unsqueeze(1)    
-            extended_kg_ext_sum_attention_mask = extended_kg_ext_sum_attention_mask.to(dtype=lang_attention_mask.dtype)
+            extended_kg_ext_sum_attention_mask = extended_kg_ext_sum_attention_mask.to(dtype=kg_attention_mask.dtype)
             extended_kg_ext_sum_attention_mask = (1.0 - extended_kg_ext_sum_attention_mask) * -10000.0
         else:
             extended_kg_ext_sum_attention_mask = None
@@ -898,40 +1061,132 @@ class GTXEncoder(nn.Module):
                     output_attentions=output_attentions
                 )
             else:
-                kg_outputs = layer_module(kg_feats, kg_attention_mask, output_attentions=output_attentions)
+                # With `kg_edge_index`, messages only go along the edges of the graphs
+                kg_outputs = layer_module(kg_feats, kg_attention_mask, output_attentions=output_attentions, edge_index=kg_edge_index)
             kg_feats = kg_outputs[0]
             kg_hidden_states = kg_hidden_states + (kg_feats,)
             if kg_attentions is not None:
                 kg_attentions = kg_attentions + (kg_outputs[1],)
+        return kg_feats, kg_hidden_states, kg_attentions
 
-        # Run cross-modality layers
-        for layer_module in self.x_layers:
-            x_outputs = layer_module(
-                lang_feats,
-                lang_attention_mask,
-                kg_feats,
-                kg_padding_mask,
-                kg_padding_mask,
-                output_attentions=output_attentions,
-            )
-            lang_feats, kg_feats = x_outputs[:2]
-            kg_hidden_states = kg_hidden_states + (kg_feats,)
-            language_hidden_states = language_hidden_states + (lang_feats,)
-            if cross_encoder_attentions is not None:
-                cross_encoder_attentions = {k:cross_encoder_attentions[k] + (x_outputs[2][k],) for k in cross_encoder_attentions}
-        kg_encoder_outputs = (
-            kg_hidden_states,
-            kg_attentions if output_attentions else None,
-        )
-        lang_encoder_outputs = (
-            language_hidden_states,
-            language_attentions if output_attentions else None,
-        )
-        return (
-            kg_encoder_outputs,
-            lang_encoder_outputs,
-            cross_encoder_attentions if output_attentions else None,
-        )
+    @staticmethod
+    def lang_layer_step(layer_module, lang_feats, lang_attention_mask, past_key_value):
+        """
+        Language layer over the positions being decoded, their keys / values being kept in ``past_key_value``.
+        The layers are ``transformers`` BERT layers (see ``re_init_to_pretrained_lang_model``), whose own caches are
+        only returned by decoders, so that their attention is run here from their modules.
+        """
+        if isinstance(layer_module, GTXLayer):
+            return layer_module(lang_feats, lang_attention_mask, past_key_value=past_key_value)[0]
+        self_attention = layer_module.attention.self
+        query_layer = self_attention.transpose_for_scores(self_attention.query(lang_feats))
+        key_layer = self_attention.transpose_for_scores(self_attention.key(lang_feats))
+        value_layer = self_attention.transpose_for_scores(self_attention.value(lang_feats))
+        key_layer, value_layer = past_key_value.update(key_layer, value_layer)
+
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        attention_scores = attention_scores / math.sqrt(self_attention.attention_head_size) + lang_attention_mask
+        attention_probs = self_attention.dropout(nn.functional.softmax(attention_scores, dim=-1))
+        context_layer = torch.matmul(attention_probs, value_layer).permute(0, 2, 1, 3).flatten(2)
+        attention_output = layer_module.attention.output(context_layer, lang_feats)
+        return layer_module.output(layer_module.intermediate(attention_output), attention_output)
+
+    def decode_step(self, lang_feats, lang_attention_mask, cache):
+        """
+        Text layers over the positions being decoded, attending to the keys / values of the graph and of the previous
+        positions kept in ``cache`` (``unilm`` cross layers only, see ``GTXModel.init_decoding_cache``).
+        """
+        for layer_module, past_key_value in zip(self.layer, cache.lang_layers):
+            lang_feats = self.lang_layer_step(layer_module, lang_feats, lang_attention_mask, past_key_value)
+        for layer_module, past_key_values in zip(self.x_layers, cache.x_layers):
+            lang_feats = layer_module.unilm_lang_step(lang_feats, lang_attention_mask, cache.kg_padding_mask[cache.rows], past_key_values)
+        return lang_feats
+
+class GTXKeyValueCache:
+    """
+    Keys / values of an attention layer during incremental decoding (see ``GTXDecodingCache``), for every sample and
+    position of the texts to decode. ``update`` writes the ones of the positions being computed and returns the ones
+    they attend to, for the samples selected by the decoding cache; the ones of a ``static`` context (the graphs) are
+    set once and read by ``get``.
+    """
+    def __init__(self, decoding_cache, static=False):
+        self.decoding_cache = decoding_cache
+        self.static = static
+        self.key = None
+        self.value = None
+
+    def get(self):
+        rows = self.decoding_cache.rows
+        return self.key[rows], self.value[rows]
+
+    def update(self, key_layer, value_layer):
+        rows, start, end = self.decoding_cache.rows, self.decoding_cache.start, self.decoding_cache.end
+        if self.key is None:
+            shape = (self.decoding_cache.batch_size, key_layer.size(1), self.decoding_cache.max_length, key_layer.size(3))
+            self.key, self.value = key_layer.new_zeros(shape), value_layer.new_zeros(shape)
+        self.key[rows, :, start:end] = key_layer
+        self.value[rows, :, start:end] = value_layer
+        return self.key[rows, :, :end], self.value[rows, :, :end]
+
+class GTXDecodingCache:
+    """
+    State of the incremental decoding of texts by ``GTXModel.decode_step``: keys / values of the language layers
+    (``lang_layers``), and of the cross-attention to the graphs (``cross``, computed once) and the self-attention
+    (``self``) of the cross layers (``x_layers``).
+    The positions of a sample are kept until their token or token type changes, except the ones whose attention is
+    not causal (padding positions, which attend to the whole prefix) which are computed again at every step, so that
+    outputs are the same as the ones of full forward passes.
+    Args:
+        lang_attention_mask: ``(batch_size, seq_length, seq_length)`` mask of the texts to decode.
+        kg_padding_mask: Additive padding mask of the graphs.
+    """
+    def __init__(self, num_lang_layers, num_x_layers, lang_attention_mask, kg_padding_mask, dtype=torch.float32):
+        self.lang_layers = [GTXKeyValueCache(self) for _ in range(num_lang_layers)]
+        self.x_layers = [{'cross':GTXKeyValueCache(self, static=True), 'self':GTXKeyValueCache(self)} for _ in range(num_x_layers)]
+        self.batch_size, self.max_length = lang_attention_mask.shape[:2]
+        self.kg_padding_mask = kg_padding_mask
+        self.lang_attention_mask = (1.0 - lang_attention_mask.unsqueeze(1).to(dtype=dtype)) * -10000.0
+        # Positions before the first one attending to later positions, or to none (padding), do not depend on the
+        # next tokens
+        mask = lang_attention_mask.bool()
+        not_causal = ~mask.any(-1) | mask.triu(1).any(-1)
+        self.causal_lengths = torch.where(not_causal.any(1), not_causal.int().argmax(1), self.max_length)
+        self.input_ids = None
+        self.token_type_ids = None
+        self.select(slice(None), 0, 0)
+
+    def select(self, rows, start, end):
+        """
+        Samples (``rows``) and positions (``start`` to ``end``) computed by the next calls of the layers.
+        """
+        self.rows, self.start, self.end = rows, start, end
+
+    def reusable_lengths(self, input_ids, token_type_ids):
+        """
+        Number of leading positions of every sample of ``input_ids`` whose keys / values are still valid.
+        """
+        if self.input_ids is None:
+            return torch.zeros(input_ids.size(0), dtype=torch.long, device=input_ids.device)
+        length = min(self.input_ids.size(1), input_ids.size(1))
+        changed = (input_ids[:, :length] != self.input_ids[:, :length]) | (token_type_ids[:, :length] != self.token_type_ids[:, :length])
+        first_changed = torch.where(changed.any(1), changed.int().argmax(1), length)
+        return torch.minimum(first_changed, self.causal_lengths)
+
+    def reorder(self, rows):
+        """
+        Keeps the samples ``rows`` only, in this order (e.g. the beams continued by a beam search, several of which may
+        come from the same sample, or the samples still being decoded).
+        """
+        for key_value in self.lang_layers + [key_value for x_layer in self.x_layers for key_value in x_layer.values()]:
+            if key_value.key is not None:
+                key_value.key, key_value.value = key_value.key[rows], key_value.value[rows]
+        self.batch_size = len(rows)
+        self.kg_padding_mask = self.kg_padding_mask[rows]
+        self.lang_attention_mask = self.lang_attention_mask[rows]
+        self.causal_lengths = self.causal_lengths[rows]
+        if self.input_ids is not None:
+            self.input_ids, self.token_type_ids = self.input_ids[rows], self.token_type_ids[rows]
+        self.select(slice(None), 0, 0)
 
 class GTXPooler(nn.Module):
     def __init__(self, config):
@@ -1149,63 +1404,19 @@ class GTXModel(GTXPreTrainedModel):
         #     literal_emb = kg_emb.sum(1)[literal_idx]/litwords_notpad.sum(1)[literal_idx].unsqueeze(-1)
         #     self.kg_embeddings.word_embeddings.weight.data[literal_idx] = literal_emb
         #     notifier.warning(f"Successfully initialize the KG embdding w/ subword embddings. {literal_idx.float().mean():.2f} indices initialized.")
-    def forward(
+    def embed_kg(
         self,
-        lang_input_ids=None,
-        kg_input_ids=None,
-        lang_inputs_embeds=None,
-        kg_inputs_embeds=None,
-        lang_attention_mask=None,
-        kg_attention_mask=None,
-        kg_padding_mask=None,
-        kg_ext_input_ids = None,
-        kg_ext_attention_mask = None,
-        kg_ext_sum_input_ids = None,
-        kg_ext_sum_attention_mask = None,
-        kg_langinit_input_ids = None,
-        kg_langinit_attention_mask = None,
-        token_type_ids=None,
-        output_attentions=None,
-        output_hidden_states=None,
-        return_dict=None,
+        kg_input_ids,
+        kg_attention_mask,
+        kg_padding_mask,
+        kg_ext_input_ids=None,
+        kg_ext_sum_input_ids=None,
+        kg_langinit_input_ids=None,
+        kg_langinit_attention_mask=None,
     ):
-
-        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
-        output_hidden_states = (
-            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
-        )
-        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
-        if lang_input_ids is not None and lang_inputs_embeds is not None:
-            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
-        elif kg_input_ids is not None and kg_inputs_embeds is not None:
-            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
-
-        # We create a 3D attention mask from a 2D tensor mask.
-        # Sizes are [batch_size, 1, 1, to_seq_length]
-        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
-        # this attention mask is more simple than the triangular masking of causal attention
-        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        if lang_attention_mask is not None:
-            if len(lang_attention_mask.shape)==2: # (batch_size, seq_length)
-                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1).unsqueeze(2)
-            elif len(lang_attention_mask.shape)==3: # (batch_size, seq_length, seq_length)
-                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1)
-            elif len(lang_attention_mask.shape)==4: # (batch_size, 1, seq_length, seq_length)
-                extended_lang_attention_mask = lang_attention_mask
-            else:
-                raise ValueError("Only supports (batch_size, seq_length) or (batch_size, seq_length, seq_length) or even full extended")    
-        else:
-            raise ValueError("there is no attention mask for langauge part")
-
-        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-        # masked positions, this operation will create a tensor which is 0.0 for
-        # positions we want to attend and -10000.0 for masked positions.
-        # Since we are adding it to the raw scores before the softmax, this is
-        # effectively the same as removing these entirely.
-        extended_lang_attention_mask = extended_lang_attention_mask.to(dtype=self.dtype)
-        extended_lang_attention_mask = (1.0 - extended_lang_attention_mask) * -10000.0
-
+        """
+        Embeddings and additive attention / padding masks of the graphs, and embeddings of their external knowledge.
+        """
         # Process the KG attention mask
         if kg_attention_mask is not None:
             if len(kg_attention_mask.shape)==2:
@@ -1244,8 +1455,6 @@ class GTXModel(GTXPreTrainedModel):
             extended_kg_padding_mask = (1.0 - extended_kg_padding_mask) * -10000.0
             extended_kg_attention_mask = extended_kg_padding_mask.clone().detach()
 
-        # Positional Word Embeddings 
-        lang_embedding_output = self.lang_embeddings(lang_input_ids, token_type_ids, lang_inputs_embeds)
         if "linearize" in self.config.KnowMix: 
             kg_inputs_embeds = self.lang_embeddings.word_embeddings(kg_input_ids)
         else:
@@ -1277,6 +1486,169 @@ class GTXModel(GTXPreTrainedModel):
             kg_ext_sum_embedding_output = self.lang_embeddings.word_embeddings(kg_ext_sum_input_ids)
         else:
             kg_ext_sum_embedding_output = None
+
+        return kg_embedding_output, extended_kg_attention_mask, extended_kg_padding_mask, kg_ext_embedding_output, kg_ext_sum_embedding_output
+
+    def supports_decoding_cache(self):
+        # The graphs are encoded independently of the texts only with `unilm` cross layers, and the texts by causal
+        # attention only with BERT layers (with absolute positions)
+        return (
+            (getattr(self.config, 'cross_att_type', 'cross') == 'unilm')
+            and (self.encoder.encoder_type not in ['bilstm', 'lstm'])
+            and all(getattr(layer_module.attention.self, 'position_embedding_type', 'absolute') == 'absolute' for layer_module in self.encoder.layer)
+        )
+
+    def init_decoding_cache(
+        self,
+        lang_attention_mask,
+        kg_input_ids,
+        kg_attention_mask=None,
+        kg_padding_mask=None,
+        kg_edge_index=None,
+        kg_ext_input_ids=None,
+        kg_ext_attention_mask=None,
+        kg_ext_sum_input_ids=None,
+        kg_ext_sum_attention_mask=None,
+        kg_langinit_input_ids=None,
+        kg_langinit_attention_mask=None,
+    ):
+        """
+        Encodes the graphs once for the incremental decoding of their texts (``decode_step``): the relational layers
+        and the graph side of the cross layers run here, and the cross-attention keys / values of every cross layer
+        are kept in the returned cache.
+        Args:
+            lang_attention_mask: ``(batch_size, seq_length, seq_length)`` mask of the texts to decode.
+        """
+        if not self.supports_decoding_cache():
+            raise ValueError("Incremental decoding requires `unilm` cross layers and a BERT language encoder")
+        kg_feats, extended_kg_attention_mask, extended_kg_padding_mask, kg_ext_embedding_output, kg_ext_sum_embedding_output = self.embed_kg(
+            kg_input_ids,
+            kg_attention_mask,
+            kg_padding_mask,
+            kg_ext_input_ids=kg_ext_input_ids,
+            kg_ext_sum_input_ids=kg_ext_sum_input_ids,
+            kg_langinit_input_ids=kg_langinit_input_ids,
+            kg_langinit_attention_mask=kg_langinit_attention_mask,
+        )
+        kg_feats = self.encoder.encode_kg(
+            kg_feats,
+            extended_kg_attention_mask,
+            kg_edge_index=kg_edge_index,
+            kg_ext_input_ids=kg_ext_embedding_output,
+            kg_ext_attention_mask=kg_ext_attention_mask,
+            kg_ext_sum_input_ids=kg_ext_sum_embedding_output,
+            kg_ext_sum_attention_mask=kg_ext_sum_attention_mask,
+            output_attentions=False,
+        )[0]
+        cache = GTXDecodingCache(
+            num_lang_layers=len(self.encoder.layer),
+            num_x_layers=len(self.encoder.x_layers),
+            lang_attention_mask=lang_attention_mask,
+            kg_padding_mask=extended_kg_padding_mask,
+            dtype=self.dtype,
+        )
+        for layer_module, past_key_values in zip(self.encoder.x_layers, cache.x_layers):
+            past_key_values['cross'].key, past_key_values['cross'].value = layer_module.cross_attention.att.key_value(kg_feats)
+            kg_feats = layer_module.unilm_visual_step(kg_feats, extended_kg_padding_mask)
+        return cache
+
+    def decode_step(self, lang_input_ids, token_type_ids, cache):
+        """
+        Encodes the texts ``lang_input_ids`` (``(batch_size, length)``, the prefix decoded so far) from the keys /
+        values kept in ``cache``: only the positions of every sample from the first one whose token, token type or
+        attention changed since the previous step are computed (usually the last decoded token and the next [MASK]).
+        Returns the language output of the last position, ``(batch_size, 1, hidden_size)``.
+        """
+        length = lang_input_ids.size(1)
+        starts = cache.reusable_lengths(lang_input_ids, token_type_ids).clamp(max=length - 1)
+        lang_output = None
+        # Samples computed from the same position go together (all of them, until some are past their length)
+        for start in starts.unique().tolist():
+            rows = (starts == start).nonzero().squeeze(1)
+            if len(rows) == len(starts):
+                rows = slice(None)
+            cache.select(rows, start, length)
+            lang_feats = self.lang_embeddings(lang_input_ids[rows, start:], token_type_ids[rows, start:], past_length=start)
+            lang_feats = self.encoder.decode_step(lang_feats, cache.lang_attention_mask[rows, :, start:length, :length], cache)
+            if lang_output is None:
+                lang_output = lang_feats.new_empty(len(starts), 1, lang_feats.size(-1))
+            lang_output[rows] = lang_feats[:, -1:]
+        cache.input_ids, cache.token_type_ids = lang_input_ids.clone(), token_type_ids.clone()
+        return lang_output
+
+    def forward(
+        self,
+        lang_input_ids=None,
+        kg_input_ids=None,
+        lang_inputs_embeds=None,
+        kg_inputs_embeds=None,
+        lang_attention_mask=None,
+        kg_attention_mask=None,
+        kg_padding_mask=None,
+        kg_edge_index=None,
+        kg_ext_input_ids = None,
+        kg_ext_attention_mask = None,
+        kg_ext_sum_input_ids = None,
+        kg_ext_sum_attention_mask = None,
+        kg_langinit_input_ids = None,
+        kg_langinit_attention_mask = None,
+        token_type_ids=None,
+        lang_position_ids=None,
+        cross_lang_index=None,
+        cross_kg_index=None,
+        output_attentions=None,
+        output_hidden_states=None,
+        return_dict=None,
+    ):
+
+        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+
+        if lang_input_ids is not None and lang_inputs_embeds is not None:
+            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
+        elif kg_input_ids is not None and kg_inputs_embeds is not None:
+            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
+
+        # We create a 3D attention mask from a 2D tensor mask.
+        # Sizes are [batch_size, 1, 1, to_seq_length]
+        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
+        # this attention mask is more simple than the triangular masking of causal attention
+        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
+        if lang_attention_mask is not None:
+            if len(lang_attention_mask.shape)==2: # (batch_size, seq_length)
+                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1).unsqueeze(2)
+            elif len(lang_attention_mask.shape)==3: # (batch_size, seq_length, seq_length)
+                extended_lang_attention_mask = lang_attention_mask.unsqueeze(1)
+            elif len(lang_attention_mask.shape)==4: # (batch_size, 1, seq_length, seq_length)
+                extended_lang_attention_mask = lang_attention_mask
+            else:
+                raise ValueError("Only supports (batch_size, seq_length) or (batch_size, seq_length, seq_length) or even full extended")    
+        else:
+            raise ValueError("there is no attention mask for langauge part")
+
+        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
+        # masked positions, this operation will create a tensor which is 0.0 for
+        # positions we want to attend and -10000.0 for masked positions.
+        # Since we are adding it to the raw scores before the softmax, this is
+        # effectively the same as removing these entirely.
+        extended_lang_attention_mask = extended_lang_attention_mask.to(dtype=self.dtype)
+        extended_lang_attention_mask = (1.0 - extended_lang_attention_mask) * -10000.0
+
+        # Positional Word Embeddings 
+        lang_embedding_output = self.lang_embeddings(lang_input_ids, token_type_ids, lang_inputs_embeds, position_ids=lang_position_ids)
+        kg_embedding_output, extended_kg_attention_mask, extended_kg_padding_mask, kg_ext_embedding_output, kg_ext_sum_embedding_output = self.embed_kg(
+            kg_input_ids,
+            kg_attention_mask,
+            kg_padding_mask,
+            kg_ext_input_ids=kg_ext_input_ids,
+            kg_ext_sum_input_ids=kg_ext_sum_input_ids,
+            kg_langinit_input_ids=kg_langinit_input_ids,
+            kg_langinit_attention_mask=kg_langinit_attention_mask,
+        )
+
         # Run GTX encoder
         encoder_outputs = self.encoder(
             lang_feats=lang_embedding_output,
@@ -1284,10 +1656,13 @@ class GTXModel(GTXPreTrainedModel):
             kg_feats=kg_embedding_output,
             kg_attention_mask=extended_kg_attention_mask,
             kg_padding_mask=extended_kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             kg_ext_input_ids = kg_ext_embedding_output,
             kg_ext_attention_mask = kg_ext_attention_mask,
             kg_ext_sum_input_ids = kg_ext_sum_embedding_output,
             kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
+            cross_lang_index=cross_lang_index,
+            cross_kg_index=cross_kg_index,
             output_attentions=output_attentions,
         )
 
@@ -1378,18 +1753,22 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         kg_label_mask=None,
         lm_label=None,
         kg_label=None,
         cross_label=None,
         token_type_ids=None,
         rc_indeces=None,
+        rc_indeces_mask=None,
         kg_ext_input_ids = None,
         kg_ext_attention_mask = None,
         kg_ext_sum_input_ids = None,
         kg_ext_sum_attention_mask = None,
         kg_langinit_input_ids = None,
         kg_langinit_attention_mask = None,
+        cross_lang_index=None,
+        cross_kg_index=None,
         output_attentions=None,
         output_hidden_states=None,
         return_dict=True,
@@ -1411,6 +1790,15 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             - 1 indicates that the sentence does match the image.
         ans: (``Torch.Tensor`` of shape ``(batch_size)``, `optional`):
             a one hot representation hof the correct answer `optional`
+        rc_indeces (``torch.LongTensor`` of shape ``(batch_size, num_relations, 3)``, `optional`):
+            Head node, tail node and relation label of the edges to classify in each sample, padded to the sample with
+            the most edges.
+        rc_indeces_mask (``torch.BoolTensor`` of shape ``(batch_size, num_relations)``, `optional`):
+            Valid (non-padding) edges of ``rc_indeces``, all of them if None.
+        cross_lang_index, cross_kg_index (``torch.LongTensor`` of shape ``(num_pairs,)``, `optional`):
+            Text and graph (rows of the inputs) paired in each row of the cross-modality layers and outputs, so that
+            negative pairs reuse the single-modality encodings of the inputs instead of re-encoding replicated inputs.
+            The leading rows must pair every sample with itself.
 
         Returns:
         """
@@ -1424,6 +1812,7 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             lang_attention_mask=lang_attention_mask,
             kg_attention_mask=kg_attention_mask,
             kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             token_type_ids=token_type_ids,
             kg_ext_input_ids = kg_ext_input_ids,
             kg_ext_attention_mask = kg_ext_attention_mask,
@@ -1431,6 +1820,8 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
             kg_langinit_input_ids = kg_langinit_input_ids,
             kg_langinit_attention_mask = kg_langinit_attention_mask,
+            cross_lang_index=cross_lang_index,
+            cross_kg_index=cross_kg_index,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
@@ -1441,6 +1832,9 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             GTX_output.kg_output,
             GTX_output.pooled_output,
         )
+        if cross_lang_index is not None:
+            # Token predictions (and their losses) only concern the inputs, i.e. the leading pairs of each sample with itself
+            lang_output, kg_output = lang_output[:lang_input_ids.size(0)], kg_output[:kg_input_ids.size(0)]
         lang_prediction_scores = self.lm_head(lang_output)
         if kg_label_mask is not None:
             kg_prediction_scores = self.classifier(self.dropout(kg_output))
@@ -1487,16 +1881,18 @@ class GTXForKGTokPredAndMaskedLM(GTXPreTrainedModel):
             loss_dict['align_loss']=cross_loss.mean().detach()
         
         if rc_indeces is not None:
-            rc_labels = list()
-            rc_inputs = list()
-            for idx, sample_rc_indeces in enumerate(rc_indeces):
-                for rc_idx in sample_rc_indeces:
-                    rc_inputs.append(torch.cat([kg_output[idx, rc_idx[0]],kg_output[idx, rc_idx[1]]],dim=-1))
-                    rc_labels.append(rc_idx[2])
-            rc_outputs = self.edge_classifier(torch.stack(rc_inputs,dim=0))
-            rc_loss = self.loss_fcts['ce'](rc_outputs,torch.tensor(rc_labels, dtype=torch.long, device=device))
-            total_loss += rc_loss
-            loss_dict['rc_loss']=rc_loss.mean().detach()
+            if rc_indeces_mask is None:
+                rc_indeces_mask = torch.ones(rc_indeces.shape[:2], dtype=torch.bool, device=device)
+            # Valid edges of every sample, in sample order
+            sample_idx, edge_idx = rc_indeces_mask.nonzero(as_tuple=True)
+            rc_edges = rc_indeces[sample_idx, edge_idx]
+            # (num_edges, 2 * hidden_size) concatenated head and tail node outputs, gathered at once
+            rc_inputs = kg_output[sample_idx.unsqueeze(1), rc_edges[:, :2]].flatten(1)
+            if rc_inputs.size(0) > 0:
+                rc_outputs = self.edge_classifier(rc_inputs)
+                rc_loss = self.loss_fcts['ce'](rc_outputs, rc_edges[:, 2])
+                total_loss += rc_loss
+                loss_dict['rc_loss']=rc_loss.mean().detach()
             
         loss_dict['loss'] = total_loss.mean().detach()
         if not return_dict:
@@ -1562,6 +1958,7 @@ class GTXForRanking(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         label=None,
         token_type_ids=None,
         kg_ext_input_ids = None,
@@ -1570,6 +1967,8 @@ class GTXForRanking(GTXPreTrainedModel):
         kg_ext_sum_attention_mask = None,
         kg_langinit_input_ids = None,
         kg_langinit_attention_mask = None,
+        cross_lang_index=None,
+        cross_kg_index=None,
         output_attentions=None,
         output_hidden_states=None,
         return_dict=True,
@@ -1591,6 +1990,9 @@ class GTXForRanking(GTXPreTrainedModel):
             - 1 indicates that the sentence does match the image.
         ans: (``Torch.Tensor`` of shape ``(batch_size)``, `optional`):
             a one hot representation hof the correct answer `optional`
+        cross_lang_index, cross_kg_index (``torch.LongTensor`` of shape ``(num_pairs,)``, `optional`):
+            Text and graph (rows of the inputs) paired in each row of the cross-modality layers and outputs, so that
+            negative pairs reuse the single-modality encodings of the inputs instead of re-encoding replicated inputs.
 
         Returns:
         """
@@ -1607,6 +2009,7 @@ class GTXForRanking(GTXPreTrainedModel):
             lang_attention_mask=lang_attention_mask,
             kg_attention_mask=kg_attention_mask,
             kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             token_type_ids=token_type_ids,
             kg_ext_input_ids = kg_ext_input_ids,
             kg_ext_attention_mask = kg_ext_attention_mask,
@@ -1614,6 +2017,8 @@ class GTXForRanking(GTXPreTrainedModel):
             kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
             kg_langinit_input_ids = kg_langinit_input_ids,
             kg_langinit_attention_mask = kg_langinit_attention_mask,
+            cross_lang_index=cross_lang_index,
+            cross_kg_index=cross_kg_index,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
@@ -1691,6 +2096,7 @@ class GTXForAdmLvlPrediction(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         label=None,
         token_type_ids=None,
         kg_ext_input_ids = None,
@@ -1736,6 +2142,7 @@ class GTXForAdmLvlPrediction(GTXPreTrainedModel):
             lang_attention_mask=lang_attention_mask,
             kg_attention_mask=kg_attention_mask,
             kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             token_type_ids=token_type_ids,
             kg_ext_input_ids = kg_ext_input_ids,
             kg_ext_attention_mask = kg_ext_attention_mask,
@@ -1827,6 +2234,7 @@ class GTXForErrorDetection(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         kg_label=None,
         lm_label=None,
         token_type_ids=None,
@@ -1873,6 +2281,7 @@ class GTXForErrorDetection(GTXPreTrainedModel):
             lang_attention_mask=lang_attention_mask,
             kg_attention_mask=kg_attention_mask,
             kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             token_type_ids=token_type_ids,
             kg_ext_input_ids = kg_ext_input_ids,
             kg_ext_attention_mask = kg_ext_attention_mask,
@@ -1967,6 +2376,7 @@ class GTXForTemporalPred(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         label=None,
         token_type_ids=None,
         kg_ext_input_ids = None,
@@ -2012,6 +2422,7 @@ class GTXForTemporalPred(GTXPreTrainedModel):
             lang_attention_mask=lang_attention_mask,
             kg_attention_mask=kg_attention_mask,
             kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             token_type_ids=token_type_ids,
             kg_ext_input_ids = kg_ext_input_ids,
             kg_ext_attention_mask = kg_ext_attention_mask,
@@ -2101,6 +2512,19 @@ class GTXForGeneration(GTXPreTrainedModel):
         self.mask_token_id = 103
         self.pad_token_id = 0
 
+    @staticmethod
+    def make_lang_attention_mask(attention_mask):
+        """
+        Causal (seq2seq) mask of the text, built on the device from the (batch_size, seq_length) padding mask sent by
+        the collator: each position attends to the positions up to itself, padded positions to none of them.
+        Masks which are already (batch_size, seq_length, seq_length) are returned as is.
+        """
+        if attention_mask.dim() != 2:
+            return attention_mask
+        seq_length = attention_mask.size(1)
+        causal_mask = torch.ones(seq_length, seq_length, dtype=attention_mask.dtype, device=attention_mask.device).tril()
+        return attention_mask.unsqueeze(2) * causal_mask
+
     def forward(
         self,
         lang_input_ids=None,
@@ -2110,6 +2534,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         kg_label_mask=None,
         lm_label=None,
         kg_label=None,
@@ -2127,6 +2552,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         return_dict=True,
     ):
         device = lang_input_ids.device #if lang_input_ids is not None else inputs_embeds.device
+        lang_attention_mask = self.make_lang_attention_mask(lang_attention_mask)
         GTX_output = self.GTX(
             lang_input_ids=lang_input_ids,
             kg_input_ids=kg_input_ids,
@@ -2135,6 +2561,7 @@ class GTXForGeneration(GTXPreTrainedModel):
             lang_attention_mask=lang_attention_mask,
             kg_attention_mask=kg_attention_mask,
             kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
             token_type_ids=token_type_ids,
             kg_ext_input_ids = kg_ext_input_ids,
             kg_ext_attention_mask = kg_ext_attention_mask,
@@ -2217,6 +2644,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         kg_label_mask=None,
         lm_label=None,
         kg_label=None,
@@ -2230,6 +2658,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=True,
+        single_pass=True,
         ):
         
         total_ppl = 0.0
@@ -2245,68 +2674,128 @@ class GTXForGeneration(GTXPreTrainedModel):
         
         assert len(lang_input_ids.shape) == 2
         batch_size, max_seq_length = lang_input_ids.shape
+        lang_attention_mask = self.make_lang_attention_mask(lang_attention_mask)
         
         # set `max_output_length` for max length within a batch
         gt_length = torch.sum(lang_input_ids.not_equal(self.pad_token_id), axis=1)
         max_output_length = torch.max(gt_length).detach()
         assert max_output_length <= max_seq_length
         
-        # construct initial settings [[CLS], [MASK]]
-        mask_ids = lang_input_ids.new(batch_size, 1).fill_(self.mask_token_id)
-        
-        next_pos = 1
-        while next_pos < max_output_length:
-            
-            curr_ids = torch.cat([lang_input_ids[:, :next_pos], mask_ids], axis=1)
-            curr_length = list(curr_ids.size())[1]
-            curr_attention_mask = lang_attention_mask[:, :curr_length, :curr_length]
-            curr_token_type_ids = token_type_ids[:, :curr_length]
-            
-            assert curr_ids.shape[-1] == curr_attention_mask.shape[-1]
-            GTX_output = self.GTX(
-                lang_input_ids=curr_ids,
+        if single_pass and (lang_inputs_embeds is None) and (kg_inputs_embeds is None) and self.GTX.supports_decoding_cache():
+            # Every position scored at once, as by the loop below
+            total_ppl = self._teacher_forced_nll(
+                lm_label,
+                lang_attention_mask,
+                token_type_ids,
+                gt_length,
+                int(max_output_length),
                 kg_input_ids=kg_input_ids,
-                lang_inputs_embeds=lang_inputs_embeds,
-                kg_inputs_embeds=kg_inputs_embeds,
-                lang_attention_mask=curr_attention_mask,
                 kg_attention_mask=kg_attention_mask,
                 kg_padding_mask=kg_padding_mask,
-                token_type_ids=curr_token_type_ids,
-                kg_ext_input_ids = kg_ext_input_ids,
-                kg_ext_attention_mask = kg_ext_attention_mask,
-                kg_ext_sum_input_ids = kg_ext_sum_input_ids,
-                kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
-                kg_langinit_input_ids = kg_langinit_input_ids,
-                kg_langinit_attention_mask = kg_langinit_attention_mask,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
+                kg_edge_index=kg_edge_index,
+                kg_ext_input_ids=kg_ext_input_ids,
+                kg_ext_attention_mask=kg_ext_attention_mask,
+                kg_ext_sum_input_ids=kg_ext_sum_input_ids,
+                kg_ext_sum_attention_mask=kg_ext_sum_attention_mask,
+                kg_langinit_input_ids=kg_langinit_input_ids,
+                kg_langinit_attention_mask=kg_langinit_attention_mask,
             )
+        else:
+            # construct initial settings [[CLS], [MASK]]
+            mask_ids = lang_input_ids.new(batch_size, 1).fill_(self.mask_token_id)
+        
+            next_pos = 1
+            while next_pos < max_output_length:
             
-            lang_output, _, _ = (
-                GTX_output.language_output,
-                GTX_output.kg_output,
-                GTX_output.pooled_output,
-            )
+                curr_ids = torch.cat([lang_input_ids[:, :next_pos], mask_ids], axis=1)
+                curr_length = list(curr_ids.size())[1]
+                curr_attention_mask = lang_attention_mask[:, :curr_length, :curr_length]
+                curr_token_type_ids = token_type_ids[:, :curr_length]
+            
+                assert curr_ids.shape[-1] == curr_attention_mask.shape[-1]
+                GTX_output = self.GTX(
+                    lang_input_ids=curr_ids,
+                    kg_input_ids=kg_input_ids,
+                    lang_inputs_embeds=lang_inputs_embeds,
+                    kg_inputs_embeds=kg_inputs_embeds,
+                    lang_attention_mask=curr_attention_mask,
+                    kg_attention_mask=kg_attention_mask,
+                    kg_padding_mask=kg_padding_mask,
+                    kg_edge_index=kg_edge_index,
+                    token_type_ids=curr_token_type_ids,
+                    kg_ext_input_ids = kg_ext_input_ids,
+                    kg_ext_attention_mask = kg_ext_attention_mask,
+                    kg_ext_sum_input_ids = kg_ext_sum_input_ids,
+                    kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
+                    kg_langinit_input_ids = kg_langinit_input_ids,
+                    kg_langinit_attention_mask = kg_langinit_attention_mask,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=return_dict,
+                )
+            
+                lang_output, _, _ = (
+                    GTX_output.language_output,
+                    GTX_output.kg_output,
+                    GTX_output.pooled_output,
+                )
         
-            last_hidden = lang_output[:, -1, :]
-            prediction_scores = self.lm_head(last_hidden)
-            _lm_label = lm_label[:, next_pos]
-            # log_scores = F.log_softmax(prediction_scores, dim=-1)
+                last_hidden = lang_output[:, -1, :]
+                prediction_scores = self.lm_head(last_hidden)
+                _lm_label = lm_label[:, next_pos]
+                # log_scores = F.log_softmax(prediction_scores, dim=-1)
             
-            masked_lm_loss = self.ce_loss(
-                prediction_scores.view(-1, self.config.vocab_size['lang']),
-                _lm_label,
-            )
-            loss_mask = (curr_length <= gt_length)
-            total_ppl += masked_lm_loss * loss_mask
+                masked_lm_loss = self.ce_loss(
+                    prediction_scores.view(-1, self.config.vocab_size['lang']),
+                    _lm_label,
+                )
+                loss_mask = (curr_length <= gt_length)
+                total_ppl += masked_lm_loss * loss_mask
+            
+                next_pos += 1
             
-            next_pos += 1
             
         total_ppl = torch.exp(total_ppl/gt_length)
         batch_mean_ppl = total_ppl.mean().detach()
         return batch_mean_ppl, lm_label
     
+    def _teacher_forced_nll(self, lm_label, lang_attention_mask, token_type_ids, gt_length, max_output_length, **kg_inputs):
+        """
+        Negative log-likelihood of every text (summed over its positions) in a single forward pass, the same as the
+        one of ``decode_for_ppl`` predicting each position from a [MASK] appended to its prefix. The texts are
+        followed by one [MASK] per scored position (shifted [MASK] layout), with the position and token type of the
+        token it predicts: it attends to the tokens before that one and to itself only, which are attended to
+        causally, so that its output is the one of the [MASK] of the loop.
+        """
+        batch_size, length = lm_label.size(0), max_output_length
+        input_ids = lm_label[:, :length]
+        mask_ids = input_ids.new_full((batch_size, length - 1), self.mask_token_id)
+        position_ids = torch.arange(length, device=input_ids.device)
+        position_ids = torch.cat([position_ids, position_ids[1:]]).unsqueeze(0).expand(batch_size, -1)
+
+        # Tokens keep their attention, the [MASK] of position p attends to the tokens before p and to itself
+        text_mask = lang_attention_mask[:, :length, :length]
+        prefix_mask = lang_attention_mask[:, 1:length, :length].tril()
+        self_mask = torch.diag_embed(lang_attention_mask.diagonal(dim1=1, dim2=2)[:, 1:length])
+        attention_mask = torch.cat([
+            torch.cat([text_mask, text_mask.new_zeros(batch_size, length, length - 1)], dim=2),
+            torch.cat([prefix_mask, self_mask], dim=2),
+        ], dim=1)
+
+        GTX_output = self.GTX(
+            lang_input_ids=torch.cat([input_ids, mask_ids], dim=1),
+            lang_attention_mask=attention_mask,
+            token_type_ids=torch.cat([token_type_ids[:, :length], token_type_ids[:, 1:length]], dim=1),
+            lang_position_ids=position_ids,
+            return_dict=True,
+            **kg_inputs,
+        )
+        # Positions p < gt_length, as scored by the loop
+        rows, positions = (torch.arange(1, length, device=input_ids.device) < gt_length.unsqueeze(1)).nonzero(as_tuple=True)
+        prediction_scores = self.lm_head(GTX_output.language_output[:, length:][rows, positions])
+        masked_lm_loss = self.ce_loss(prediction_scores, lm_label[:, 1:length][rows, positions])
+        return masked_lm_loss.new_zeros(batch_size).index_add(0, rows, masked_lm_loss)
+
     def decode(
         self,
         lang_input_ids=None,
@@ -2316,6 +2805,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         kg_label_mask=None,
         lm_label=None,
         kg_label=None,
@@ -2333,9 +2823,21 @@ class GTXForGeneration(GTXPreTrainedModel):
         clean_outputs=True,
         given_gt_length=False,
         search_beam_size=1,
+        length_penalty=1.0,
+        output_scores=False,
+        use_cache=True,
         ):
-        
+        """
+        Decodes the texts of a batch from their first token: greedily (top-p sampling for Rx texts) if
+        ``search_beam_size`` is 1, else by beam search. Returns ``(output_ids, kg_input_ids, lang_input_ids)``,
+        followed by the scores of the decoded texts with ``output_scores`` (a ``(batch_size,)`` tensor for the beam
+        search, None for greedy decoding). The beam search only returns the best hypothesis of every sample, not its
+        ``search_beam_size`` beams. With ``clean_outputs``, ``output_ids`` is a list of the texts cut before their
+        last [SEP], else a ``(batch_size, output_length)`` tensor. ``use_cache`` decodes from the cached keys / values
+        of the graph and of the decoded prefix (see ``supports_decoding_cache``).
+        """
         device = lang_input_ids.device if lang_input_ids is not None else lang_inputs_embeds.device
+        lang_attention_mask = self.make_lang_attention_mask(lang_attention_mask)
 
         # if lm_label is not None:
         #     ignore_index = -100
@@ -2360,6 +2862,7 @@ class GTXForGeneration(GTXPreTrainedModel):
                 lang_attention_mask=lang_attention_mask,
                 kg_attention_mask=kg_attention_mask,
                 kg_padding_mask=kg_padding_mask,
+                kg_edge_index=kg_edge_index,
                 # kg_label_mask=None,
                 # lm_label=None,
                 # kg_label=None,
@@ -2376,27 +2879,34 @@ class GTXForGeneration(GTXPreTrainedModel):
                 num_db=num_db,
                 gt_length=gt_length,
                 given_lang_tokens=1,
-                top_p_sampling=top_p_sampling
+                top_p_sampling=top_p_sampling,
+                use_cache=use_cache,
             )
             
         # 2. Beam Search Decoding    
         else:
-            output_ids = self._beam_search(
+            output_ids, sequence_scores = self._beam_search(
                 lang_input_ids=lang_input_ids,
                 kg_input_ids=kg_input_ids,
-                # lang_inputs_embeds=lang_inputs_embeds,
+                lang_inputs_embeds=lang_inputs_embeds,
                 kg_inputs_embeds=kg_inputs_embeds,
                 lang_attention_mask=lang_attention_mask,
                 kg_attention_mask=kg_attention_mask,
                 kg_padding_mask=kg_padding_mask,
+                kg_edge_index=kg_edge_index,
+                kg_ext_input_ids=kg_ext_input_ids,
+                kg_ext_attention_mask=kg_ext_attention_mask,
+                kg_ext_sum_input_ids = kg_ext_sum_input_ids,
+                kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
+                kg_langinit_input_ids = kg_langinit_input_ids,
+                kg_langinit_attention_mask = kg_langinit_attention_mask,
                 token_type_ids=token_type_ids,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
                 search_beam_size=search_beam_size,      
                 num_db=num_db,
                 gt_length=gt_length,
                 given_lang_tokens=1,
+                length_penalty=length_penalty,
+                use_cache=use_cache,
             )
         
         if clean_outputs:
@@ -2406,6 +2916,9 @@ class GTXForGeneration(GTXPreTrainedModel):
                                                given_gt_length=given_gt_length)
         
         outputs = (output_ids, kg_input_ids, lang_input_ids)
+        # Scores of the decoded texts (log-likelihoods normalized by `length_penalty`), given by the beam search only
+        if output_scores:
+            outputs = outputs + (sequence_scores if search_beam_size > 1 else None,)
         return outputs
     
     def _greedy_decode(
@@ -2417,6 +2930,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
+        kg_edge_index=None,
         kg_label_mask=None,
         lm_label=None,
         kg_label=None,
@@ -2434,6 +2948,7 @@ class GTXForGeneration(GTXPreTrainedModel):
         gt_length=None,
         given_lang_tokens=1,
         top_p_sampling=True,
+        use_cache=True,
         ):
         
         assert len(lang_input_ids.shape) == 2
@@ -2448,6 +2963,23 @@ class GTXForGeneration(GTXPreTrainedModel):
         curr_ids = lang_input_ids[:, :given_lang_tokens]
         mask_ids = lang_input_ids.new(batch_size, 1).fill_(self.mask_token_id)
         output_ids.append(curr_ids)
+
+        # Graphs encoded once, and only the new positions of the text at each step
+        cache = None
+        if use_cache and (lang_inputs_embeds is None) and self.GTX.supports_decoding_cache():
+            cache = self.GTX.init_decoding_cache(
+                lang_attention_mask,
+                kg_input_ids,
+                kg_attention_mask=kg_attention_mask,
+                kg_padding_mask=kg_padding_mask,
+                kg_edge_index=kg_edge_index,
+                kg_ext_input_ids=kg_ext_input_ids,
+                kg_ext_attention_mask=kg_ext_attention_mask,
+                kg_ext_sum_input_ids=kg_ext_sum_input_ids,
+                kg_ext_sum_attention_mask=kg_ext_sum_attention_mask,
+                kg_langinit_input_ids=kg_langinit_input_ids,
+                kg_langinit_attention_mask=kg_langinit_attention_mask,
+            )
         
         next_pos = given_lang_tokens
         while next_pos < max_output_length:
@@ -2462,31 +2994,35 @@ class GTXForGeneration(GTXPreTrainedModel):
             if num_db == 2:
                 curr_token_type_ids = self.convert_token_type_ids(curr_ids, curr_token_type_ids)
                 
-            GTX_output = self.GTX(
-                lang_input_ids=curr_ids,
-                kg_input_ids=kg_input_ids,
-                lang_inputs_embeds=lang_inputs_embeds,
-                kg_inputs_embeds=kg_inputs_embeds,
-                lang_attention_mask=curr_attention_mask,
-                kg_attention_mask=kg_attention_mask,
-                kg_padding_mask=kg_padding_mask,
-                kg_ext_input_ids=kg_ext_input_ids,
-                kg_ext_attention_mask=kg_ext_attention_mask,
-                kg_ext_sum_input_ids = kg_ext_sum_input_ids,
-                kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
-                kg_langinit_input_ids = kg_langinit_input_ids,
-                kg_langinit_attention_mask = kg_langinit_attention_mask,
-                token_type_ids=curr_token_type_ids,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-                return_dict=return_dict,
-            )
+            if cache is not None:
+                lang_output = self.GTX.decode_step(curr_ids, curr_token_type_ids, cache)
+            else:
+                GTX_output = self.GTX(
+                    lang_input_ids=curr_ids,
+                    kg_input_ids=kg_input_ids,
+                    lang_inputs_embeds=lang_inputs_embeds,
+                    kg_inputs_embeds=kg_inputs_embeds,
+                    lang_attention_mask=curr_attention_mask,
+                    kg_attention_mask=kg_attention_mask,
+                    kg_padding_mask=kg_padding_mask,
+                    kg_edge_index=kg_edge_index,
+                    kg_ext_input_ids=kg_ext_input_ids,
+                    kg_ext_attention_mask=kg_ext_attention_mask,
+                    kg_ext_sum_input_ids = kg_ext_sum_input_ids,
+                    kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
+                    kg_langinit_input_ids = kg_langinit_input_ids,
+                    kg_langinit_attention_mask = kg_langinit_attention_mask,
+                    token_type_ids=curr_token_type_ids,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=return_dict,
+                )
                 
-            lang_output, _, _ = (
-                GTX_output.language_output,
-                GTX_output.kg_output,
-                GTX_output.pooled_output,
-            )
+                lang_output, _, _ = (
+                    GTX_output.language_output,
+                    GTX_output.kg_output,
+                    GTX_output.pooled_output,
+                )
             
             # predict [MASK] by greedy infer.
             last_hidden = lang_output[:, -1, :]
@@ -2542,14 +3078,12 @@ class GTXForGeneration(GTXPreTrainedModel):
         self,
         lang_input_ids=None,
         kg_input_ids=None,
-        # lang_inputs_embeds=None,
+        lang_inputs_embeds=None,
         kg_inputs_embeds=None,
         lang_attention_mask=None,
         kg_attention_mask=None,
         kg_padding_mask=None,
-        kg_label_mask=None,
-        lm_label=None,
-        kg_label=None,
+        kg_edge_index=None,
         kg_ext_input_ids = None,
         kg_ext_attention_mask = None,
         kg_ext_sum_input_ids = None,
@@ -2557,152 +3091,166 @@ class GTXForGeneration(GTXPreTrainedModel):
         kg_langinit_input_ids = None,
         kg_langinit_attention_mask = None,
         token_type_ids=None,
-        output_attentions=None,
-        output_hidden_states=None,
-        return_dict=True,
         search_beam_size=5,
         num_db=1,
         gt_length=None,
         given_lang_tokens=1,
+        length_penalty=1.0,
+        use_cache=True,
         ):
-        
+        """
+        Beam search of ``search_beam_size`` beams per sample, all samples at once. A hypothesis ends with its
+        ``num_db``-th [SEP] (the one closing the last section) and is scored by its log-likelihood divided by its
+        number of decoded tokens to the power ``length_penalty``. A sample is done, and its beams leave the batch,
+        once it has ``search_beam_size`` ended hypotheses that none of its beams can beat anymore; hypotheses still
+        running at the maximum length of the batch end there.
+        Returns the best hypothesis of every sample, ``(batch_size, output_length)`` padded after its end, and its
+        score.
+        """
         batch_size, max_length = lang_input_ids.shape
+        device = lang_input_ids.device
+        K = search_beam_size
 
         # find maximum output_length
-        output_length = torch.max(gt_length).detach()
+        output_length = int(torch.max(gt_length))
         assert output_length <= max_length
-        
-        # init settings
-        curr_ids = lang_input_ids[:, :1]
-        mask_ids = curr_ids.new(batch_size, 1).fill_(self.mask_token_id)
-        # output_ids = []
-        # output_ids.append(curr_ids)
 
-        next_pos = 1
-        K = search_beam_size
+        kg_inputs = dict(
+            kg_input_ids=kg_input_ids,
+            kg_inputs_embeds=kg_inputs_embeds,
+            kg_attention_mask=kg_attention_mask,
+            kg_padding_mask=kg_padding_mask,
+            kg_edge_index=kg_edge_index,
+            kg_ext_input_ids=kg_ext_input_ids,
+            kg_ext_attention_mask=kg_ext_attention_mask,
+            kg_ext_sum_input_ids=kg_ext_sum_input_ids,
+            kg_ext_sum_attention_mask=kg_ext_sum_attention_mask,
+            kg_langinit_input_ids=kg_langinit_input_ids,
+            kg_langinit_attention_mask=kg_langinit_attention_mask,
+        )
 
-        total_scores = []
-        beam_masks = []
-        step_ids = []
-        step_back_ptrs = []
-        # partial_seqs = []
-        # forbid_word_mask = None
-        # buf_matrix = None
+        # Samples still being decoded, with `K` beams (rows) each
+        samples = torch.arange(batch_size, device=device)
+        rows = samples.repeat_interleave(K)
+        curr_ids = lang_input_ids[rows, :given_lang_tokens]
+        token_type_ids = token_type_ids[rows]
+        # Beams start as the same hypothesis, only the first one is expanded at the first step
+        beam_scores = torch.full((batch_size, K), -float('inf'), device=device)
+        beam_scores[:, 0] = 0.0
+        beam_scores = beam_scores.view(-1)
+
+        # Ended hypotheses of every sample, best first
+        hyp_scores = torch.full((batch_size, K), -float('inf'), device=device)
+        hyp_ids = lang_input_ids.new_full((batch_size, K, output_length), self.pad_token_id)
+
+        def add_hypotheses(scores, ids):
+            # `scores` / `ids` of the new hypotheses of the samples being decoded, -inf for none
+            ids = F.pad(ids, (0, output_length - ids.size(-1)), value=self.pad_token_id)
+            pool_scores = torch.cat([hyp_scores[samples], scores], dim=1)
+            pool_ids = torch.cat([hyp_ids[samples], ids], dim=1)
+            best_scores, best = torch.topk(pool_scores, k=K, dim=1)
+            hyp_scores[samples] = best_scores
+            hyp_ids[samples] = pool_ids[torch.arange(len(samples), device=device).unsqueeze(1), best]
+
+        # Graphs encoded once per sample and shared by its beams
+        cache = None
+        if use_cache and (lang_inputs_embeds is None) and (kg_inputs_embeds is None) and self.GTX.supports_decoding_cache():
+            cache = self.GTX.init_decoding_cache(lang_attention_mask, **{k:v for k, v in kg_inputs.items() if k != 'kg_inputs_embeds'})
+            cache.reorder(rows)
+
+        next_pos = given_lang_tokens
+        while next_pos < output_length and len(samples) > 0:
 
-        while next_pos < output_length:
-            
             # construct current inputs
-            curr_length = list(curr_ids.size())[1]
-            curr_ids = torch.cat([curr_ids, mask_ids], axis=1)    
+            num_samples = len(samples)
+            curr_length = curr_ids.size(1)
+            curr_ids = torch.cat([curr_ids, curr_ids.new_full((len(curr_ids), 1), self.mask_token_id)], dim=1)
             curr_token_type_ids = token_type_ids[:, :curr_length+1]
-            curr_attention_mask = lang_attention_mask[:, :curr_length+1, :curr_length+1]
-            
+
             # when dx,prx case, we should consider token_type_ids
             if num_db == 2:
                 curr_token_type_ids = self.convert_token_type_ids(curr_ids, curr_token_type_ids)
-            
-            # output for current inputs
-            GTX_output = self.GTX(
-                lang_input_ids=curr_ids,
-                kg_input_ids=kg_input_ids,
-                lang_attention_mask=curr_attention_mask,
-                kg_padding_mask=kg_padding_mask,
-                token_type_ids=curr_token_type_ids,
-                kg_ext_input_ids = kg_ext_input_ids,
-                kg_ext_attention_mask = kg_ext_attention_mask,
-                kg_ext_sum_input_ids = kg_ext_sum_input_ids,
-                kg_ext_sum_attention_mask = kg_ext_sum_attention_mask,
-                kg_langinit_input_ids = kg_langinit_input_ids,
-                kg_langinit_attention_mask = kg_langinit_attention_mask,
-                output_attentions=False,
-                output_hidden_states=False,
-                return_dict=True,
-            )
-            lang_output, _, _ = (
-                GTX_output.language_output,
-                GTX_output.kg_output,
-                GTX_output.pooled_output,
-            )
-            last_hidden = lang_output[:, -1, :]
-            prediction_scores = self.lm_head(last_hidden)
-            log_scores = F.log_softmax(prediction_scores, dim=-1)
-            
-            # choose top-k logits and indices
-            kk_scores, kk_ids = torch.topk(log_scores, k=K) # (batch_size, beam_size) / (batch_size*beam_size, beam_size)
-            
-            def first_expand(x):
-                input_shape = list(x.size())
-                expanded_shape = input_shape[:1] + [1] + input_shape[1:]
-                x = torch.reshape(x, expanded_shape)
-                repeat_count = [1, K] + [1] * (len(input_shape) - 1)
-                x = x.repeat(*repeat_count)
-                x = torch.reshape(x, [input_shape[0] * K] + input_shape[1:])
-                return x
-            
-            def select_beam_items(x, ids):
-                id_shape = list(ids.size())
-                id_rank = len(id_shape)
-                assert len(id_shape) == 2
-                x_shape = list(x.size())
-                x = torch.reshape(x, [batch_size, K] + x_shape[1:])
-                x_rank = len(x_shape) + 1
-                assert x_rank >= 2
-                if id_rank < x_rank:
-                    ids = torch.reshape(
-                        ids, id_shape + [1] * (x_rank - id_rank))
-                    ids = ids.expand(id_shape + x_shape[1:])
-                y = torch.gather(x, 1, ids)
-                y = torch.reshape(y, x_shape)
-                return y
-            
-            if len(total_scores) == 0: # for the first time,
-                k_ids = torch.reshape(kk_ids, [batch_size, K])
-                back_ptrs = torch.zeros(batch_size, K, dtype=torch.long)
-                k_scores = torch.reshape(kk_scores, [batch_size, K])
-                print('start:', k_scores, k_ids)
+
+            if cache is not None:
+                lang_output = self.GTX.decode_step(curr_ids, curr_token_type_ids, cache)
             else:
-                last_eos = torch.reshape(beam_masks[-1], [batch_size * K, 1])
-                last_seq_scores = torch.reshape(total_scores[-1], [batch_size * K, 1])
-                kk_scores += last_eos * (-10000.0) + last_seq_scores
-                kk_scores = torch.reshape(kk_scores, [batch_size, K * K])
-                k_scores, k_ids = torch.topk(kk_scores, k=K)
-                back_ptrs = torch.floor_divide(k_ids, K)
-                kk_ids = torch.reshape(kk_ids, [batch_size, K * K])
-                print('kk_ids', kk_ids[0])
-                print(k_ids[0])
-                k_ids = torch.gather(kk_ids, 1, k_ids)
-                print('gather 이후:', k_ids[0])
-                curr_ids = select_beam_items(curr_ids, back_ptrs.long())
-                print(curr_ids.shape)
-                for idx in range(curr_ids.shape[0]):
-                    print(self.tokenizer.decode(curr_ids[idx]))
-                print()
-                
-            step_back_ptrs.append(back_ptrs)
-            step_ids.append(k_ids)
-            beam_masks.append(torch.eq(k_ids, self.sep_token_id).float())
-            total_scores.append(k_scores)
-
-            if next_pos == 1: # for the first time,
-                curr_ids = first_expand(curr_ids)
-                kg_input_ids = first_expand(kg_input_ids)
-                token_type_ids = first_expand(token_type_ids)
-                lang_attention_mask = first_expand(lang_attention_mask)
-                kg_padding_mask = first_expand(kg_padding_mask)
-                mask_ids = first_expand(mask_ids)
-            
-            # fill out the [MASK]'s position with stretched ids
-            curr_ids[:, curr_length] = torch.reshape(k_ids, [batch_size * K])
+                GTX_output = self.GTX(
+                    lang_input_ids=curr_ids,
+                    lang_attention_mask=lang_attention_mask[rows, :curr_length+1, :curr_length+1],
+                    token_type_ids=curr_token_type_ids,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                    **self._select_graphs(kg_inputs, rows),
+                )
+                lang_output = GTX_output.language_output
+            log_scores = F.log_softmax(self.lm_head(lang_output[:, -1, :]), dim=-1)
+            vocab_size = log_scores.size(-1)
+
+            # Best 2K continuations of every sample, at least K of which go on (a beam ends at most once)
+            scores = (beam_scores.unsqueeze(1) + log_scores).view(num_samples, K * vocab_size)
+            cand_scores, cand_ids = torch.topk(scores, k=2*K, dim=1)
+            cand_rows = torch.div(cand_ids, vocab_size, rounding_mode='floor') + K * torch.arange(num_samples, device=device).unsqueeze(1)
+            cand_tokens = cand_ids % vocab_size
+            num_sep = curr_ids[:, :curr_length].eq(self.sep_token_id).sum(1)
+            ended = cand_tokens.eq(self.sep_token_id) & (num_sep[cand_rows] + 1 >= num_db)
+
+            # Hypotheses ending among the K best continuations
+            num_tokens = curr_length + 1 - given_lang_tokens
+            new_hyps = ended & (torch.arange(2*K, device=device) < K)
+            if new_hyps.any():
+                ended_ids = torch.cat([curr_ids[cand_rows.view(-1), :curr_length], cand_tokens.view(-1, 1)], dim=1)
+                add_hypotheses(
+                    (cand_scores / num_tokens ** length_penalty).masked_fill(~new_hyps, -float('inf')),
+                    ended_ids.view(num_samples, 2*K, -1),
+                )
+
+            # The K best continuations going on are the next beams
+            beam_scores, beam_ids = torch.topk(cand_scores.masked_fill(ended, -float('inf')), k=K, dim=1)
+            beam_rows = cand_rows.gather(1, beam_ids).view(-1)
+            curr_ids = torch.cat([curr_ids[beam_rows, :curr_length], cand_tokens.gather(1, beam_ids).view(-1, 1)], dim=1)
+            token_type_ids = token_type_ids[beam_rows]
+            if cache is not None:
+                cache.reorder(beam_rows)
             next_pos += 1
-            
-        output_ids = curr_ids.reshape(batch_size, K, -1)
-        
-        for idx in range(K):
-            print(f'batch_idx:0, beam_idx:{idx}:', self.tokenizer.decode(output_ids[0][idx], skip_special_tokens=True))
-            print()
-        print('original text:', self.tokenizer.decode(lang_input_ids[0], skip_special_tokens=True))
-        
-        return output_ids
+
+            # Samples whose K-th hypothesis scores above any their best beam may still reach are done: log-likelihoods
+            # only decrease, length normalization raises them at most up to the maximum length
+            bound_length = (output_length - given_lang_tokens) if length_penalty > 0 else num_tokens
+            done = hyp_scores[samples, -1] >= beam_scores[:, 0] / bound_length ** length_penalty
+            beam_scores = beam_scores.view(-1)
+            if done.any():
+                keep = (~done).nonzero().squeeze(1)
+                kept_rows = (keep.unsqueeze(1) * K + torch.arange(K, device=device)).view(-1)
+                samples = samples[keep]
+                curr_ids, token_type_ids, beam_scores = curr_ids[kept_rows], token_type_ids[kept_rows], beam_scores[kept_rows]
+                if cache is not None:
+                    cache.reorder(kept_rows)
+            rows = samples.repeat_interleave(K)
+
+        # Hypotheses still running end at the maximum length
+        if len(samples) > 0:
+            num_tokens = max(curr_ids.size(1) - given_lang_tokens, 1)
+            add_hypotheses((beam_scores / num_tokens ** length_penalty).view(len(samples), K), curr_ids.view(len(samples), K, -1))
+
+        return hyp_ids[:, 0], hyp_scores[:, 0]
+
+    @staticmethod
+    def _select_graphs(kg_inputs, samples):
+        """
+        Graph inputs of the given ``samples`` (e.g. one per beam), in this order: edge lists ``kg_edge_index`` are
+        relabeled to the rows of their samples.
+        """
+        selected = dict()
+        for k, v in kg_inputs.items():
+            if v is None:
+                selected[k] = None
+            elif k == 'kg_edge_index':
+                rows, edges = (v[:, 0].unsqueeze(0) == samples.unsqueeze(1)).nonzero(as_tuple=True)
+                selected[k] = torch.cat([rows.unsqueeze(1), v[edges, 1:]], dim=1)
+            else:
+                selected[k] = v[samples]
+        return selected
     
     def clean_output_ids(self, output_ids, gt_length, num_sep_id, given_gt_length):
         c_output_ids = []
@@ -2714,25 +3262,18 @@ class GTXForGeneration(GTXPreTrainedModel):
                 c_output_ids.append(o[:min(l_gt, l_sep)])
         else:
             for o in output_ids:
-                if len(o.shape) == 1: # greedy
-                    sep_idx = o.eq(self.sep_token_id)
-                    l_sep = torch.nonzero(sep_idx)[num_sep_id-1] if sep_idx.sum() >= num_sep_id else 512
-                    c_output_ids.append(o[:min(512, l_sep)])
-                else: # beam search
-                    c_output_id = []
-                    for oo in o:
-                        sep_idx = oo.eq(self.sep_token_id)
-                        l_sep = torch.nonzero(sep_idx)[num_sep_id-1] if sep_idx.sum() >= num_sep_id else 512
-                        c_output_id.append(oo[:min(512, l_sep)])
-                    assert len(c_output_id) == o.shape[0] # beam size
-                    c_output_ids.append(c_output_id)
+                sep_idx = o.eq(self.sep_token_id)
+                l_sep = torch.nonzero(sep_idx)[num_sep_id-1] if sep_idx.sum() >= num_sep_id else 512
+                c_output_ids.append(o[:min(512, l_sep)])
         return c_output_ids
     
     def convert_token_type_ids(self, curr_ids, curr_token_type_ids):
-        for idx in range(len(curr_ids)):
-            if self.sep_token_id in curr_ids[idx][-2]:
-                first_sep_idx = torch.nonzero(curr_ids[idx].eq(self.sep_token_id))[0]
-                curr_token_type_ids[idx][first_sep_idx+1:] = 1        
+        # Positions after the first [SEP] of the samples which just decoded a [SEP] (before the [MASK]) move to the
+        # second section
+        is_sep = curr_ids.eq(self.sep_token_id)
+        first_sep = torch.where(is_sep.any(1), is_sep.int().argmax(1), curr_ids.size(1))
+        after_first_sep = torch.arange(curr_ids.size(1), device=curr_ids.device).unsqueeze(0) > first_sep.unsqueeze(1)
+        curr_token_type_ids[after_first_sep & is_sep[:, -2:-1]] = 1
         return curr_token_type_ids
 
 class UnimodalEmbeddings(nn.Module):
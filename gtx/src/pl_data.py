@@ -1,14 +1,20 @@
 # Base pkgs
 import os
 import itertools
+import dataclasses
 import torch
 import pytorch_lightning as pl
 from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.dataset import IterableDataset
+from torch.utils.data.distributed import DistributedSampler
 from typing import Any, Callable, Dict, List, NewType, Optional, Tuple, Union
 
 # User defined pkgs
-from utils.dataset import get_dataset
+from utils.dataset import get_dataset, StreamingDataset
+from utils.samplers import LengthGroupedBatchSampler, TokenBudgetBatchSampler, dataset_lengths, distributed_rank
 from utils.data_collator import NodeClassification_DataCollator, NegativeSampling_DataCollator, UniLM_DataCollator, AdmLvlPred_DataCollator, ErrorDetection_DataCollator, Evaluation_DataCollator, TemporalPred_DataCollator
+from utils.corruption import CorruptionTable
+from utils.prefetch import PrefetchDataLoader, PrefetchMetrics
 
 # Huggingface Transformers Module
 from transformers import (
@@ -46,6 +52,12 @@ class DataModule(pl.LightningDataModule):
                     "and load it from here, using --tokenizer_name"
                 )
         self.tokenizer = tokenizer
+        # Position of a streaming training set restored from a checkpoint
+        self.train_dataset_state = None
+        # Length grouped batches of the training set, reshuffled every epoch
+        self.train_batch_sampler = None
+        # Input pipeline counters of the prefetching DataLoaders
+        self.prefetch_metrics = {stage:PrefetchMetrics() for stage in ("train", "valid", "test")}
 
         # Set block size for padding & truncating inputs
         if data_args.block_size <= 0:
@@ -101,41 +113,107 @@ class DataModule(pl.LightningDataModule):
         # else:
         id2desc=None
 
+        corruption_table = None
+        if (self.args.task == "ErrDetect") and (self.args.corruption_table is not None):
+            # Literal features of the nodes are tokenized with the dataset and would not follow their corruption
+            if self.args.knowmix:
+                raise ValueError("On the fly corruption does not support knowmix, use a precomputed ErrDetect db instead")
+            corruption_table = CorruptionTable.load(self.args.corruption_table)
+
         collator_args = {
             "tokenizer": self.tokenizer,
             "align": self.args.align,
             "n_negatives": self.args.n_negatives if stage=="fit" else 1,
+            "virtual_negatives": self.args.virtual_negatives,
             "edge_cls": self.args.edge_cls,
             "kg_special_token_ids": self.config.kg_special_token_ids,
             "kg_size": self.config.vocab_size['kg'],
             "num_labels": self.config.num_labels,
             "label_domain": self.args.label_domain,
             "id2desc": id2desc if self.args.knowmix else None,
-            "linearize": "linearize" in self.args.knowmix
+            "linearize": "linearize" in self.args.knowmix,
+            # A token budget only holds for batches trimmed to their longest sample
+            "dynamic_padding": self.args.dynamic_padding or (self.args.max_tokens_per_batch is not None),
+            # Batches collated in the main process are allocated pinned instead of copied by the pin memory thread
+            "pin_memory": self.args.dataloader_pin_memory and (self.args.dataloader_num_workers == 0),
+            "device_masking": self.args.device_masking,
+            "corruption_table": corruption_table,
+            "corruption_probability": self.args.corruption_probability,
+            "seed": self.args.seed,
+            # Relational layers of the unimodal models only take dense adjacency masks
+            "sparse_adjacency": (getattr(self.config, 'kg_message_passing', 'dense') == 'sparse') and not self.args.unimodal,
         }
         self.data_collator = COLLATORS[self.args.task](**{k:v for k,v in collator_args.items() if k in COLLATORS[self.args.task].__annotations__}, prediction=self.args.do_predict)
+        # Validation draws from its own batch generators, kept at epoch 0 so that every evaluation sees the same corruptions
+        self.eval_data_collator = dataclasses.replace(self.data_collator)
 
     def train_dataloader(self):
-        return DataLoader(
+        if isinstance(self.train_dataset, StreamingDataset) and (self.train_dataset_state is not None):
+            self.train_dataset.load_state_dict(self.train_dataset_state)
+            if getattr(self.data_collator, 'rng', None) is not None:
+                self.data_collator.rng.resume(self.train_dataset_state['epoch'], self.train_dataset_state['batches_consumed'])
+            self.train_dataset_state = None
+        if self.batch_by_length and not isinstance(self.train_dataset, IterableDataset):
+            self.train_batch_sampler = self.length_grouped_sampler(self.train_dataset, self.args.train_batch_size, drop_last=self.args.dataloader_drop_last, shuffle=True)
+            return self.dataloader(
+                self.train_dataset,
+                stage="train",
+                batch_sampler=self.train_batch_sampler,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        return self.dataloader(
             self.train_dataset,
+            stage="train",
             batch_size=self.args.train_batch_size,
             collate_fn=self.data_collator,
             drop_last=self.args.dataloader_drop_last,
             num_workers=self.args.dataloader_num_workers,
             pin_memory=self.args.dataloader_pin_memory,
-            shuffle=True,
+            shuffle=not isinstance(self.train_dataset, IterableDataset),
         )
 
     def val_dataloader(self):
-        return DataLoader(
+        if self.batch_by_length:
+            return self.dataloader(
+                self.eval_dataset,
+                stage="valid",
+                batch_sampler=self.length_grouped_sampler(self.eval_dataset, self.args.eval_batch_size, drop_last=False, shuffle=False),
+                collate_fn=self.eval_data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        return self.dataloader(
             self.eval_dataset,
+            stage="valid",
             batch_size=self.args.eval_batch_size,
-            collate_fn=self.data_collator,
+            collate_fn=self.eval_data_collator,
             drop_last=False,
             num_workers=self.args.dataloader_num_workers,
             pin_memory=self.args.dataloader_pin_memory,
             shuffle=False)
 
+    def dataloader(self, dataset, stage, **kwargs):
+        # Batches are collated ahead by a background thread, its queue depth and wait times counted per stage
+        if self.args.dataloader_prefetch_batches > 0:
+            return PrefetchDataLoader(dataset, prefetch_batches=self.args.dataloader_prefetch_batches, metrics=self.prefetch_metrics[stage], **kwargs)
+        return DataLoader(dataset, **kwargs)
+
+    @property
+    def batch_by_length(self):
+        return self.args.group_by_length or (self.args.max_tokens_per_batch is not None)
+
+    def length_grouped_sampler(self, dataset, batch_size, drop_last, shuffle):
+        lengths = dataset_lengths(dataset, self.config.kg_special_token_ids['PAD'])
+        if self.args.max_tokens_per_batch is not None:
+            # `batch_size` only sizes the pool of samples sorted together
+            sampler = TokenBudgetBatchSampler(lengths, self.args.max_tokens_per_batch, shuffle=shuffle, mega_batch_size=batch_size*self.args.length_grouping_mult, seed=self.args.seed)
+        else:
+            sampler = LengthGroupedBatchSampler(lengths, batch_size, drop_last=drop_last, shuffle=shuffle, mega_batch_mult=self.args.length_grouping_mult, seed=self.args.seed)
+        notifier.warning(f"Grouping {len(lengths)} samples by length into {len(sampler)} batches ({sampler.padding_ratio():.1%} padding left after trimming)")
+        return sampler
+
     def test_dataloader(self, batch_size=None):
         if batch_size is None:
             if self.args.task == "Re":
@@ -147,16 +225,37 @@ class DataModule(pl.LightningDataModule):
         
         if self.args.task == "Re":
             self.data_collator.n_negatives=0
+            # Test batches are concatenated with the batches of the negative sampler, which must keep the same lengths
+            self.data_collator.dynamic_padding=False
+
+        # Lightning does not add the DistributedSampler when batches are grouped by length or token budget (`replace_sampler_ddp`)
+        sampler = None
+        rank, world_size = distributed_rank()
+        if self.batch_by_length and (world_size > 1):
+            sampler = DistributedSampler(self.test_dataset, num_replicas=world_size, rank=rank, shuffle=False)
 
-        return DataLoader(
+        return self.dataloader(
             self.test_dataset,
+            stage="test",
             batch_size=bsize,
+            sampler=sampler,
             collate_fn=self.data_collator,
             drop_last=False,
             num_workers=self.args.dataloader_num_workers,
             pin_memory=self.args.dataloader_pin_memory,
             shuffle=False)
 
+    def on_save_checkpoint(self, checkpoint):
+        # Only a streaming training set has a position to resume from
+        train_dataset = getattr(self, 'train_dataset', None)
+        if isinstance(train_dataset, StreamingDataset) and (self.trainer is not None):
+            batches_consumed = self.trainer.fit_loop.epoch_loop.batch_progress.current.completed
+            checkpoint['train_dataset'] = train_dataset.state_dict(batches_consumed, self.args.train_batch_size)
+
+    def on_load_checkpoint(self, checkpoint):
+        # Applied by the next train_dataloader, the training set is only built by prepare_data
+        self.train_dataset_state = checkpoint.get('train_dataset')
+
     def save(self):
         output_dir = self.args.output_dir
         if (self.args.use_tpu and self.local_rank == 0) or not self.args.use_tpu:
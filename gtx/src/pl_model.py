@@ -32,6 +32,7 @@ class GTXModel(pl.LightningModule):
 
         self.best_val_metric = -1e10
         self.best_test_metric = -1e10
+        self._masking_generator = None
   
         if training_args.unimodal:
             if training_args.unimodal == "graph":
@@ -114,6 +115,51 @@ class GTXModel(pl.LightningModule):
     def forward(self, x):
         return self.model(x)
 
+    def on_train_epoch_start(self):
+        # Streaming datasets reshuffle their shards every epoch, length grouped batches are drawn again
+        train_dataset = getattr(self.trainer.datamodule, 'train_dataset', None)
+        if hasattr(train_dataset, 'set_epoch'):
+            train_dataset.set_epoch(self.current_epoch)
+        train_batch_sampler = getattr(self.trainer.datamodule, 'train_batch_sampler', None)
+        if train_batch_sampler is not None:
+            train_batch_sampler.set_epoch(self.current_epoch)
+        # Batch generators of the collator are seeded from the epoch
+        data_collator = getattr(self.trainer.datamodule, 'data_collator', None)
+        if getattr(data_collator, 'rng', None) is not None:
+            data_collator.rng.set_epoch(self.current_epoch)
+        if self.training_args.dataloader_prefetch_batches > 0:
+            self.trainer.datamodule.prefetch_metrics['train'].reset()
+
+    def on_validation_epoch_start(self):
+        data_collator = getattr(self.trainer.datamodule, 'eval_data_collator', None)
+        if getattr(data_collator, 'rng', None) is not None:
+            data_collator.rng.set_epoch(0)
+        if self.training_args.dataloader_prefetch_batches > 0:
+            self.trainer.datamodule.prefetch_metrics['valid'].reset()
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Masking deferred by the data collator (`device_masking`) runs on the device the batch was moved to
+        datamodule = self.trainer.datamodule
+        data_collator = datamodule.data_collator if self.trainer.training else getattr(datamodule, 'eval_data_collator', datamodule.data_collator)
+        if getattr(data_collator, 'device_masking', False) and not data_collator.prediction:
+            batch = data_collator.mask_batch(batch, generator=self.masking_generator(batch['lang_input_ids'].device, data_collator))
+        return batch
+
+    def masking_generator(self, device, data_collator=None):
+        """
+        Generator of the masks drawn on ``device``: the batch generator of ``data_collator`` if it has one, otherwise
+        seeded per rank so that ranks corrupt their batches differently but reproducibly. None (the default generator)
+        on devices without generators of their own (e.g. TPU).
+        """
+        if device.type not in ('cpu', 'cuda'):
+            return None
+        if getattr(data_collator, 'rng', None) is not None:
+            return data_collator.rng.generator(device)
+        if (self._masking_generator is None) or (self._masking_generator.device != device):
+            self._masking_generator = torch.Generator(device=device)
+            self._masking_generator.manual_seed(self.training_args.seed + self.global_rank)
+        return self._masking_generator
+
     def training_step(self, batch, batch_idx):
         if self.global_step==1:
             notifier.critical("Here is the actual input of model")
@@ -125,6 +171,13 @@ class GTXModel(pl.LightningModule):
             on_step=False if self.training_args.use_tpu else True,
             on_epoch=True if self.training_args.use_tpu else False,
         )
+        # Running means over the epoch: an empty queue and long waits mean the run is input-bound
+        if self.training_args.dataloader_prefetch_batches > 0:
+            self.log_dict(
+                self.trainer.datamodule.prefetch_metrics['train'].summary(prefix="train_"),
+                on_step=False if self.training_args.use_tpu else True,
+                on_epoch=True if self.training_args.use_tpu else False,
+            )
 
         return outputs.loss
 
@@ -163,6 +216,8 @@ class GTXModel(pl.LightningModule):
                     current_epoch=self.current_epoch,
                 )
             )
+        if self.training_args.dataloader_prefetch_batches > 0:
+            epoch_metrics.update(self.trainer.datamodule.prefetch_metrics['valid'].summary(prefix="valid_"))
         self.log_dict(epoch_metrics)
         return epoch_metrics
 
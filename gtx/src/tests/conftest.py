@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of gtx/src are imported as top level packages (`utils`, `model`), as by main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
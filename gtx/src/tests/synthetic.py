@@ -0,0 +1,75 @@
+"""
+Small random dbs laid out as the preprocessed splits (see ``preprocessing``) and tiny random models, for the tests.
+"""
+import os
+import random
+import torch
+from transformers import BertTokenizerFast
+
+from configuration import GTXConfig
+from model import GTXForGeneration
+from utils.data_collator import UniLM_DataCollator
+from utils.dataset import Featurizer, iter_samples
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+WORDS = ['aspirin', 'cough', 'daily', 'dose', 'failure', 'fever', 'heart', 'insulin', 'iv', 'mg', 'oral', 'pneumonia', 'saline', 'sepsis', 'tablet']
+TOKEN_TYPE_VOCAB = {'dx':0, 'prx':1}
+KG_SPECIAL_TOKEN_IDS = {'PAD':0, 'MASK':1, 'CLS':2}
+KG_SIZE = 64
+
+def tokenizer():
+    return BertTokenizerFast(os.path.join(FIXTURES_DIR, 'vocab.txt'))
+
+def words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+def make_db(num_samples, num_nodes=12, seed=0):
+    """
+    Raw db dict (field -> one entry per sample). The second node of sample ``i`` is ``3 + i`` so that samples can be
+    told apart once featurized.
+    """
+    rng = random.Random(seed)
+    db = {k:list() for k in ('input', 'mask', 'label', 'label_mask', 'rc_index', 'knowledge', 'text')}
+    for i in range(num_samples):
+        size = rng.randint(num_nodes // 2, num_nodes)
+        nodes = [KG_SPECIAL_TOKEN_IDS['CLS'], 3 + i] + [rng.randrange(3, KG_SIZE) for _ in range(size - 2)] + [KG_SPECIAL_TOKEN_IDS['PAD']] * (num_nodes - size)
+        mask = [[int((r == c) or ((r < size) and (c < size) and (rng.random() < 0.3))) for c in range(num_nodes)] for r in range(num_nodes)]
+        db['input'].append(nodes)
+        db['mask'].append(mask)
+        db['label'].append(list(nodes))
+        db['label_mask'].append([0] + [1] * (size - 1) + [0] * (num_nodes - size))
+        db['rc_index'].append([[rng.randrange(1, size), rng.randrange(1, size), rng.randrange(1, 8)] for _ in range(rng.randint(1, 4))])
+        db['knowledge'].append([words(rng, rng.randint(0, 3)) for _ in range(num_nodes)])
+        db['text'].append({'dx':words(rng, rng.randint(4, 20)), 'prx':words(rng, rng.randint(2, 10))})
+    return db
+
+def save_db(file_path, db):
+    os.makedirs(file_path, exist_ok=True)
+    torch.save(db, os.path.join(file_path, 'db'))
+    return os.path.join(file_path, 'db')
+
+def features(num_samples, seed=0, block_size=32):
+    return Featurizer(tokenizer(), block_size, TOKEN_TYPE_VOCAB, gcn=True).featurize_batch(list(iter_samples(make_db(num_samples, seed=seed))))
+
+def generation_model(seed=0, **config):
+    """
+    Randomly initialized ``GTXForGeneration`` of ``fixtures/config.json`` (a tiny BERT language part, cold started),
+    with ``config`` overriding its options.
+    """
+    gtx_config = GTXConfig.from_json_file(os.path.join(FIXTURES_DIR, 'config.json'))
+    gtx_config.pretrained_lang_model = {'model_name':os.path.join(FIXTURES_DIR, 'bert'), 'use_weight':False}
+    for k, v in config.items():
+        setattr(gtx_config, k, v)
+    torch.manual_seed(seed)
+    model = GTXForGeneration(gtx_config).eval()
+    model.sep_token_id, model.mask_token_id = tokenizer().sep_token_id, tokenizer().mask_token_id
+    return model
+
+def generation_batch(features, sparse_adjacency=False, num_db=2):
+    """
+    Batch of ``features`` as collated for decoding, with the texts of a single db (Rx, sampled) if ``num_db`` is 1.
+    """
+    batch = UniLM_DataCollator(tokenizer(), KG_SPECIAL_TOKEN_IDS, sparse_adjacency=sparse_adjacency, prediction=True)(features)
+    if num_db == 1:
+        batch['token_type_ids'].zero_()
+    return batch
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from utils.corruption import CorruptionTable, corrupt_nodes
+
+KG_SIZE = 40
+GROUPS = [[3, 4, 5, 6], [10, 11], [20, 21, 22], [30]]
+# Literal node of every code, replaced along with it
+LINKED = {3:33, 4:34, 5:35, 6:36}
+
+def group_of(node):
+    return next((i for i, group in enumerate(GROUPS) if node in group), None)
+
+class TestCorruptionTable(unittest.TestCase):
+    def setUp(self):
+        self.table = CorruptionTable.from_groups(GROUPS, KG_SIZE, weights={20:0.0, 21:2.0, 22:1.0}, linked=LINKED)
+
+    def test_from_groups(self):
+        # Groups of a single node have no replacement
+        self.assertEqual(self.table.group[30].item(), -1)
+        self.assertEqual(self.table.offsets.tolist(), [0, 4, 6, 9])
+        for node in (3, 4, 5, 6, 10, 11, 20, 21, 22):
+            group = self.table.group[node]
+            self.assertEqual(self.table.members[self.table.offsets[group] + self.table.position[node]].item(), node)
+        self.assertEqual(self.table.weight[[3, 20, 21, 0]].tolist(), [1.0, 0.0, 2.0, 0.0])
+        self.assertEqual(self.table.linked[[3, 10]].tolist(), [33, -1])
+        with self.assertRaises(ValueError):
+            CorruptionTable.from_groups([[1, 2], [2, 3]], KG_SIZE)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'table.pt')
+            self.table.save(path)
+            loaded = CorruptionTable.load(path)
+        for k, v in self.table.state_dict().items():
+            self.assertTrue(torch.equal(loaded.state_dict()[k], v), k)
+
+    def test_corrupt_nodes(self):
+        inputs = torch.tensor([
+            [2, 3, 33, 10, 20, 21, 7, 0],
+            [2, 4, 34, 5, 35, 22, 30, 0],
+            [2, 7, 8, 9, 30, 0, 0, 0],
+        ])
+        generator = torch.Generator().manual_seed(0)
+        for ratio in (0.25, 0.5, 1.0):
+            with self.subTest(ratio=ratio):
+                corrupted, changed = corrupt_nodes(inputs, self.table, ratio, generator=generator)
+                self.assertEqual(changed.dtype, torch.float32)
+                self.assertTrue(torch.equal(changed.bool(), corrupted != inputs))
+                # Weighted candidates (node 20 has no weight, 30 is alone in its group), at least one per graph
+                candidates = torch.tensor([[0, 1, 0, 1, 0, 1, 0, 0], [0, 1, 0, 1, 0, 1, 0, 0], [0] * 8]).bool()
+                num_changed = (changed.bool() & candidates).sum(1)
+                self.assertEqual(num_changed.tolist(), [max(1, int(3 * ratio)), max(1, int(3 * ratio)), 0])
+                for row, col in (changed.bool() & candidates).nonzero().tolist():
+                    old, new = inputs[row, col].item(), corrupted[row, col].item()
+                    self.assertNotEqual(old, new)
+                    self.assertEqual(group_of(old), group_of(new))
+                    # Literal of a replaced code follows it
+                    if old in LINKED:
+                        literal = inputs[row].tolist().index(LINKED[old])
+                        self.assertEqual(corrupted[row, literal].item(), LINKED[new])
+                # Nothing else changes
+                untouched = ~candidates & ~torch.isin(inputs, torch.tensor(list(LINKED.values())))
+                self.assertTrue(torch.equal(corrupted[untouched], inputs[untouched]))
+
+    def test_generator(self):
+        inputs = torch.tensor([[2, 3, 4, 5, 6, 10, 11, 21, 22]] * 4)
+        first = corrupt_nodes(inputs, self.table, 0.5, generator=torch.Generator().manual_seed(3))[0]
+        second = corrupt_nodes(inputs, self.table, 0.5, generator=torch.Generator().manual_seed(3))[0]
+        self.assertTrue(torch.equal(first, second))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import copy
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from utils.data_collator import BatchRNG, BatchTensorizer, adjacency_edge_index, batch_edges, densify_adjacency, trim_padding
+
+class TestBatchTensorizer(unittest.TestCase):
+    def test_pad_ragged(self):
+        values = [[[1, 2, 3], [4, 5, 6]], [], np.array([[7, 8, 9]], dtype=np.int16), [[1, 1, 1], [2, 2, 2], [3, 3, 3]]]
+        padded, mask = BatchTensorizer.pad_ragged(values)
+        self.assertEqual(padded.shape, (4, 3, 3))
+        self.assertEqual(padded.dtype, torch.int64)
+        self.assertEqual(mask.tolist(), [[True, True, False], [False, False, False], [True, False, False], [True, True, True]])
+        for row, value in zip(padded, values):
+            value = np.asarray(value).reshape(-1, 3)
+            self.assertEqual(row[:len(value)].tolist(), value.tolist())
+            self.assertTrue(row[len(value):].eq(0).all())
+
+    def test_pad_ragged_flat(self):
+        padded, mask = BatchTensorizer.pad_ragged([[5, 6], [7], []])
+        self.assertEqual(padded.tolist(), [[5, 6], [7, 0], [0, 0]])
+        self.assertEqual(mask.sum(1).tolist(), [2, 1, 0])
+
+    def test_pad_ragged_empty(self):
+        padded, mask = BatchTensorizer.pad_ragged([[], []])
+        self.assertEqual(padded.shape, (2, 0))
+        self.assertEqual(mask.shape, (2, 0))
+
+    def test_ragged_fields(self):
+        features = [{'kg_input_ids':np.array([2, 5, 0]), 'rc_indeces':[[1, 2, 3]]}, {'kg_input_ids':np.array([2, 0, 0]), 'rc_indeces':[[0, 1, 4], [1, 0, 4]]}]
+        batch = BatchTensorizer(ragged=('rc_indeces',), kg_pad_id=0)(features)
+        self.assertEqual(batch['rc_indeces'].shape, (2, 2, 3))
+        self.assertEqual(batch['rc_indeces_mask'].tolist(), [[True, False], [True, True]])
+        self.assertEqual(batch['kg_padding_mask'].tolist(), [[True, True, False], [True, False, False]])
+
+class TestPadding(unittest.TestCase):
+    def setUp(self):
+        # Texts of 3 and 5 tokens and graphs of 2 and 4 nodes, padded to 8 and 6
+        self.features = [
+            {'kg_input_ids':np.array([2, 7, 0, 0, 0, 0]), 'kg_adjacency':np.array([[0, 0], [0, 1], [1, 1], [1, 0]])},
+            {'kg_input_ids':np.array([2, 8, 9, 10, 0, 0]), 'kg_adjacency':np.array([[0, 0], [1, 1], [2, 3], [3, 2], [3, 3]])},
+        ]
+        self.batch = {
+            'lang_input_ids':torch.tensor([[2, 5, 3, 0, 0, 0, 0, 0], [2, 5, 6, 7, 3, 0, 0, 0]]),
+            'lang_attention_mask':torch.tensor([[1, 1, 1, 0, 0, 0, 0, 0], [1, 1, 1, 1, 1, 0, 0, 0]]),
+            'token_type_ids':torch.zeros(2, 8, dtype=torch.long),
+            'kg_input_ids':torch.from_numpy(np.stack([f['kg_input_ids'] for f in self.features])),
+        }
+
+    def test_trim_padding(self):
+        batch = trim_padding(dict(self.batch), kg_pad_id=0)
+        self.assertEqual(batch['lang_input_ids'].shape, (2, 5))
+        self.assertEqual(batch['lang_attention_mask'].shape, (2, 5))
+        self.assertEqual(batch['token_type_ids'].shape, (2, 5))
+        self.assertEqual(batch['kg_input_ids'].shape, (2, 4))
+        self.assertTrue(torch.equal(batch['lang_input_ids'], self.batch['lang_input_ids'][:, :5]))
+        self.assertTrue(torch.equal(batch['kg_input_ids'], self.batch['kg_input_ids'][:, :4]))
+
+    def test_batch_edges(self):
+        sample_idx, edges = batch_edges(self.batch, self.features)
+        self.assertEqual(sample_idx.tolist(), [0] * 4 + [1] * 5)
+        self.assertEqual(edges.tolist(), [[0, 0], [0, 1], [1, 1], [1, 0], [0, 0], [1, 1], [2, 3], [3, 2], [3, 3]])
+        # Edges of the nodes cut by trimming are dropped
+        trimmed = trim_padding(dict(self.batch, kg_input_ids=self.batch['kg_input_ids'][:1]), kg_pad_id=0)
+        sample_idx, edges = batch_edges(trimmed, self.features[:1])
+        self.assertEqual(edges.tolist(), [[0, 0], [0, 1], [1, 1], [1, 0]])
+
+    def test_sparse_matches_dense(self):
+        batch = trim_padding(dict(self.batch), kg_pad_id=0)
+        dense = densify_adjacency(dict(batch), self.features)['kg_attention_mask']
+        edge_index = adjacency_edge_index(dict(batch), self.features)['kg_edge_index']
+        self.assertEqual(dense.shape, (2, 4, 4))
+        rebuilt = torch.zeros_like(dense)
+        rebuilt[edge_index[:, 0], edge_index[:, 1], edge_index[:, 2]] = 1
+        self.assertTrue(torch.equal(dense, rebuilt))
+
+    def test_repeated_samples(self):
+        # Negative sampling repeats the samples of the batch
+        batch = dict(self.batch, kg_input_ids=self.batch['kg_input_ids'].repeat(2, 1))
+        dense = densify_adjacency(dict(batch), self.features)['kg_attention_mask']
+        edge_index = adjacency_edge_index(dict(batch), self.features)['kg_edge_index']
+        self.assertTrue(torch.equal(dense[:2], dense[2:]))
+        self.assertEqual(sorted(edge_index[:, 0].unique().tolist()), [0, 1, 2, 3])
+
+class TestBatchRNG(unittest.TestCase):
+    """
+    The generator of a batch only depends on its index in the epoch, whichever DataLoader worker collates it.
+    """
+    def draws(self, rng, num_batches, num_workers):
+        # DataLoader hands out batches to its workers in turn, each one collating with its own copy of the collator
+        workers = [copy.deepcopy(rng) for _ in range(num_workers)]
+        draws = list()
+        for batch_index in range(num_batches):
+            worker_id = batch_index % num_workers
+            worker_info = types.SimpleNamespace(id=worker_id, num_workers=num_workers) if num_workers > 1 else None
+            with mock.patch('utils.data_collator.get_worker_info', return_value=worker_info):
+                draws.append(torch.rand(4, generator=workers[worker_id].generator()))
+        return draws
+
+    def assertDrawsEqual(self, draws, expected):
+        self.assertEqual(len(draws), len(expected))
+        for draw, expected_draw in zip(draws, expected):
+            self.assertTrue(torch.equal(draw, expected_draw))
+
+    def test_worker_counts(self):
+        expected = self.draws(BatchRNG(seed=7), 12, num_workers=1)
+        for num_workers in (2, 3, 5):
+            with self.subTest(num_workers=num_workers):
+                self.assertDrawsEqual(self.draws(BatchRNG(seed=7), 12, num_workers), expected)
+        self.assertFalse(torch.equal(expected[0], expected[1]))
+
+    def test_epochs(self):
+        rng = BatchRNG(seed=7)
+        first = self.draws(rng, 4, num_workers=1)
+        rng.set_epoch(1)
+        second = self.draws(rng, 4, num_workers=1)
+        self.assertFalse(any(torch.equal(a, b) for a, b in zip(first, second)))
+        rng.set_epoch(0)
+        self.assertDrawsEqual(self.draws(rng, 4, num_workers=1), first)
+
+    def test_resume(self):
+        rng = BatchRNG(seed=7)
+        rng.set_epoch(2)
+        expected = self.draws(rng, 10, num_workers=1)
+        for num_workers in (1, 2):
+            with self.subTest(num_workers=num_workers):
+                resumed = BatchRNG(seed=7)
+                resumed.resume(epoch=2, batches_consumed=4)
+                self.assertDrawsEqual(self.draws(resumed, 6, num_workers), expected[4:])
+
+if __name__ == '__main__':
+    unittest.main()
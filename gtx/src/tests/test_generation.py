@@ -0,0 +1,127 @@
+import unittest
+from unittest import mock
+
+import torch
+
+from synthetic import features, generation_batch, generation_model, tokenizer
+
+class TestTeacherForcedPerplexity(unittest.TestCase):
+    """
+    ``decode_for_ppl`` scores every position in a single pass when the model supports it, with the perplexities of
+    the loop over the positions.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.features = features(6)
+
+    def perplexities(self, model, batch, single_pass):
+        with torch.no_grad():
+            return model.decode_for_ppl(**batch, single_pass=single_pass)[0]
+
+    def test_single_pass(self):
+        model = generation_model()
+        for sparse_adjacency in (False, True):
+            batches = [generation_batch(self.features, sparse_adjacency)] + [generation_batch([f], sparse_adjacency) for f in self.features[:3]]
+            for batch in batches:
+                with self.subTest(sparse_adjacency=sparse_adjacency, batch_size=len(batch['lang_input_ids'])):
+                    with mock.patch.object(model, '_teacher_forced_nll', wraps=model._teacher_forced_nll) as single_pass:
+                        ppl = self.perplexities(model, batch, single_pass=True)
+                    single_pass.assert_called_once()
+                    self.assertTrue(torch.allclose(ppl, self.perplexities(model, batch, single_pass=False), rtol=1e-4))
+
+    def test_fallback(self):
+        batch = generation_batch(self.features)
+        # Non-unilm generation models use `single` cross layers, `cross` ones take no causal text mask
+        for config in ({'encoder_type':{'lang':'lstm'}}, {'cross_att_type':'single'}):
+            with self.subTest(**config):
+                model = generation_model(**config)
+                self.assertFalse(model.GTX.supports_decoding_cache())
+                with mock.patch.object(model, '_teacher_forced_nll', wraps=model._teacher_forced_nll) as single_pass:
+                    ppl = self.perplexities(model, batch, single_pass=True)
+                single_pass.assert_not_called()
+                self.assertTrue(torch.isfinite(ppl))
+
+class TestDecodingCache(unittest.TestCase):
+    """
+    Greedy decoding from the cached keys / values of the graph and of the decoded prefix gives the ids of the full
+    forward pass of every step.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.features = features(6)
+
+    def greedy(self, model, batch, use_cache):
+        # Rx texts (a single db) are sampled from, with the same draws either way
+        torch.manual_seed(0)
+        with mock.patch.object(model.GTX, 'decode_step', wraps=model.GTX.decode_step) as decode_step, torch.no_grad():
+            output_ids = model.decode(**batch, use_cache=use_cache, clean_outputs=False)[0]
+        self.assertEqual(decode_step.called, use_cache)
+        return output_ids
+
+    def test_cache(self):
+        for attention_backend in ('eager', 'sdpa', 'chunked'):
+            model = generation_model(attention_backend=attention_backend, attention_chunk_size=4)
+            self.assertTrue(model.GTX.supports_decoding_cache())
+            for num_db in (1, 2):
+                for sparse_adjacency in (False, True):
+                    with self.subTest(attention_backend=attention_backend, num_db=num_db, sparse_adjacency=sparse_adjacency):
+                        batch = generation_batch(self.features, sparse_adjacency, num_db)
+                        self.assertTrue(torch.equal(self.greedy(model, batch, use_cache=True), self.greedy(model, batch, use_cache=False)))
+
+class TestBeamSearch(unittest.TestCase):
+    """
+    The beam search of a batch decodes every sample as if it were alone, with and without the decoding cache, and
+    returns the best hypothesis of each sample with its score.
+    """
+    BEAM_SIZE = 3
+
+    @classmethod
+    def setUpClass(cls):
+        cls.features = features(6)
+        cls.model = generation_model()
+        # Hypotheses end (with their last [SEP]) before the maximum length of the batch, which would end them
+        cls.sep_token_id = tokenizer().sep_token_id
+        with torch.no_grad():
+            cls.model.lm_head.predictions.bias[cls.sep_token_id] += 4.0
+
+    def beam_search(self, batch, use_cache=True):
+        with torch.no_grad():
+            output_ids, _, _, scores = self.model.decode(**batch, search_beam_size=self.BEAM_SIZE, output_scores=True, use_cache=use_cache, clean_outputs=False)
+        return output_ids, scores
+
+    def test_batched(self):
+        for num_db in (1, 2):
+            for sparse_adjacency in (False, True):
+                with self.subTest(num_db=num_db, sparse_adjacency=sparse_adjacency):
+                    output_ids, scores = self.beam_search(generation_batch(self.features, sparse_adjacency, num_db))
+                    self.assertTrue(output_ids.eq(self.sep_token_id).sum(1).ge(num_db).all())
+                    for i, feature in enumerate(self.features):
+                        sample_ids, sample_scores = self.beam_search(generation_batch([feature], sparse_adjacency, num_db))
+                        length = sample_ids.size(1)
+                        self.assertTrue(torch.equal(output_ids[i, :length], sample_ids[0]))
+                        self.assertTrue(output_ids[i, length:].eq(self.model.pad_token_id).all())
+                        self.assertTrue(torch.allclose(scores[i], sample_scores[0], atol=1e-5))
+
+    def test_cache(self):
+        for num_db in (1, 2):
+            with self.subTest(num_db=num_db):
+                batch = generation_batch(self.features, num_db=num_db)
+                output_ids, scores = self.beam_search(batch, use_cache=True)
+                uncached_ids, uncached_scores = self.beam_search(batch, use_cache=False)
+                self.assertTrue(torch.equal(output_ids, uncached_ids))
+                self.assertTrue(torch.allclose(scores, uncached_scores, atol=1e-5))
+
+    def test_output_scores(self):
+        batch = generation_batch(self.features)
+        with torch.no_grad():
+            outputs = self.model.decode(**batch, search_beam_size=self.BEAM_SIZE, output_scores=True)
+            self.assertEqual(len(outputs), 4)
+            self.assertEqual(len(outputs[0]), len(self.features))
+            self.assertEqual(outputs[3].shape, (len(self.features),))
+            self.assertTrue((outputs[3] <= 0).all())
+            self.assertEqual(len(self.model.decode(**batch, search_beam_size=self.BEAM_SIZE)), 3)
+            # Greedy decoding has no scores
+            self.assertIsNone(self.model.decode(**batch, output_scores=True)[3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from utils.samplers import LengthGroupedBatchSampler, MegaBatchSampler, TokenBudgetBatchSampler, trailing_lengths
+
+def random_lengths(num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.integers(4, 128, num_samples), rng.integers(2, 64, num_samples)], axis=1)
+
+def rank_batches(sampler, world_size):
+    batches = list()
+    for rank in range(world_size):
+        with mock.patch('utils.samplers.distributed_rank', return_value=(rank, world_size)):
+            batches.append([batch.tolist() for batch in sampler.rank_batches()])
+    return batches
+
+class TestLengths(unittest.TestCase):
+    def test_trailing_lengths(self):
+        values = np.array([[[1, 0], [2, 0], [0, 0]], [[0, 0], [0, 3], [0, 0]], [[0, 0], [0, 0], [0, 0]]])
+        self.assertEqual(trailing_lengths(values).tolist(), [2, 2, 0])
+        self.assertEqual(trailing_lengths(values, chunk_size=1).tolist(), [2, 2, 0])
+
+class TestMegaBatchSampler(unittest.TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            MegaBatchSampler(random_lengths(10))
+
+    def test_length_grouped(self):
+        lengths = random_lengths(203)
+        sampler = LengthGroupedBatchSampler(lengths, batch_size=8, mega_batch_mult=4)
+        batches = sampler.batches()
+        self.assertEqual(sorted(i for batch in batches for i in batch.tolist()), list(range(203)))
+        self.assertEqual(sum(len(batch) != 8 for batch in batches), 1)
+        # Sorting larger mega-batches leaves less padding
+        self.assertLess(sampler.padding_ratio(), LengthGroupedBatchSampler(lengths, batch_size=8, mega_batch_mult=1).padding_ratio())
+        dropped = LengthGroupedBatchSampler(lengths, batch_size=8, drop_last=True, mega_batch_mult=4).batches()
+        self.assertTrue(all(len(batch) == 8 for batch in dropped))
+
+    def test_epochs(self):
+        sampler = LengthGroupedBatchSampler(random_lengths(100), batch_size=4, mega_batch_mult=5, seed=1)
+        first = [batch.tolist() for batch in sampler.batches()]
+        self.assertEqual(first, [batch.tolist() for batch in sampler.batches()])
+        sampler.set_epoch(1)
+        self.assertNotEqual(first, [batch.tolist() for batch in sampler.batches()])
+
+    def test_rank_batches_train(self):
+        sampler = LengthGroupedBatchSampler(random_lengths(203), batch_size=8, mega_batch_mult=4)
+        all_batches = [batch.tolist() for batch in sampler.batches()]
+        for world_size in (2, 3, 4):
+            with self.subTest(world_size=world_size):
+                batches = rank_batches(sampler, world_size)
+                # Every rank runs the same number of steps over its own batches, the leftover ones are dropped
+                self.assertEqual({len(b) for b in batches}, {len(all_batches) // world_size})
+                kept = [batch for b in batches for batch in b]
+                self.assertEqual(sorted(kept), sorted(all_batches[:len(all_batches) // world_size * world_size]))
+
+    def test_rank_batches_eval(self):
+        sampler = LengthGroupedBatchSampler(random_lengths(203), batch_size=8, shuffle=False)
+        for world_size in (2, 3, 4):
+            with self.subTest(world_size=world_size):
+                batches = rank_batches(sampler, world_size)
+                # No sample is left out, the last round is completed by repeating the first batches
+                self.assertEqual(len({len(b) for b in batches}), 1)
+                self.assertEqual({i for b in batches for batch in b for i in batch}, set(range(203)))
+                with mock.patch('utils.samplers.distributed_rank', return_value=(0, world_size)):
+                    self.assertEqual(len(sampler), len(batches[0]))
+
+    def test_rank_batches_few(self):
+        # Fewer batches than ranks in evaluation
+        sampler = LengthGroupedBatchSampler(random_lengths(5), batch_size=4, shuffle=False)
+        batches = rank_batches(sampler, 4)
+        self.assertEqual([len(b) for b in batches], [1, 1, 1, 1])
+        self.assertEqual({i for b in batches for batch in b for i in batch}, set(range(5)))
+
+class TestTokenBudgetBatchSampler(unittest.TestCase):
+    def test_split(self):
+        lengths = random_lengths(300)
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=1024, mega_batch_size=100)
+        indices = sampler.sort(np.arange(100))
+        batches = sampler.split(indices)
+        self.assertEqual(np.concatenate(batches).tolist(), indices.tolist())
+        for batch, next_batch in zip(batches, batches[1:] + [None]):
+            self.assertLessEqual(sampler.padded_size(batch), 1024)
+            # Batches are closed by the first sample which would take them over the budget
+            if next_batch is not None:
+                self.assertGreater(sampler.padded_size(np.append(batch, next_batch[0])), 1024)
+
+    def test_oversized(self):
+        lengths = np.array([[10, 5], [300, 100], [12, 4], [8, 8]])
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=64, shuffle=False)
+        batches = [batch.tolist() for batch in sampler.batches()]
+        self.assertIn([1], batches)
+        self.assertEqual(sorted(i for batch in batches for i in batch), [0, 1, 2, 3])
+
+    def test_budget_grows_batches(self):
+        lengths = np.concatenate([np.full((50, 2), 4), np.full((50, 2), 60)])
+        batches = TokenBudgetBatchSampler(lengths, max_tokens=960, shuffle=False).batches()
+        # The 50 short samples (8 positions) fit in one batch, the long ones (120 positions) by 8
+        self.assertEqual([len(batch) for batch in batches], [50] + [8] * 6 + [2])
+
+if __name__ == '__main__':
+    unittest.main()
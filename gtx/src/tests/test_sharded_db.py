@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from synthetic import make_db, save_db
+from utils.dataset import load_db
+from utils.sharded_db import EDGES_SUFFIX, ShardedDB, convert_db
+
+class TestConvertDB(unittest.TestCase):
+    """
+    A db converted into shards reads back the samples of the pickled one, whatever the shard size.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.file_path = os.path.join(cls.tmp_dir.name, 'train')
+        cls.db = make_db(23)
+        # Fields ragged beyond their first axis and scalars
+        cls.db['nested'] = [[[i], [i, i]] for i in range(23)]
+        cls.db['score'] = [float(i) / 2 for i in range(23)]
+        cls.db_path = save_db(cls.file_path, cls.db)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def assertValueEqual(self, value, expected, kind, msg=None):
+        if kind == 'json':
+            self.assertEqual(value, expected, msg)
+        else:
+            self.assertTrue(np.array_equal(value, np.asarray(expected)), msg)
+
+    def test_round_trip(self):
+        for shard_size in (1, 5, 23, 100):
+            with self.subTest(shard_size=shard_size):
+                output_dir = convert_db(self.db_path, os.path.join(self.tmp_dir.name, f'shards_{shard_size}'), shard_size=shard_size)
+                db = ShardedDB(output_dir)
+                self.assertEqual(len(db), 23)
+                self.assertEqual(db.num_shards, -(-23 // shard_size))
+                self.assertEqual(sorted(db.keys()), sorted(self.db))
+                self.assertEqual(db.index['fields']['mask'], 'adjacency')
+                self.assertEqual(db.index['fields']['nested'], 'json')
+                for i in (0, 7, 22):
+                    sample = db[i]
+                    for k, values in self.db.items():
+                        self.assertValueEqual(sample[k], values[i], db.index['fields'][k], (k, i))
+                for k, values in self.db.items():
+                    field = db.field(k)
+                    self.assertValueEqual(field[-1], values[-1], db.index['fields'][k], k)
+                    self.assertEqual(len(list(field)), 23)
+
+    def test_edges(self):
+        db = ShardedDB(convert_db(self.db_path, os.path.join(self.tmp_dir.name, 'shards_edges'), shard_size=4))
+        fields = db.as_dict(edges=True)
+        self.assertIn('mask' + EDGES_SUFFIX, fields)
+        self.assertNotIn('mask', fields)
+        for i, mask in enumerate(self.db['mask']):
+            edges = np.asarray(fields['mask' + EDGES_SUFFIX][i]).reshape(-1, 2)
+            dense = np.zeros_like(np.asarray(mask))
+            dense[edges[:, 0], edges[:, 1]] = 1
+            self.assertTrue(np.array_equal(dense, np.asarray(mask)), i)
+            sample = db.sample(*db.locate(i), fields=['mask'], edges=True)
+            self.assertTrue(np.array_equal(sample['mask' + EDGES_SUFFIX], edges))
+
+    def test_load_db(self):
+        # Splits with a converted db are read from its shards, with the adjacency masks as edge lists
+        file_path = os.path.join(self.tmp_dir.name, 'load')
+        db_path = save_db(file_path, self.db)
+        convert_db(db_path, shard_size=8)
+        db = load_db(file_path)
+        self.assertEqual(set(db), (set(self.db) - {'mask'}) | {'mask' + EDGES_SUFFIX})
+        self.assertEqual(db['text'][3], self.db['text'][3])
+        self.assertTrue(np.array_equal(np.asarray(db['input'][12]), np.asarray(self.db['input'][12])))
+
+    def test_overwrite(self):
+        output_dir = os.path.join(self.tmp_dir.name, 'shards_overwrite')
+        convert_db(self.db_path, output_dir, shard_size=10)
+        convert_db(self.db_path, output_dir, shard_size=5)
+        self.assertEqual(ShardedDB(output_dir).num_shards, 3)
+        convert_db(self.db_path, output_dir, shard_size=5, overwrite=True)
+        self.assertEqual(ShardedDB(output_dir).num_shards, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+from torch.utils.data import DataLoader
+
+from synthetic import KG_SIZE, KG_SPECIAL_TOKEN_IDS, TOKEN_TYPE_VOCAB, make_db, save_db, tokenizer
+from utils.data_collator import NodeClassification_DataCollator
+from utils.dataset import StreamingDataset
+from utils.sharded_db import convert_db
+
+BATCH_SIZE = 4
+
+class TestStreamingResume(unittest.TestCase):
+    """
+    An epoch resumed from ``StreamingDataset.state_dict`` (as restored by ``DataModule.on_load_checkpoint``) yields
+    the batches the uninterrupted epoch had left.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.file_path = os.path.join(cls.tmp_dir.name, 'dx,prx_64', 'train')
+        convert_db(save_db(cls.file_path, make_db(61)), shard_size=8)
+        cls.tokenizer = tokenizer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def build(self, epoch):
+        dataset = StreamingDataset(self.tokenizer, [self.file_path], block_size=32, token_type_vocab=TOKEN_TYPE_VOCAB, gcn=True, shuffle_buffer_size=8, seed=3)
+        collator = NodeClassification_DataCollator(self.tokenizer, KG_SPECIAL_TOKEN_IDS, kg_size=KG_SIZE, dynamic_padding=True, seed=3)
+        dataset.set_epoch(epoch)
+        collator.rng.set_epoch(epoch)
+        return dataset, collator
+
+    def batches(self, dataset, collator, num_workers):
+        return list(DataLoader(dataset, batch_size=BATCH_SIZE, collate_fn=collator, num_workers=num_workers))
+
+    def assertBatchesEqual(self, batches, expected):
+        self.assertEqual(len(batches), len(expected))
+        for batch, expected_batch in zip(batches, expected):
+            self.assertEqual(batch.keys(), expected_batch.keys())
+            for k in batch:
+                self.assertTrue(torch.equal(batch[k], expected_batch[k]), k)
+
+    def check_resume(self, num_workers, batches_consumed, epoch=1):
+        dataset, collator = self.build(epoch)
+        uninterrupted = self.batches(dataset, collator, num_workers)
+        state = dataset.state_dict(batches_consumed, BATCH_SIZE)
+
+        dataset, collator = self.build(0)
+        dataset.load_state_dict(state)
+        collator.rng.resume(state['epoch'], state['batches_consumed'])
+        self.assertEqual(len(dataset), sum(len(batch['kg_input_ids']) for batch in uninterrupted[batches_consumed:]))
+        self.assertBatchesEqual(self.batches(dataset, collator, num_workers), uninterrupted[batches_consumed:])
+
+    def test_resume(self):
+        for batches_consumed in (0, 1, 5, 15):
+            with self.subTest(batches_consumed=batches_consumed):
+                self.check_resume(num_workers=0, batches_consumed=batches_consumed)
+
+    def test_resume_workers(self):
+        # DataLoader starts over from its first worker, which is where the uninterrupted epoch stood
+        self.check_resume(num_workers=2, batches_consumed=4)
+
+    def test_resume_rank(self):
+        with mock.patch.object(StreamingDataset, '_rank', return_value=(1, 2)):
+            self.check_resume(num_workers=0, batches_consumed=3)
+
+    def test_epoch_order(self):
+        dataset, _ = self.build(0)
+        first = [sample['kg_input_ids'][1] for sample in dataset]
+        dataset.set_epoch(1)
+        second = [sample['kg_input_ids'][1] for sample in dataset]
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(first), list(range(3, 3 + 61)))
+        self.assertEqual(sorted(second), sorted(first))
+
+if __name__ == '__main__':
+    unittest.main()
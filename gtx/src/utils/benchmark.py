@@ -0,0 +1,421 @@
+import time
+import argparse
+from typing import Callable, Dict, List, Union
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from transformers import AutoConfig, AutoTokenizer
+
+from .dataset import Featurizer, HeadOnlyDataset, ext_max_len_of, featurize, iter_samples, load_db
+from .data_collator import NodeClassification_DataCollator, UniLM_DataCollator, special_tokens_lookup
+from .samplers import LengthGroupedBatchSampler
+from .prefetch import PrefetchDataLoader, PrefetchMetrics
+from model import ATTENTION_BACKENDS, GTXAttention, GTXForGeneration, GTXForKGTokPredAndMaskedLM, GTXLayer
+
+from utils.notifier import logging, log_formatter
+notifier = logging.getLogger(__name__)
+notifier.addHandler(log_formatter())
+
+"""
+Benchmarks of the data pipeline
+
+    python -m utils.benchmark featurize --data data/dx,prx_2000/train --tokenizer <tokenizer dir> --knowmix init,summary
+    python -m utils.benchmark padding --data data/dx,prx_2000/train --tokenizer <tokenizer dir> --config <model config dir>
+    python -m utils.benchmark collate --data data/dx,prx_2000/train --tokenizer <tokenizer dir>
+    python -m utils.benchmark attention --config <model config dir>
+    python -m utils.benchmark message_passing --config <model config dir>
+    python -m utils.benchmark decode --data data/dx,prx_2000/test --tokenizer <tokenizer dir> --config <model config dir> --sections dx,prx
+    python -m utils.benchmark beam --data data/dx,prx_2000/test --tokenizer <tokenizer dir> --config <model config dir> --sections dx,prx
+    python -m utils.benchmark ppl --data data/dx,prx_2000/test --tokenizer <tokenizer dir> --config <model config dir> --sections dx,prx
+    python -m utils.benchmark prefetch --data data/dx,prx_2000/train --tokenizer <tokenizer dir> --config <model config dir>
+"""
+def best_time(fn: Callable, repeat: int = 3):
+    """
+    Best wall time of `repeat` runs of `fn`, in seconds.
+    """
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def report(title: str, timings: Dict[str, float], unit_count: Union[int, Dict[str, int]], unit: str):
+    """
+    Logs the throughput of each run, relative to the first one. ``unit_count`` is given per run if runs do not
+    process the same amount of work.
+    """
+    unit_counts = unit_count if isinstance(unit_count, dict) else {name:unit_count for name in timings}
+    throughputs = {name:unit_counts[name]/seconds for name, seconds in timings.items()}
+    baseline = next(iter(throughputs.values()))
+    notifier.warning(title)
+    for name, seconds in timings.items():
+        notifier.warning(f"  {name:<24} {seconds:8.3f} s  {throughputs[name]:10.1f} {unit}/s  x{throughputs[name]/baseline:.2f}")
+
+def bench_featurize(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    token_type_vocab = {k:idx for idx, k in enumerate(args.sections.split(","))} if args.sections else None
+    featurizer = Featurizer(tokenizer, args.block_size, token_type_vocab, args.knowmix, True, ext_max_len_of(args.data))
+    db = load_db(args.data)
+    db = {k:db[k] for k in featurizer.required_fields(db)}
+    samples = list(iter_samples(db))[:args.num_samples]
+
+    timings = {"per-sample": best_time(lambda: [featurizer(sample) for sample in samples], args.repeat)}
+    for batch_size in args.batch_sizes:
+        timings[f"batched ({batch_size})"] = best_time(lambda: list(featurize(featurizer, samples, batch_size=batch_size)), args.repeat)
+    for num_proc in args.num_procs:
+        timings[f"batched ({args.batch_sizes[-1]}) x{num_proc} proc"] = best_time(lambda: list(featurize(featurizer, samples, batch_size=args.batch_sizes[-1], num_proc=num_proc)), args.repeat)
+    report(f"Featurization of {len(samples)} samples (knowmix={args.knowmix!r})", timings, len(samples), "samples")
+
+def bench_padding(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    token_type_vocab = {k:idx for idx, k in enumerate(args.sections.split(","))} if args.sections else None
+    dataset = HeadOnlyDataset(tokenizer, args.data, args.block_size, token_type_vocab, args.knowmix, gcn=True)
+    config = AutoConfig.from_pretrained(args.config)
+    config.KnowMix = args.knowmix
+    config.use_ce_pooler = True
+    if args.lang_model:
+        config.pretrained_lang_model = {'model_name': args.lang_model, 'use_weight': False}
+    model = GTXForKGTokPredAndMaskedLM(config)
+    kg_special_token_ids = config.kg_special_token_ids
+
+    lengths = dataset.lengths(kg_special_token_ids['PAD'])
+    order = np.random.default_rng(args.seed).permutation(len(dataset))
+    random_batches = [order[i:i+args.batch_size] for i in range(0, len(order), args.batch_size)][:args.num_batches]
+    grouped_batches = LengthGroupedBatchSampler(lengths, args.batch_size, mega_batch_mult=args.mega_batch_mult, seed=args.seed).batches()[:args.num_batches]
+
+    def train_steps(batches, dynamic_padding):
+        collator = NodeClassification_DataCollator(tokenizer, kg_special_token_ids, config.vocab_size['kg'], dynamic_padding=dynamic_padding)
+        for batch in batches:
+            outputs = model(**collator([dataset[int(i)] for i in batch]))
+            outputs.loss.backward()
+            model.zero_grad()
+
+    runs = {
+        "fixed padding": (random_batches, False),
+        "dynamic padding": (random_batches, True),
+        "grouped + dynamic": (grouped_batches, True),
+    }
+    timings, tokens = dict(), dict()
+    for name, (batches, dynamic_padding) in runs.items():
+        # Text tokens and graph nodes actually fed (padding excluded)
+        tokens[name] = int(sum(lengths[batch][:, :2].sum() for batch in batches))
+        train_steps(batches[:1], dynamic_padding)
+        timings[name] = best_time(lambda: train_steps(batches, dynamic_padding), args.repeat)
+    report(f"Training steps on {args.num_batches} batches of {args.batch_size} (knowmix={args.knowmix!r}, block_size={args.block_size})", timings, tokens, "tokens")
+
+def bench_collate(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    token_type_vocab = {k:idx for idx, k in enumerate(args.sections.split(","))} if args.sections else None
+    dataset = HeadOnlyDataset(tokenizer, args.data, args.block_size, token_type_vocab, args.knowmix, gcn=True)
+    kg_special_token_ids = {"PAD":0,"MASK":1,"CLS":2}
+    kg_size = int(dataset.features.columns['kg_input_ids'].values.max()) + 1
+    batches = [[dataset[(start+i) % len(dataset)] for i in range(args.batch_size)] for start in range(0, args.num_batches*args.batch_size, args.batch_size)]
+    input_ids = [NodeClassification_DataCollator(tokenizer, kg_special_token_ids, kg_size)._tensorize_batch(batch)['lang_input_ids'] for batch in batches]
+
+    # Special token masks of the text inputs, as built before and after the lookup table
+    def rowwise():
+        for ids in input_ids:
+            torch.tensor([tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in ids.tolist()], dtype=torch.bool)
+    def lookup():
+        for ids in input_ids:
+            special_tokens_lookup(tokenizer)[ids]
+    for ids in input_ids:
+        expected = torch.tensor([tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in ids.tolist()], dtype=torch.bool)
+        assert torch.equal(expected, special_tokens_lookup(tokenizer)[ids]), "Special token lookup differs from the tokenizer"
+    timings = {
+        "special tokens (rows)": best_time(rowwise, args.repeat),
+        "special tokens (lookup)": best_time(lookup, args.repeat),
+    }
+    report(f"Special token masks of {args.num_batches} batches of {args.batch_size}x{args.block_size}", timings, args.num_batches*args.batch_size, "samples")
+
+    collators = {
+        "NodeClassification": NodeClassification_DataCollator(tokenizer, kg_special_token_ids, kg_size),
+        "UniLM": UniLM_DataCollator(tokenizer, kg_special_token_ids),
+    }
+    timings = {name:best_time(lambda: [collator(batch) for batch in batches], args.repeat) for name, collator in collators.items()}
+    report(f"Collation of {args.num_batches} batches of {args.batch_size}x{args.block_size} (knowmix={args.knowmix!r})", timings, args.num_batches*args.batch_size, "samples")
+
+def bench_prefetch(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    token_type_vocab = {k:idx for idx, k in enumerate(args.sections.split(","))} if args.sections else None
+    dataset = HeadOnlyDataset(tokenizer, args.data, args.block_size, token_type_vocab, args.knowmix, gcn=True)
+    config = AutoConfig.from_pretrained(args.config)
+    config.KnowMix = args.knowmix
+    config.use_ce_pooler = True
+    if args.lang_model:
+        config.pretrained_lang_model = {'model_name': args.lang_model, 'use_weight': False}
+    model = GTXForKGTokPredAndMaskedLM(config)
+    collator = NodeClassification_DataCollator(tokenizer, config.kg_special_token_ids, config.vocab_size['kg'], dynamic_padding=True)
+    subset = torch.utils.data.Subset(dataset, range(min(len(dataset), args.num_batches*args.batch_size)))
+
+    def train_steps(loader):
+        for batch in loader:
+            outputs = model(**batch)
+            outputs.loss.backward()
+            model.zero_grad()
+
+    timings, metrics = dict(), dict()
+    train_steps(DataLoader(subset, batch_size=args.batch_size, collate_fn=collator))
+    timings["in the training loop"] = best_time(lambda: train_steps(DataLoader(subset, batch_size=args.batch_size, collate_fn=collator)), args.repeat)
+    for prefetch_batches in args.prefetch_batches:
+        metrics[prefetch_batches] = PrefetchMetrics()
+        loader = PrefetchDataLoader(subset, batch_size=args.batch_size, collate_fn=collator, prefetch_batches=prefetch_batches, metrics=metrics[prefetch_batches])
+        timings[f"prefetch ({prefetch_batches})"] = best_time(lambda: (metrics[prefetch_batches].reset(), train_steps(loader)), args.repeat)
+    report(f"Training steps on {args.num_batches} batches of {args.batch_size} collated in the main process", timings, args.num_batches*args.batch_size, "samples")
+    for prefetch_batches, counters in metrics.items():
+        summary = counters.summary()
+        notifier.warning(f"  prefetch ({prefetch_batches}): {summary['prefetch_queue_depth']:.2f} batches ready, {summary['prefetch_empty_ratio']:.0%} of steps waited {summary['data_wait_ms']:.1f} ms on average")
+
+def bench_attention(args):
+    config = AutoConfig.from_pretrained(args.config)
+    hidden_states = {length:torch.randn(args.batch_size, length, config.hidden_size) for length in args.lengths}
+    # Additive padding masks hiding the last quarter of every sequence
+    masks = {length:torch.where(torch.arange(length) < length - length//4, 0.0, -10000.0).expand(args.batch_size, 1, 1, length) for length in args.lengths}
+    layers = dict()
+    for backend in ATTENTION_BACKENDS:
+        config.attention_backend = backend
+        config.attention_chunk_size = args.chunk_size
+        torch.manual_seed(args.seed)
+        layers[backend] = GTXAttention(config).eval()
+
+    for length in args.lengths:
+        x, mask = hidden_states[length], masks[length]
+        def forward(layer):
+            with torch.no_grad():
+                return layer(x, x, mask)[0]
+        def backward(layer):
+            layer(x.requires_grad_(), x, mask)[0].sum().backward()
+        expected = forward(layers['eager'])
+        timings = dict()
+        for backend, layer in layers.items():
+            assert torch.allclose(expected, forward(layer), atol=1e-5), f"{backend} attention differs from eager"
+            timings[f"{backend} forward"] = best_time(lambda: forward(layer), args.repeat)
+        for backend, layer in layers.items():
+            timings[f"{backend} forward+backward"] = best_time(lambda: backward(layer), args.repeat)
+        report(f"Self-attention over {args.batch_size}x{length} (H={config.hidden_size}, heads={config.num_attention_heads}, eager scores {args.batch_size*config.num_attention_heads*length*length*4/2**20:.0f} MiB)", timings, args.batch_size, "samples")
+
+def bench_message_passing(args):
+    config = AutoConfig.from_pretrained(args.config)
+    generator = torch.Generator().manual_seed(args.seed)
+    num_real = args.num_nodes - args.num_nodes//4
+    # Graphs of `num_real` nodes (the rest is padding), each with a self-loop and `degree` random incoming edges
+    sources = torch.randint(num_real, (args.batch_size, num_real, args.degree), generator=generator)
+    sources = torch.cat([torch.arange(num_real)[:, None].expand(args.batch_size, num_real, 1), sources], dim=2)
+    adjacency = torch.zeros(args.batch_size, args.num_nodes, args.num_nodes, dtype=torch.bool)
+    adjacency[torch.arange(args.batch_size)[:, None, None], torch.arange(num_real)[None, :, None], sources] = True
+    edge_index = adjacency.nonzero()
+    mask = torch.where(adjacency, 0.0, -10000.0).unsqueeze(1)
+    x = torch.randn(args.batch_size, args.num_nodes, config.hidden_size)
+    layers = dict()
+    for backend in ("eager", "sdpa"):
+        config.attention_backend = backend
+        torch.manual_seed(args.seed)
+        layers[f"dense ({backend})"] = GTXLayer(config).eval()
+    layers["sparse"] = layers["dense (eager)"]
+
+    def forward(name):
+        with torch.no_grad():
+            return layers[name](x, mask, edge_index=edge_index if name == "sparse" else None)[0]
+    def backward(name):
+        layers[name](x.requires_grad_(), mask, edge_index=edge_index if name == "sparse" else None)[0].sum().backward()
+    expected = forward("dense (eager)")
+    assert torch.allclose(expected[:, :num_real], forward("sparse")[:, :num_real], atol=1e-5), "sparse message passing differs from the masked dense attention"
+    timings = dict()
+    for name in layers:
+        timings[f"{name} forward"] = best_time(lambda: forward(name), args.repeat)
+    for name in layers:
+        timings[f"{name} forward+backward"] = best_time(lambda: backward(name), args.repeat)
+    dense_bytes = args.batch_size*config.num_attention_heads*args.num_nodes*args.num_nodes*4
+    sparse_bytes = len(edge_index)*(config.num_attention_heads + 2*config.hidden_size)*4
+    report(f"Relational layer over {args.batch_size}x{args.num_nodes} nodes, {len(edge_index)/(args.batch_size*num_real):.1f} edges per node (dense scores {dense_bytes/2**20:.0f} MiB, sparse scores and gathered keys / values {sparse_bytes/2**20:.0f} MiB)", timings, args.batch_size, "graphs")
+
+def generation_batches(args):
+    """
+    Randomly initialized ``GTXForGeneration`` (UniLM cross attention) and the prediction batches it is run on.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    token_type_vocab = {k:idx for idx, k in enumerate(args.sections.split(","))} if args.sections else None
+    dataset = HeadOnlyDataset(tokenizer, args.data, args.block_size, token_type_vocab, args.knowmix, gcn=True)
+    config = AutoConfig.from_pretrained(args.config)
+    config.KnowMix = args.knowmix
+    config.use_ce_pooler = True
+    config.cross_att_type = 'unilm'
+    if args.lang_model:
+        config.pretrained_lang_model = {'model_name': args.lang_model, 'use_weight': False}
+    model = GTXForGeneration(config).eval()
+    model.sep_token_id, model.mask_token_id, model.pad_token_id = tokenizer.sep_token_id, tokenizer.mask_token_id, tokenizer.pad_token_id
+    collator = UniLM_DataCollator(tokenizer, config.kg_special_token_ids, prediction=True)
+    batches = [collator([dataset[(start+i) % len(dataset)] for i in range(args.batch_size)]) for start in range(0, args.num_batches*args.batch_size, args.batch_size)]
+    return model, batches
+
+def bench_decode(args):
+    model, batches = generation_batches(args)
+
+    def decode(use_cache):
+        outputs = list()
+        for batch in batches:
+            # Same draws of the top-p sampling (Rx) in both runs, and token types are converted in place
+            torch.manual_seed(args.seed)
+            with torch.no_grad():
+                outputs.append(model.decode(**{k:(v.clone() if torch.is_tensor(v) else v) for k, v in batch.items()}, use_cache=use_cache)[0])
+        return outputs
+    for cached, full in zip(decode(True), decode(False)):
+        assert all(torch.equal(c, f) for c, f in zip(cached, full)), "cached decoding differs from full forward passes"
+    timings = {
+        "full forward per step": best_time(lambda: decode(False), args.repeat),
+        "cached": best_time(lambda: decode(True), args.repeat),
+    }
+    report(f"Greedy decoding of {args.num_batches} batches of {args.batch_size}", timings, args.num_batches*args.batch_size, "samples")
+
+def bench_beam(args):
+    model, batches = generation_batches(args)
+
+    def beam_search(use_cache):
+        with torch.no_grad():
+            return [model.decode(**batch, search_beam_size=args.beam_size, length_penalty=args.length_penalty, output_scores=True, clean_outputs=False, use_cache=use_cache) for batch in batches]
+    for cached, full in zip(beam_search(True), beam_search(False)):
+        assert torch.equal(cached[0], full[0]), "beam search from cached keys / values differs from full forward passes"
+        assert torch.allclose(cached[3], full[3], atol=1e-4), "beam scores differ from the ones of full forward passes"
+    timings = {
+        "full forward per step": best_time(lambda: beam_search(False), args.repeat),
+        "cached": best_time(lambda: beam_search(True), args.repeat),
+    }
+    report(f"Beam search ({args.beam_size} beams) of {args.num_batches} batches of {args.batch_size}", timings, args.num_batches*args.batch_size, "samples")
+
+def bench_ppl(args):
+    model, batches = generation_batches(args)
+
+    def perplexity(single_pass):
+        with torch.no_grad():
+            return [model.decode_for_ppl(**batch, single_pass=single_pass)[0] for batch in batches]
+    for single_pass, loop in zip(perplexity(True), perplexity(False)):
+        assert torch.allclose(single_pass, loop, rtol=1e-4), f"single pass perplexity {single_pass} differs from the loop {loop}"
+    timings = {
+        "forward per position": best_time(lambda: perplexity(False), args.repeat),
+        "single pass": best_time(lambda: perplexity(True), args.repeat),
+    }
+    report(f"Teacher-forced perplexity of {args.num_batches} batches of {args.batch_size}", timings, args.num_batches*args.batch_size, "samples")
+
+BENCHMARKS = {
+    "featurize": bench_featurize,
+    "padding": bench_padding,
+    "collate": bench_collate,
+    "prefetch": bench_prefetch,
+    "attention": bench_attention,
+    "message_passing": bench_message_passing,
+    "decode": bench_decode,
+    "beam": bench_beam,
+    "ppl": bench_ppl,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the data pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    featurize_parser = subparsers.add_parser("featurize", help="Per-sample vs. batched (and multi-process) featurization")
+    featurize_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    featurize_parser.add_argument("--tokenizer", required=True)
+    featurize_parser.add_argument("--knowmix", default="")
+    featurize_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    featurize_parser.add_argument("--block_size", type=int, default=512)
+    featurize_parser.add_argument("--num_samples", type=int, default=2000)
+    featurize_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[100, 1000])
+    featurize_parser.add_argument("--num_procs", type=int, nargs="*", default=[4])
+    featurize_parser.add_argument("--repeat", type=int, default=3)
+
+    padding_parser = subparsers.add_parser("padding", help="Training throughput with fixed vs. dynamic padding and length grouped batches")
+    padding_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    padding_parser.add_argument("--tokenizer", required=True)
+    padding_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    padding_parser.add_argument("--lang_model", default="", help="Overrides the pretrained language model of the config (e.g. a local copy)")
+    padding_parser.add_argument("--knowmix", default="")
+    padding_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    padding_parser.add_argument("--block_size", type=int, default=512)
+    padding_parser.add_argument("--batch_size", type=int, default=8)
+    padding_parser.add_argument("--num_batches", type=int, default=20)
+    padding_parser.add_argument("--mega_batch_mult", type=int, default=50)
+    padding_parser.add_argument("--seed", type=int, default=42)
+    padding_parser.add_argument("--repeat", type=int, default=1)
+
+    collate_parser = subparsers.add_parser("collate", help="Special token masking and collation of the MLM collators")
+    collate_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    collate_parser.add_argument("--tokenizer", required=True)
+    collate_parser.add_argument("--knowmix", default="")
+    collate_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    collate_parser.add_argument("--block_size", type=int, default=512)
+    collate_parser.add_argument("--batch_size", type=int, default=32)
+    collate_parser.add_argument("--num_batches", type=int, default=20)
+    collate_parser.add_argument("--repeat", type=int, default=3)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Training throughput with collation in the loop vs. prefetched by a background thread")
+    prefetch_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    prefetch_parser.add_argument("--tokenizer", required=True)
+    prefetch_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    prefetch_parser.add_argument("--lang_model", default="", help="Overrides the pretrained language model of the config (e.g. a local copy)")
+    prefetch_parser.add_argument("--knowmix", default="")
+    prefetch_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    prefetch_parser.add_argument("--block_size", type=int, default=512)
+    prefetch_parser.add_argument("--batch_size", type=int, default=8)
+    prefetch_parser.add_argument("--num_batches", type=int, default=20)
+    prefetch_parser.add_argument("--prefetch_batches", type=int, nargs="+", default=[2, 4])
+    prefetch_parser.add_argument("--repeat", type=int, default=1)
+
+    attention_parser = subparsers.add_parser("attention", help="Eager vs. fused (sdpa) vs. chunked attention at the text / dx,prx / px lengths")
+    attention_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    attention_parser.add_argument("--lengths", type=int, nargs="+", default=[512, 768, 2048])
+    attention_parser.add_argument("--batch_size", type=int, default=8)
+    attention_parser.add_argument("--chunk_size", type=int, default=512)
+    attention_parser.add_argument("--seed", type=int, default=42)
+    attention_parser.add_argument("--repeat", type=int, default=3)
+
+    message_passing_parser = subparsers.add_parser("message_passing", help="Adjacency masked dense vs. edge list (sparse) attention of the relational layers on px sized graphs")
+    message_passing_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    message_passing_parser.add_argument("--num_nodes", type=int, default=2048)
+    message_passing_parser.add_argument("--degree", type=int, default=8, help="Random incoming edges of every node, besides its self-loop")
+    message_passing_parser.add_argument("--batch_size", type=int, default=4)
+    message_passing_parser.add_argument("--seed", type=int, default=42)
+    message_passing_parser.add_argument("--repeat", type=int, default=3)
+
+    decode_parser = subparsers.add_parser("decode", help="Greedy decoding with full forward passes vs. cached keys / values")
+    decode_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    decode_parser.add_argument("--tokenizer", required=True)
+    decode_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    decode_parser.add_argument("--lang_model", default="", help="Overrides the pretrained language model of the config (e.g. a local copy)")
+    decode_parser.add_argument("--knowmix", default="")
+    decode_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    decode_parser.add_argument("--block_size", type=int, default=512)
+    decode_parser.add_argument("--batch_size", type=int, default=8)
+    decode_parser.add_argument("--num_batches", type=int, default=4)
+    decode_parser.add_argument("--seed", type=int, default=42)
+    decode_parser.add_argument("--repeat", type=int, default=1)
+
+    beam_parser = subparsers.add_parser("beam", help="Beam search with full forward passes of every beam vs. cached keys / values")
+    beam_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    beam_parser.add_argument("--tokenizer", required=True)
+    beam_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    beam_parser.add_argument("--lang_model", default="", help="Overrides the pretrained language model of the config (e.g. a local copy)")
+    beam_parser.add_argument("--knowmix", default="")
+    beam_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    beam_parser.add_argument("--block_size", type=int, default=512)
+    beam_parser.add_argument("--batch_size", type=int, default=8)
+    beam_parser.add_argument("--num_batches", type=int, default=2)
+    beam_parser.add_argument("--beam_size", type=int, default=4)
+    beam_parser.add_argument("--length_penalty", type=float, default=1.0)
+    beam_parser.add_argument("--repeat", type=int, default=1)
+
+    ppl_parser = subparsers.add_parser("ppl", help="Teacher-forced perplexity with a forward pass per position vs. a single one (shifted [MASK] layout)")
+    ppl_parser.add_argument("--data", required=True, help="Split directory holding a `db` (or converted shards)")
+    ppl_parser.add_argument("--tokenizer", required=True)
+    ppl_parser.add_argument("--config", required=True, help="Model config (weights are randomly initialized)")
+    ppl_parser.add_argument("--lang_model", default="", help="Overrides the pretrained language model of the config (e.g. a local copy)")
+    ppl_parser.add_argument("--knowmix", default="")
+    ppl_parser.add_argument("--sections", default="", help="Comma separated note sections of the token type vocab")
+    ppl_parser.add_argument("--block_size", type=int, default=512)
+    ppl_parser.add_argument("--batch_size", type=int, default=8)
+    ppl_parser.add_argument("--num_batches", type=int, default=4)
+    ppl_parser.add_argument("--repeat", type=int, default=1)
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,124 @@
+from typing import Dict, Iterable, Optional, Tuple
+import torch
+
+from utils.notifier import logging, log_formatter
+notifier = logging.getLogger(__name__)
+notifier.addHandler(log_formatter())
+
+"""
+KG corruption for error detection
+"""
+class CorruptionTable:
+    """
+    Candidate replacements of the KG nodes, indexed by node id, from which ``corrupt_nodes`` draws the corruptions of
+    the ``ErrDetect`` task on the fly instead of reading them from a precomputed db.
+    Nodes are split into groups of interchangeable ids (e.g. the ICD codes of a category, or the values of a
+    prescription field); a corrupted node is replaced by another member of its group. The groups are stored CSR-style
+    (``members`` sorted by group, ``offsets``) so that a replacement is a single gather.
+    Args:
+        group: ``(kg_size,)`` group of each node, -1 for nodes which are never corrupted.
+        members: Node ids of every group, one group after the other.
+        offsets: ``(num_groups + 1,)`` start of each group in ``members``.
+        position: ``(kg_size,)`` position of each node within its group.
+        weight: ``(kg_size,)`` relative chance of each node to be corrupted (e.g. the frequency of the code).
+        linked: ``(kg_size,)`` node replaced along with each node (e.g. the literal of a code), -1 if none.
+    """
+    def __init__(self, group: torch.Tensor, members: torch.Tensor, offsets: torch.Tensor, position: torch.Tensor, weight: torch.Tensor, linked: torch.Tensor):
+        self.group = group
+        self.members = members
+        self.offsets = offsets
+        self.position = position
+        self.weight = weight
+        self.linked = linked
+        self._device_tables = dict()
+
+    @classmethod
+    def from_groups(cls, groups: Iterable[Iterable[int]], kg_size: int, weights: Optional[Dict[int, float]] = None, linked: Optional[Dict[int, int]] = None):
+        """
+        Builds the table from groups of interchangeable node ids, e.g. ``pxcat2ids.values()`` for ``px``, or the
+        entity ids of the codes of each large category of the codebook for ``dx,prx`` with the code frequencies as
+        ``weights`` and their literals as ``linked``. Groups of a single node have nothing to be replaced by and are
+        dropped.
+        """
+        groups = [list(dict.fromkeys(g)) for g in groups]
+        groups = [g for g in groups if len(g) > 1]
+        group = torch.full((kg_size,), -1, dtype=torch.long)
+        position = torch.zeros(kg_size, dtype=torch.long)
+        members = torch.tensor([node for g in groups for node in g], dtype=torch.long)
+        offsets = torch.tensor([0] + [len(g) for g in groups], dtype=torch.long).cumsum(0)
+        if (group.scatter_add(0, members, torch.ones_like(members)) > 0).any():
+            raise ValueError("A node can only belong to a single group")
+        group[members] = torch.repeat_interleave(torch.arange(len(groups)), offsets.diff())
+        position[members] = torch.arange(len(members)) - offsets[group[members]]
+        weight = torch.zeros(kg_size)
+        weight[members] = 1.0
+        if weights is not None:
+            nodes = [node for node in weights if group[node] > -1]
+            weight[nodes] = torch.tensor([float(weights[node]) for node in nodes])
+        linked_ids = torch.full((kg_size,), -1, dtype=torch.long)
+        if linked is not None:
+            linked_ids[list(linked)] = torch.tensor(list(linked.values()), dtype=torch.long)
+        notifier.info(f"Corruption table of {len(members)} nodes in {len(groups)} groups")
+        return cls(group, members, offsets, position, weight, linked_ids)
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return {k:getattr(self, k) for k in ('group', 'members', 'offsets', 'position', 'weight', 'linked')}
+
+    def save(self, path: str):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path: str):
+        return cls(**torch.load(path))
+
+    def __getstate__(self):
+        # Copies on other devices are rebuilt where they are needed
+        state = self.__dict__.copy()
+        state['_device_tables'] = dict()
+        return state
+
+    def to(self, device: torch.device) -> Tuple[torch.Tensor, ...]:
+        device = torch.device(device)
+        if device not in self._device_tables:
+            self._device_tables[device] = tuple(t.to(device) for t in self.state_dict().values())
+        return self._device_tables[device]
+
+def corrupt_nodes(inputs: torch.Tensor, table: CorruptionTable, ratio: float, generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Replaces ``ratio`` of the corruptible nodes of every graph (at least one) by another node of their group, for the
+    whole batch at once. Nodes to corrupt are drawn without replacement with chances proportional to their weight
+    (exponential keys, Efraimidis-Spirakis), and each one by a node of its group drawn uniformly among the others; a
+    node linked to a corrupted one (e.g. its literal) is replaced by the node linked to its replacement, at its first
+    position in the graph.
+    Returns the corrupted node ids and a float mask of the nodes which were changed (the ``kg_label`` of ``ErrDetect``).
+    """
+    group, members, offsets, position, weight, linked = table.to(inputs.device)
+    node_group = group[inputs]
+    candidates = (node_group > -1) & (weight[inputs] > 0)
+    num_candidates = candidates.sum(1)
+    num_targets = torch.where(num_candidates > 0, (num_candidates * ratio).long().clamp(min=1), num_candidates)
+
+    # The `num_targets` smallest keys of each graph, Exp(1) / weight, make a weighted sample without replacement
+    keys = torch.empty(inputs.shape, device=inputs.device).exponential_(generator=generator) / weight[inputs]
+    keys = keys.masked_fill(~candidates, float('inf'))
+    rank = torch.empty_like(inputs).scatter_(1, keys.argsort(1), torch.arange(inputs.size(1), device=inputs.device).expand_as(inputs))
+    rows, cols = (candidates & (rank < num_targets.unsqueeze(1))).nonzero(as_tuple=True)
+
+    # Uniform over the other members of the group: draw among size - 1 and step over the original node
+    original = inputs[rows, cols]
+    target_group = node_group[rows, cols]
+    start, size = offsets[target_group], offsets[target_group + 1] - offsets[target_group]
+    draw = (torch.rand(len(rows), generator=generator, device=inputs.device) * (size - 1)).long()
+    draw = draw + (draw >= position[original]).long()
+    replacement = members[start + draw]
+    corrupted = inputs.clone()
+    corrupted[rows, cols] = replacement
+
+    has_link = (linked[original] > -1) & (linked[replacement] > -1)
+    if has_link.any():
+        rows, old, new = rows[has_link], linked[original[has_link]], linked[replacement[has_link]]
+        found = inputs[rows] == old.unsqueeze(1)
+        hit = found.any(1)
+        corrupted[rows[hit], found[hit].int().argmax(1)] = new[hit]
+
+    return corrupted, (corrupted != inputs).float()
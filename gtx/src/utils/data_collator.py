@@ -5,18 +5,23 @@ import pickle
 import time
 import torch
 import itertools
+import functools
 from filelock import FileLock
 from dataclasses import dataclass
 from typing import Any, Callable, Dict, List, NewType, Optional, Tuple, Union
 
 import torch
+import numpy as np
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import get_worker_info
 from torch.utils.data.dataset import Dataset
 
 from transformers.tokenization_utils_base import BatchEncoding, PaddingStrategy, PreTrainedTokenizerBase
 from transformers.tokenization_utils import PreTrainedTokenizer
 from transformers.utils import logging
 
+from utils.corruption import CorruptionTable, corrupt_nodes
+from utils.samplers import distributed_rank
 from utils.notifier import logging, log_formatter
 notifier = logging.getLogger(__name__)
 notifier.addHandler(log_formatter())
@@ -28,6 +33,276 @@ notifier.addHandler(log_formatter())
 InputDataClass = NewType("InputDataClass", Any)
 DataCollator = NewType("DataCollator", Callable[[List[InputDataClass]], Dict[str, torch.Tensor]])
 
+class BatchTensorizer:
+    """
+    Tensorization shared by the data collators. The schema of the batch (kept fields and how each one is stacked) is
+    resolved once from the first sample, then NumPy fields (handed out by ``FeatureStore``) are copied in a single pass
+    straight into their final tensor, widened to the dtypes ``torch.tensor`` gives for Python lists (int64 / float32),
+    instead of round-tripping through Python lists or intermediate arrays.
+    Args:
+        skip: Fields whose name contains any of these are left out (``kg_adjacency`` always is, see
+            ``densify_adjacency``).
+        drop: Fields with exactly these names are left out (e.g. a ``label`` built by the collator itself).
+        ragged: Fields whose name contains any of these vary in length along their first axis (e.g. ``rc_indeces``).
+            They are padded with zeros to the longest sample of the batch, and ``{field}_mask`` flags their valid rows.
+        kg_pad_id: (Optional) Adds ``kg_padding_mask`` (non-padding nodes of ``kg_input_ids``).
+        pin_memory: Whether array fields are allocated in page-locked memory (only worth it when collating in the
+            main process before a host-to-device copy).
+    """
+    def __init__(self, skip: Tuple[str, ...] = (), drop: Tuple[str, ...] = (), ragged: Tuple[str, ...] = (), kg_pad_id: Optional[int] = None, pin_memory: bool = False):
+        self.skip = skip
+        self.drop = drop
+        self.ragged = ragged
+        self.kg_pad_id = kg_pad_id
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._keys = None
+        self._schema = None
+
+    def resolve(self, first: Dict[str, Any]) -> List[Tuple[str, str, Any]]:
+        """
+        ``(field, kind, dtype)`` of every kept field of samples shaped as ``first``.
+        """
+        schema = list()
+        for k, v in first.items():
+            if (k == 'kg_adjacency') or (k in self.drop) or (v is None) or isinstance(v, str):
+                continue
+            if any(s in k for s in self.ragged):
+                schema.append((k, 'ragged', None))
+            elif any(s in k for s in self.skip):
+                continue
+            elif isinstance(v, torch.Tensor):
+                # Legacy per-head (N x N x heads) masks are laid out heads first
+                schema.append((k, 'permuted' if (k == 'kg_attention_mask') and (v.dim() == 3) else 'tensor', None))
+            elif isinstance(v, (np.ndarray, np.generic)):
+                schema.append((k, 'array', torch.float32 if np.issubdtype(v.dtype, np.floating) else torch.int64))
+            else:
+                schema.append((k, 'nested', None))
+        return schema
+
+    def stack_arrays(self, values: List[np.ndarray], dtype) -> torch.Tensor:
+        out = torch.empty((len(values),) + np.shape(values[0]), dtype=dtype, pin_memory=self.pin_memory)
+        np.stack(values, out=out.numpy())
+        return out
+
+    @staticmethod
+    def pad_ragged(values: List[Any]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        ``(batch_size, max_length, ...)`` int64 tensor of per-sample arrays of different lengths, zero-padded, and its
+        ``(batch_size, max_length)`` validity mask, both filled with one scatter of the concatenated samples.
+        """
+        arrays = [np.asarray(v) for v in values]
+        # Empty samples carry no trailing shape, take it from the others
+        trailing = next((a.shape[1:] for a in arrays if a.size > 0), ())
+        arrays = [a.reshape((-1,) + trailing) if a.size > 0 else np.zeros((0,) + trailing, dtype=np.int64) for a in arrays]
+        lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+        rows = np.repeat(np.arange(len(arrays)), lengths)
+        cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        padded = torch.zeros((len(arrays), int(lengths.max(initial=0))) + trailing, dtype=torch.int64)
+        mask = torch.zeros(padded.shape[:2], dtype=torch.bool)
+        padded[rows, cols] = torch.from_numpy(np.concatenate(arrays).astype(np.int64, copy=False))
+        mask[rows, cols] = True
+        return padded, mask
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        first = features[0]
+        keys = tuple(k for k, v in first.items() if v is not None)
+        if keys != self._keys:
+            self._keys, self._schema = keys, self.resolve(first)
+        batch = dict()
+        for k, kind, dtype in self._schema:
+            values = [f[k] for f in features]
+            if kind == 'array':
+                batch[k] = self.stack_arrays(values, dtype)
+            elif kind == 'tensor':
+                batch[k] = torch.stack(values)
+            elif kind == 'permuted':
+                batch[k] = torch.stack(values).permute(0,3,1,2)
+            elif kind == 'ragged':
+                batch[k], batch[f'{k}_mask'] = self.pad_ragged(values)
+            else:
+                batch[k] = torch.tensor(values)
+        if (self.kg_pad_id is not None) and ('kg_input_ids' in batch):
+            batch['kg_padding_mask'] = ~batch['kg_input_ids'].eq(self.kg_pad_id)
+        return batch
+
+class BatchRNG:
+    """
+    Generator of the random draws of a data collator, re-seeded for every batch from (seed, epoch, rank, batch index),
+    so that a batch is corrupted the same way however many DataLoader workers there are, whether it is collated in a
+    worker or masked on the device, and when an epoch is resumed. DataLoader hands out batches to its workers in turn,
+    hence the ``k``-th batch collated by worker ``w`` of ``num_workers`` is the batch ``start + k * num_workers + w``
+    of the epoch (``start`` being the batches consumed before a resume).
+    """
+    def __init__(self, seed: int):
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self._count = 0
+        self._generators = dict()
+
+    def __getstate__(self):
+        # Generators are not picklable, workers make their own
+        state = self.__dict__.copy()
+        state['_generators'] = dict()
+        return state
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.start = 0
+        self.epoch = epoch
+        self._count = 0
+
+    def resume(self, epoch: int, batches_consumed: int):
+        self.epoch = epoch
+        self.start = batches_consumed
+        self._count = 0
+
+    def batch_seed(self, batch_index: int) -> int:
+        """
+        Seed of the draws of the ``batch_index``-th batch of the current epoch, e.g. to replay it on its own.
+        """
+        rank, _ = distributed_rank()
+        return random.Random(f"{self.seed}-{self.epoch}-{rank}-{batch_index}").getrandbits(63)
+
+    def generator(self, device: Optional[torch.device] = None) -> torch.Generator:
+        """
+        Generator on ``device`` seeded for the next batch of this process.
+        """
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        batch_index = self.start + self._count * num_workers + worker_id
+        self._count += 1
+        device = torch.device('cpu' if device is None else device)
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device)
+        return self._generators[device].manual_seed(self.batch_seed(batch_index))
+
+@functools.lru_cache(maxsize=None)
+def special_tokens_lookup(tokenizer: PreTrainedTokenizerBase) -> torch.Tensor:
+    """
+    Boolean table over the vocabulary of ``tokenizer``, True at its special tokens. Indexing it with a batch of ids
+    gives the same mask as ``tokenizer.get_special_tokens_mask(ids, already_has_special_tokens=True)`` row by row.
+    """
+    special_ids = torch.tensor(sorted(set(tokenizer.all_special_ids)), dtype=torch.long)
+    vocab_size = max(len(tokenizer), int(special_ids.max()) + 1 if len(special_ids) else 0)
+    lookup = torch.zeros(vocab_size, dtype=torch.bool)
+    lookup[special_ids] = True
+    return lookup
+
+# Fields padded along their second axis, by the length they are padded to
+PADDED_FIELDS = {
+    'lang': ('lang_input_ids', 'lang_attention_mask', 'token_type_ids'),
+    'kg': ('kg_input_ids', 'kg_attention_mask', 'kg_padding_mask', 'kg_label', 'kg_label_mask', 'kg_langinit_index', 'kg_langinit_input_ids', 'kg_langinit_attention_mask', 'kg_ext_input_ids', 'kg_ext_attention_mask'),
+    'kg_ext_sum': ('kg_ext_sum_input_ids', 'kg_ext_sum_attention_mask'),
+}
+
+def batch_length(mask: torch.Tensor) -> int:
+    """
+    Position of the last non-zero entry along the second axis of ``mask`` (over the whole batch) plus one.
+    """
+    nonpad = mask.reshape(mask.shape[0], mask.shape[1], -1).ne(0).any(-1).any(0)
+    if not nonpad.any():
+        return 1
+    return int(nonpad.nonzero()[-1]) + 1
+
+def trim_padding(batch: Dict[str, Any], kg_pad_id: int) -> Dict[str, Any]:
+    """
+    Cuts the trailing padding shared by every sample of ``batch``, so that each padded field ends at the longest
+    sample of the batch instead of the block size. Only positions that are padding in every sample are dropped,
+    hence outputs on real tokens/nodes are unchanged (relation indices of ``rc_indeces`` still point to the same nodes).
+    """
+    lengths = dict()
+    if 'lang_attention_mask' in batch:
+        lengths['lang'] = batch_length(batch['lang_attention_mask'])
+    if 'kg_input_ids' in batch:
+        kg_attention_mask = batch.get('kg_attention_mask')
+        if (kg_attention_mask is not None) and (kg_attention_mask.dim() == 2):
+            # Linearized graphs: a token mask, as for texts
+            lengths['kg'] = batch_length(kg_attention_mask)
+        else:
+            lengths['kg'] = batch_length(batch['kg_input_ids'].ne(kg_pad_id))
+    if 'kg_ext_sum_attention_mask' in batch:
+        lengths['kg_ext_sum'] = batch_length(batch['kg_ext_sum_attention_mask'])
+
+    for group, length in lengths.items():
+        for k in PADDED_FIELDS[group]:
+            v = batch.get(k)
+            if not isinstance(v, torch.Tensor) or (v.dim() < 2):
+                continue
+            if (k == 'kg_attention_mask') and (v.dim() == 3):
+                batch[k] = v[:, :length, :length].contiguous()
+            elif (k == 'kg_attention_mask') and (v.dim() == 4):
+                batch[k] = v[:, :, :length, :length].contiguous()
+            else:
+                batch[k] = v[:, :length].contiguous()
+    return batch
+
+def batch_edges(batch: Dict[str, Any], features: List[Dict]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Sample and (target, source) nodes of the edges (``kg_adjacency``) of the samples, without the edges of padding
+    nodes cut by ``trim_padding``.
+    """
+    num_nodes = batch['kg_input_ids'].size(1)
+    edges = [np.asarray(f['kg_adjacency'], dtype=np.int64).reshape(-1, 2) for f in features]
+    sample_idx = torch.from_numpy(np.repeat(np.arange(len(edges)), [len(e) for e in edges]))
+    edges = torch.from_numpy(np.concatenate(edges))
+    kept = (edges < num_nodes).all(1)
+    return sample_idx[kept], edges[kept]
+
+def densify_adjacency(batch: Dict[str, Any], features: List[Dict]) -> Dict[str, Any]:
+    """
+    Builds the dense ``kg_attention_mask`` of the GAT from the edge lists (``kg_adjacency``) of the samples, only as
+    large as the (possibly trimmed) ``kg_input_ids`` of the batch. Samples repeated in the batch for negative
+    sampling have their mask repeated as well.
+    """
+    if (not features) or (features[0].get('kg_adjacency') is None):
+        return batch
+    num_rows, num_nodes = batch['kg_input_ids'].shape
+    sample_idx, edges = batch_edges(batch, features)
+    mask = torch.zeros(len(features), num_nodes, num_nodes, dtype=torch.long)
+    mask[sample_idx, edges[:, 0], edges[:, 1]] = 1
+    if num_rows != len(features):
+        mask = mask.repeat(num_rows // len(features), 1, 1)
+    batch['kg_attention_mask'] = mask
+    return batch
+
+def adjacency_edge_index(batch: Dict[str, Any], features: List[Dict]) -> Dict[str, Any]:
+    """
+    Sparse counterpart of ``densify_adjacency`` for ``kg_message_passing="sparse"`` models: ``kg_edge_index`` lists
+    the (row, target node, source node) of every edge of the batch instead of an N x N mask per row. Samples
+    repeated in the batch for negative sampling have their edges repeated as well.
+    """
+    if (not features) or (features[0].get('kg_adjacency') is None):
+        return batch
+    num_rows = batch['kg_input_ids'].size(0)
+    sample_idx, edges = batch_edges(batch, features)
+    edge_index = torch.cat([sample_idx.unsqueeze(1), edges], dim=1)
+    if num_rows != len(features):
+        edge_index = torch.cat([edge_index + torch.tensor([copy*len(features), 0, 0]) for copy in range(num_rows // len(features))])
+    batch['kg_edge_index'] = edge_index
+    return batch
+
+def negative_pair_indices(batch_size: int, n_negatives: int, device: Optional[torch.device] = None) -> Dict[str, torch.Tensor]:
+    """
+    Rows of the text and of the graph paired in each of the ``(n_negatives + 1) * batch_size`` rows of the alignment
+    task: the positive pairs first, then the text of the ``idx``-th next sample paired with each graph, as
+    ``negative_sampling`` lays out its copies of the batch. The model only repeats the cross-modality layers.
+    """
+    return {
+        'cross_lang_index': torch.cat([(torch.arange(batch_size, device=device) + idx) % batch_size for idx in range(n_negatives+1)]),
+        'cross_kg_index': torch.arange(batch_size, device=device).repeat(n_negatives+1),
+    }
+
+def multi_hot(labels: List[Any], num_labels: int) -> torch.Tensor:
+    """
+    ``(batch_size, num_labels)`` float multi-hot matrix of per-sample label index lists, set with one scatter of the
+    flattened indices offset by their row (label lists of a ``FeatureStore`` are views into its CSR column).
+    """
+    labels = [np.asarray(l, dtype=np.int64).reshape(-1) for l in labels]
+    rows = np.repeat(np.arange(len(labels), dtype=np.int64), [len(l) for l in labels])
+    flat_index = torch.from_numpy(rows * num_labels + np.concatenate(labels))
+    return torch.zeros(len(labels) * num_labels).index_fill_(0, flat_index, 1).view(len(labels), num_labels)
+
 @dataclass
 class NodeClassification_DataCollator:
     """
@@ -40,38 +315,33 @@ class NodeClassification_DataCollator:
     kg_size: int
     align: bool = False
     n_negatives: int = 1
+    virtual_negatives: bool = False
     edge_cls: bool = False
     mlm: bool = True
     mlm_probability: float = 0.15
     contrastive: bool = False
     linearize: bool = False
+    dynamic_padding: bool = False
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
+    device_masking: bool = False
+    # Seed of the per batch generators (see `BatchRNG`), the default generator if None
+    seed: Optional[int] = None
     prediction: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_padding(batch, self.kg_special_token_ids['PAD'])
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
 
         if not self.prediction:
-            # Construct batch for Masked LM
-            masked_texts, lm_label = self.mask_tokens(batch['lang_input_ids'])
-            # Construct batch for Masekd LP
-            if self.linearize:
-                masked_table_contents, content_label = self.mask_tokens(batch['kg_input_ids'])
-                batch['kg_input_ids'] = masked_table_contents
-                batch['kg_label'] = content_label
-                batch['kg_padding_mask'] = batch['kg_attention_mask']
-            else:
-                masked_subs, kg_label_mask, kg_padding_mask = self.mask_kg(batch['kg_input_ids'], batch['kg_label_mask'])
-                batch['kg_input_ids'] = masked_subs
-                batch['kg_label_mask'] = kg_label_mask
-                batch['kg_padding_mask'] = kg_padding_mask
-
-            batch['lang_input_ids'] = masked_texts
-            batch['lm_label'] = lm_label
-            # Construct batch for Alignment loss
-            if self.align:
-                batch = self.negative_sampling(batch, len(features))
+            # With `device_masking`, the LightningModule masks the batch once moved to the device
+            if not self.device_masking:
+                batch = self.mask_batch(batch, self.rng.generator() if self.rng is not None else None)
         else:
             batch['lang_input_ids'] = batch['lang_input_ids']
             batch['lm_label'] = None
@@ -80,52 +350,65 @@ class NodeClassification_DataCollator:
 
         return batch
 
-    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
-
-        for k, v in first.items():
-            if ('rc' in k) and (v is not None):
-                if self.edge_cls:
-                    batch[k] = [f[k] for f in features]
-                continue
-            if v is not None:
-                if (k == "kg_attention_mask") and not isinstance(v, str):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                elif not isinstance(v, str):
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
+    def mask_batch(self, batch: Dict[str, Any], generator: Optional[torch.Generator] = None) -> Dict[str, Any]:
+        """
+        Masked LM / LP corruption of a tensorized batch, then negative sampling for the alignment loss, on the device
+        of the batch and drawn from ``generator`` (the default generator if None).
+        """
+        batch_size = batch['lang_input_ids'].size(0)
+        # Construct batch for Masked LM
+        masked_texts, lm_label = self.mask_tokens(batch['lang_input_ids'], generator)
+        # Construct batch for Masekd LP
+        if self.linearize:
+            masked_table_contents, content_label = self.mask_tokens(batch['kg_input_ids'], generator)
+            batch['kg_input_ids'] = masked_table_contents
+            batch['kg_label'] = content_label
+            batch['kg_padding_mask'] = batch['kg_attention_mask']
+        else:
+            masked_subs, kg_label_mask, kg_padding_mask = self.mask_kg(batch['kg_input_ids'], batch['kg_label_mask'], generator)
+            batch['kg_input_ids'] = masked_subs
+            batch['kg_label_mask'] = kg_label_mask
+            batch['kg_padding_mask'] = kg_padding_mask
 
+        batch['lang_input_ids'] = masked_texts
+        batch['lm_label'] = lm_label
+        # Construct batch for Alignment loss
+        if self.align:
+            batch = self.negative_sampling(batch, batch_size)
         return batch
 
+    def __post_init__(self):
+        self.rng = BatchRNG(self.seed) if self.seed is not None else None
+        self.tensorizer = BatchTensorizer(skip=('rc',), ragged=('rc',) if self.edge_cls else (), pin_memory=self.pin_memory)
+
+    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
+        return self.tensorizer(features)
+
     def negative_sampling(self,batch, batch_size) -> Dict[str, torch.Tensor]:
+        device = batch['lang_input_ids'].device
+        if self.virtual_negatives:
+            batch.update(negative_pair_indices(batch_size, self.n_negatives, device))
+            batch['cross_label'] = torch.cat([torch.ones(batch_size, dtype=torch.long, device=device),
+                                                 torch.zeros(batch_size*self.n_negatives, dtype=torch.long, device=device)],dim=0)
+            return batch
         for k, v in batch.items():
             if v is not None:
                 if ('rc' in k) or ('label' in k):
                     continue
+                elif k == 'kg_edge_index':
+                    # Edges follow the copies of their graph
+                    batch[k] = torch.cat([v + torch.tensor([idx*batch_size, 0, 0], device=device) for idx in range(self.n_negatives + 1)],dim=0)
                 elif 'kg' not in k:
-                    batch[k] = torch.cat([batch[k].detach().clone()[(torch.arange(batch_size) + idx) % batch_size] for idx in range(self.n_negatives+1)],dim=0)
+                    batch[k] = torch.cat([batch[k].detach().clone()[(torch.arange(batch_size, device=device) + idx) % batch_size] for idx in range(self.n_negatives+1)],dim=0)
 
                 else:
                     batch[k] = torch.cat([batch[k].detach().clone() for _ in range(self.n_negatives + 1)],dim=0)
 
-        batch['cross_label'] = torch.cat([torch.ones(batch_size, dtype=torch.long),
-                                             torch.zeros(batch_size*self.n_negatives, dtype=torch.long)],dim=0)
+        batch['cross_label'] = torch.cat([torch.ones(batch_size, dtype=torch.long, device=device),
+                                             torch.zeros(batch_size*self.n_negatives, dtype=torch.long, device=device)],dim=0)
         return batch
 
-    def mask_tokens(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def mask_tokens(self, inputs: torch.Tensor, generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
@@ -136,31 +419,30 @@ class NodeClassification_DataCollator:
             )
 
         labels = inputs.clone()
+        device = labels.device
         # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-        probability_matrix = torch.full(labels.shape, self.mlm_probability)
-        special_tokens_mask = [
-            self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-        ]
-        probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
+        probability_matrix = torch.full(labels.shape, self.mlm_probability, device=device)
+        special_tokens_mask = special_tokens_lookup(self.tokenizer).to(device)[labels]
+        probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
         if self.tokenizer._pad_token is not None:
             padding_mask = labels.eq(self.tokenizer.pad_token_id)
             probability_matrix.masked_fill_(padding_mask, value=0.0)
-        masked_indices = torch.bernoulli(probability_matrix).bool()
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
         labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=device), generator=generator).bool() & masked_indices
         inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
+        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5, device=device), generator=generator).bool() & masked_indices & ~indices_replaced
+        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long, device=device, generator=generator)
         inputs[indices_random] = random_words[indices_random]
 
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
         return inputs, labels
 
-    def mask_kg(self, inputs: torch.Tensor, entity_mask = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    def mask_kg(self, inputs: torch.Tensor, entity_mask = None, generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
@@ -170,20 +452,21 @@ class NodeClassification_DataCollator:
                 "This tokenizer does not have a mask token which is necessary for masked language modeling. Remove the --mlm flag if you want to use this tokenizer."
             )
         # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-        probability_matrix = torch.full(inputs.shape, self.mlm_probability)
+        device = inputs.device
+        probability_matrix = torch.full(inputs.shape, self.mlm_probability, device=device)
         if entity_mask is not None:
             ignore_masking = ~(entity_mask.detach().clone().bool())
             probability_matrix.masked_fill_(ignore_masking, value=0.0)
         padding_mask = ~inputs.eq(self.kg_special_token_ids['PAD'])
-        masked_indices = torch.bernoulli(probability_matrix).bool()
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(inputs.shape, 0.8)).bool() & masked_indices
+        indices_replaced = torch.bernoulli(torch.full(inputs.shape, 0.8, device=device), generator=generator).bool() & masked_indices
         inputs[indices_replaced] = self.kg_special_token_ids['MASK']
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(inputs.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_nodes = torch.randint(len(self.kg_special_token_ids),self.kg_size, inputs.shape, dtype=torch.long)
+        indices_random = torch.bernoulli(torch.full(inputs.shape, 0.5, device=device), generator=generator).bool() & masked_indices & ~indices_replaced
+        random_nodes = torch.randint(len(self.kg_special_token_ids),self.kg_size, inputs.shape, dtype=torch.long, device=device, generator=generator)
         inputs[indices_random] = random_nodes[indices_random]
 
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
@@ -205,12 +488,20 @@ class NegativeSampling_DataCollator:
     tokenizer: PreTrainedTokenizerBase
     kg_special_token_ids: dict
     n_negatives: int = 1
+    virtual_negatives: bool = False
+    dynamic_padding: bool = False
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
     prediction: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_padding(batch, self.kg_special_token_ids['PAD'])
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
         batch_size = len(features)
 
         if not self.prediction:
@@ -221,49 +512,27 @@ class NegativeSampling_DataCollator:
             # else:
             batch['label'] = torch.cat([torch.ones(batch_size, dtype=torch.long),
                                              torch.zeros(batch_size*self.n_negatives, dtype=torch.long)],dim=0)
+            if self.virtual_negatives and (self.n_negatives > 0):
+                batch.update(negative_pair_indices(batch_size, self.n_negatives))
         else:
             return NotImplementedError("Not Support Yet")
 
         return batch
 
-    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
-
-        for k, v in first.items():
-            if ('label' in k) or ('rc' in k):
-                continue
-            if (v is not None) and (not isinstance(v, str)):
-                if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                else:
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-
-                    if (k == "kg_input_ids"):
-                        batch['kg_padding_mask'] = ~batch[k].detach().clone().eq(self.kg_special_token_ids['PAD'])
-
-                # if not NCE:
-                if 'kg' not in k:
-                    batch_size = len(features)
-                    batch[k] = torch.cat([batch[k].detach().clone()[(torch.arange(batch_size) + idx) % batch_size] for idx in range(self.n_negatives+1)],dim=0)
-                else:
-                    batch[k] = torch.cat([batch[k].detach().clone() for _ in range(self.n_negatives + 1)],dim=0)
-                    if (k == "kg_input_ids"):
-                        batch['kg_padding_mask'] = torch.cat([batch['kg_padding_mask'].detach().clone() for _ in range(self.n_negatives + 1)],dim=0)
+    def __post_init__(self):
+        self.tensorizer = BatchTensorizer(skip=('label', 'rc'), kg_pad_id=self.kg_special_token_ids['PAD'], pin_memory=self.pin_memory)
 
+    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
+        batch = self.tensorizer(features)
+        if self.virtual_negatives:
+            return batch
+        # if not NCE:
+        batch_size = len(features)
+        for k, v in batch.items():
+            if 'kg' not in k:
+                batch[k] = torch.cat([v[(torch.arange(batch_size) + idx) % batch_size] for idx in range(self.n_negatives+1)],dim=0)
+            else:
+                batch[k] = torch.cat([v for _ in range(self.n_negatives + 1)],dim=0)
         return batch
 
 @dataclass
@@ -276,29 +545,27 @@ class UniLM_DataCollator:
     # kg_size: int
     mlm: bool = True
     mlm_probability: float = 0.15
+    dynamic_padding: bool = False
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
+    device_masking: bool = False
+    # Seed of the per batch generators (see `BatchRNG`), the default generator if None
+    seed: Optional[int] = None
     prediction: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_padding(batch, self.kg_special_token_ids['PAD'])
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
 
         if not self.prediction:
-            # Text Part
-            masked_texts, lm_label = self.mask_tokens_with_sep(batch['lang_input_ids'])
-            casual_mask = self.make_lang_attention_mask(batch['lang_attention_mask'])
-            batch['lang_input_ids'] = masked_texts
-            batch['lm_label'] = lm_label
-            batch['lang_attention_mask'] = casual_mask
-                    
-            # Graph Part
-            _, kg_label_mask, kg_padding_mask = self.make_kg_padding_mask(batch['kg_input_ids']) # only need padding_mask
-            batch['kg_padding_mask'] = kg_padding_mask
-            batch['kg_label_mask'] = kg_label_mask
-            batch['kg_label'] = None
-            
-            # check padding by using assert
-            # self._assert_padding(batch)
+            # With `device_masking`, the LightningModule masks the batch once moved to the device
+            if not self.device_masking:
+                batch = self.mask_batch(batch, self.rng.generator() if self.rng is not None else None)
         else:
             '''
             for decoding (generation)
@@ -308,43 +575,41 @@ class UniLM_DataCollator:
             batch['kg_input_ids'] = batch['kg_input_ids']
             batch['kg_label'] = None
             
-            casual_mask = self.make_lang_attention_mask(batch['lang_attention_mask'])
-            batch['lang_attention_mask'] = casual_mask
             _, kg_label_mask, kg_padding_mask = self.make_kg_padding_mask(batch['kg_input_ids']) # only need padding_mask
             batch['kg_padding_mask'] = kg_padding_mask
 
         return batch
 
-    def _tensorize_batch(self, features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
+    def mask_batch(self, batch: Dict[str, Any], generator: Optional[torch.Generator] = None) -> Dict[str, Any]:
+        """
+        Masked LM corruption of a tensorized batch, on the device of the batch and drawn from ``generator`` (the default
+        generator if None).
+        """
+        # Text Part
+        # `lang_attention_mask` stays a padding mask, the causal mask is made on the device by GTXForGeneration
+        masked_texts, lm_label = self.mask_tokens_with_sep(batch['lang_input_ids'], generator=generator)
+        batch['lang_input_ids'] = masked_texts
+        batch['lm_label'] = lm_label
+
+        # Graph Part
+        _, kg_label_mask, kg_padding_mask = self.make_kg_padding_mask(batch['kg_input_ids']) # only need padding_mask
+        batch['kg_padding_mask'] = kg_padding_mask
+        batch['kg_label_mask'] = kg_label_mask
+        batch['kg_label'] = None
+
+        # check padding by using assert
+        # self._assert_padding(batch)
+        return batch
 
-        for k, v in first.items():
-            if 'rc' in k:
-                # we don't need to use graph part
-                continue
-            if v is not None:
-                if (k == "kg_attention_mask") and not isinstance(v, str):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                elif not isinstance(v, str):
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:  
-                        batch[k] = torch.tensor([f[k] for f in features])
+    def __post_init__(self):
+        self.rng = BatchRNG(self.seed) if self.seed is not None else None
+        # we don't need to use graph part
+        self.tensorizer = BatchTensorizer(skip=('rc',), pin_memory=self.pin_memory)
 
-        return batch
+    def _tensorize_batch(self, features: List[Dict]) -> Dict[str, torch.Tensor]:
+        return self.tensorizer(features)
 
-    def mask_tokens_with_sep(self, inputs: torch.Tensor, special_tokens_mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    def mask_tokens_with_sep(self, inputs: torch.Tensor, special_tokens_mask: Optional[torch.Tensor] = None, generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
@@ -355,13 +620,11 @@ class UniLM_DataCollator:
             )
 
         labels = inputs.clone()
+        device = labels.device
         # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-        probability_matrix = torch.full(labels.shape, self.mlm_probability)
+        probability_matrix = torch.full(labels.shape, self.mlm_probability, device=device)
         if special_tokens_mask is None:
-            special_tokens_mask = [
-                self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-            ]
-            special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
+            special_tokens_mask = special_tokens_lookup(self.tokenizer).to(device)[labels]
         else:
             special_tokens_mask = special_tokens_mask.bool()
 
@@ -374,17 +637,17 @@ class UniLM_DataCollator:
         if self.tokenizer._sep_token is not None:
             sep_mask = labels.eq(self.tokenizer.sep_token_id)
             probability_matrix.masked_fill_(sep_mask, value=0.5) 
-        masked_indices = torch.bernoulli(probability_matrix).bool()
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
 
         labels[~masked_indices] = -100  # We only compute loss on masked tokens
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=device), generator=generator).bool() & masked_indices
         inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
 
         # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
+        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5, device=device), generator=generator).bool() & masked_indices & ~indices_replaced
+        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long, device=device, generator=generator)
         inputs[indices_random] = random_words[indices_random]
 
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
@@ -396,17 +659,10 @@ class UniLM_DataCollator:
                 "This tokenizer does not have a mask token which is necessary for padding mask in the graph part."
             )
         padding_mask = ~inputs.eq(self.kg_special_token_ids['PAD'])
-        masked_indices = torch.zeros(inputs.shape, dtype=torch.float)
+        masked_indices = torch.zeros(inputs.shape, dtype=torch.float, device=inputs.device)
         
         return inputs, masked_indices, padding_mask.float()
 
-    def make_lang_attention_mask(self, attention_mask: torch.Tensor) -> torch.Tensor:
-        batch_size, seq_length = attention_mask.shape
-        seq_ids = torch.arange(seq_length)
-        causal_mask = seq_ids[None, None, :].repeat(batch_size, seq_length, 1) <= seq_ids[None, :, None]
-        causal_mask = attention_mask.unsqueeze(2) * causal_mask
-        return causal_mask
-
     def _assert_padding(self, batch):
         '''
         assert for grpah part
@@ -442,12 +698,19 @@ class AdmLvlPred_DataCollator:
     tokenizer: PreTrainedTokenizerBase
     kg_special_token_ids: dict
     num_labels: int
+    dynamic_padding: bool = False
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
     prediction: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_padding(batch, self.kg_special_token_ids['PAD'])
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
         batch_size = len(features)
 
         # else:
@@ -455,35 +718,13 @@ class AdmLvlPred_DataCollator:
 
         return batch
 
-    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
-
-        for k, v in first.items():
-            if (v is not None) and (not isinstance(v, str)):
-                if (k == 'label'):
-                    batch[k] = torch.stack([torch.zeros(self.num_labels).index_fill_(0,torch.LongTensor(f[k]),1) for f in features])
-                    continue
-                if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                else:
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                    if (k == "kg_input_ids"):
-                        batch['kg_padding_mask'] = ~batch[k].detach().clone().eq(self.kg_special_token_ids['PAD'])
+    def __post_init__(self):
+        self.tensorizer = BatchTensorizer(drop=('label',), kg_pad_id=self.kg_special_token_ids['PAD'], pin_memory=self.pin_memory)
 
+    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
+        batch = self.tensorizer(features)
+        if features[0].get('label') is not None:
+            batch['label'] = multi_hot([f['label'] for f in features], self.num_labels)
         return batch
 
 @dataclass
@@ -496,48 +737,28 @@ class TemporalPred_DataCollator:
     tokenizer: PreTrainedTokenizerBase
     kg_special_token_ids: dict
     num_labels: int
+    dynamic_padding: bool = False
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
     prediction: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        if self.dynamic_padding:
+            batch = trim_padding(batch, self.kg_special_token_ids['PAD'])
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
 
         return batch
 
-    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
-
-        for k, v in first.items():
-            if (v is not None) and (not isinstance(v, str)):
-                if (k == 'label'):
-                    if self.num_labels>1:
-                        batch[k] = torch.stack([torch.zeros(self.num_labels).index_fill_(0,torch.LongTensor(f[k]),1) for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                else:
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-
-                    if (k == "kg_input_ids"):
-                        batch['kg_padding_mask'] = ~batch[k].detach().clone().eq(self.kg_special_token_ids['PAD'])
+    def __post_init__(self):
+        # Labels come as they are used: a scalar (ReAdm, Death*) or a multi-hot vector over `num_labels` (NextDx)
+        self.tensorizer = BatchTensorizer(kg_pad_id=self.kg_special_token_ids['PAD'], pin_memory=self.pin_memory)
 
-        return batch
+    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
+        return self.tensorizer(features)
 
 @dataclass
 class ErrorDetection_DataCollator:
@@ -552,13 +773,23 @@ class ErrorDetection_DataCollator:
     kg_size: int
     id2desc: dict
     label_domain: str
-    # corruption_probability: float = 0.1
+    # Samples without a precomputed `label` (clean dbs) are corrupted on the fly from this table
+    corruption_table: Optional[CorruptionTable] = None
+    corruption_probability: float = 0.25
+    # Seed of the per batch generators (see `BatchRNG`), the default generator if None
+    seed: Optional[int] = None
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
     prediction: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
+        if ('label' not in batch) and (self.corruption_table is not None):
+            batch['kg_input_ids'], batch['label'] = corrupt_nodes(batch['kg_input_ids'], self.corruption_table, self.corruption_probability, self.rng.generator() if self.rng is not None else None)
         # if 'graph' == self.label_domain:
         #     batch = self.kg_corruption(batch)
         # elif 'text' == self.label_domain:
@@ -575,36 +806,12 @@ class ErrorDetection_DataCollator:
 
         return batch
 
-    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
+    def __post_init__(self):
+        self.rng = BatchRNG(self.seed) if self.seed is not None else None
+        self.tensorizer = BatchTensorizer(skip=('rc', 'label_mask'), kg_pad_id=self.kg_special_token_ids['PAD'], pin_memory=self.pin_memory)
 
-        for k, v in first.items():
-            if ('rc' in k) or ('label_mask' in k):
-                continue
-            if (v is not None) and not isinstance(v,str):
-                if k == "kg_attention_mask":
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                else:
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-
-                    if (k == "kg_input_ids"):
-                        batch['kg_padding_mask'] = ~batch[k].detach().clone().eq(self.kg_special_token_ids['PAD'])
-
-        return batch
+    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
+        return self.tensorizer(features)
 
     # def tensorize_ext_know(self, batch):
     #     inputs = batch['kg_input_ids']
@@ -925,42 +1132,21 @@ class Evaluation_DataCollator:
     tokenizer: PreTrainedTokenizerBase
     task : str
     kg_special_token_ids: dict
+    # Edge lists (`kg_edge_index`) instead of dense adjacency masks, for sparse message passing
+    sparse_adjacency: bool = False
+    pin_memory: bool = False
 
     def __call__(self,features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
         if not isinstance(features[0], (dict, BatchEncoding)):
             features = [vars(f) for f in features]
         batch = self._tensorize_batch(features)
+        batch = adjacency_edge_index(batch, features) if self.sparse_adjacency else densify_adjacency(batch, features)
         batch_size = len(features)
 
         return batch
 
-    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
-        # In this function we'll make the assumption that all `features` in the batch
-        # have the same attributes.
-        # So we will look at the first element as a proxy for what attributes exist
-        # on the whole batch.
-        first = features[0]
-        batch = {}
+    def __post_init__(self):
+        self.tensorizer = BatchTensorizer(skip=('label', 'rc'), kg_pad_id=self.kg_special_token_ids['PAD'], pin_memory=self.pin_memory)
 
-        for k, v in first.items():
-            if ('label' in k) or ('rc' in k):
-                continue
-            if (v is not None) and (not isinstance(v, str)):
-                if (k == "kg_attention_mask"):
-                    if isinstance(v, torch.Tensor):
-                        if (len(v.shape) == 3):
-                            batch[k] = torch.stack([f[k] for f in features]).permute(0,3,1,2)
-                        else:
-                            batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-                else:
-                    if isinstance(v, torch.Tensor):
-                        batch[k] = torch.stack([f[k] for f in features])
-                    else:
-                        batch[k] = torch.tensor([f[k] for f in features])
-
-                    if (k == "kg_input_ids"):
-                        batch['kg_padding_mask'] = ~batch[k].detach().clone().eq(self.kg_special_token_ids['PAD'])
-
-        return batch
\ No newline at end of file
+    def _tensorize_batch(self,features: List[Dict]) -> Dict[str, torch.Tensor]:
+        return self.tensorizer(features)
@@ -1,18 +1,25 @@
 import random
 import json
+import math
+import hashlib
+import itertools
+import dataclasses
 import gc
+import multiprocessing
 import os
 import logging
 import pickle
+import shutil
 import time
 import torch
 from filelock import FileLock
 from dataclasses import dataclass
-from typing import Any, Callable, Dict, List, NewType, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NewType, Optional, Tuple, Union
+from glob import glob
 from tqdm import tqdm
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, ConcatDataset, IterableDataset
 import numpy as np
 from itertools import chain
 
@@ -20,11 +27,94 @@ from transformers.tokenization_utils_base import BatchEncoding, PaddingStrategy,
 from transformers.tokenization_utils import PreTrainedTokenizer
 
 from .parameters import DataTrainingArguments
+from .feature_store import FeatureStore, adjacency_edges, is_feature_store, narrowest_int_dtype
+from .sharded_db import EDGES_SUFFIX, SHARDED_DB_DIR, INDEX_FILE, ShardedDB, is_sharded_db
+from .samplers import trailing_lengths
 
 from utils.notifier import logging, log_formatter
 notifier = logging.getLogger(__name__)
 notifier.addHandler(log_formatter())
 
+"""
+Feature cache
+"""
+# Bump when the layout of cached features changes
+FEATURE_CACHE_VERSION = 5
+
+def file_digest(path, chunk_size=1<<24):
+    """
+    Content hash of `path`. The digest is memoized in a sidecar file and only recomputed when the size or mtime changes.
+    """
+    stat = os.stat(path)
+    memo_path = path + ".sha1"
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+        if (memo['size'] == stat.st_size) and (memo['mtime_ns'] == stat.st_mtime_ns):
+            return memo['sha1']
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+    try:
+        with open(memo_path, 'w') as f:
+            json.dump({'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'sha1':digest}, f)
+    except OSError:
+        notifier.warning(f"Cannot write digest memo {memo_path}")
+    return digest
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hash of everything that decides the output ids of `tokenizer` (class, vocab, normalization, special tokens).
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(tokenizer.__class__.__name__.encode())
+    if getattr(tokenizer, 'is_fast', False):
+        # Padding/truncation are per-call states of the backend, not part of the tokenizer itself
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop('padding', None)
+        backend.pop('truncation', None)
+        sha1.update(json.dumps(backend, sort_keys=True).encode())
+    else:
+        sha1.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+        sha1.update(json.dumps(tokenizer.init_kwargs, sort_keys=True, default=str).encode())
+    sha1.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return sha1.hexdigest()
+
+def db_source_path(file_path):
+    """
+    File that identifies the raw db of a split: the index of its memory-mapped shards if converted, else the pickle.
+    """
+    sharded_path = os.path.join(file_path, SHARDED_DB_DIR)
+    if is_sharded_db(sharded_path):
+        return os.path.join(sharded_path, INDEX_FILE)
+    return os.path.join(file_path, 'db')
+
+def load_db(file_path):
+    """
+    Loads the raw db of a split as a dict of per-sample sequences. Converted splits (see ``utils.sharded_db``) are
+    memory-mapped instead of unpickled, their adjacency masks read as the stored edge lists (``mask_edges``).
+    """
+    sharded_path = os.path.join(file_path, SHARDED_DB_DIR)
+    if is_sharded_db(sharded_path):
+        notifier.warning(f"Memory-mapping sharded db at {sharded_path}")
+        return ShardedDB(sharded_path).as_dict(edges=True)
+    return torch.load(os.path.join(file_path,'db'))
+
+def feature_cache_key(db_path, tokenizer, block_size, token_type_vocab, knowmix, gcn, ext_max_len):
+    key = {
+        'version': FEATURE_CACHE_VERSION,
+        'db': file_digest(db_path),
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'block_size': block_size,
+        'token_type_vocab': token_type_vocab,
+        'knowmix': knowmix,
+        'gcn': bool(gcn),
+        'ext_max_len': ext_max_len,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
 """
 Define Dataset & Load
 """
@@ -48,8 +138,10 @@ class InputFeatures:
     kg_ext_input_ids: Optional[List[List[int]]] = None
     kg_ext_sum_input_ids: Optional[List[List[int]]] = None
     kg_langinit_input_ids: Optional[List[List[int]]] = None
+    kg_langinit_index: Optional[List[int]] = None
     lang_attention_mask: Optional[List[int]] = None
     kg_attention_mask: Optional[List[int]] = None
+    kg_adjacency: Optional[List[List[int]]] = None
     kg_ext_attention_mask: Optional[List[List[int]]] = None
     kg_ext_sum_attention_mask: Optional[List[List[int]]] = None
     kg_langinit_attention_mask: Optional[List[List[int]]] = None
@@ -63,129 +155,536 @@ class InputFeatures:
         """Serializes this instance to a JSON string."""
         return json.dumps(dataclasses.asdict(self)) + "\n"
 
-class HeadOnlyDataset(Dataset):
+def ext_max_len_of(file_path):
     """
-    This will be superseded by a framework-agnostic approach soon.
+    Length of the external knowledge tokens, set by the DB type in the path of a split.
     """
-    def __init__(self, tokenizer: PreTrainedTokenizer, file_path: str, block_size: int, token_type_vocab: dict = None, knowmix: str = "", gcn: bool = None, task: int=None,):
-        assert os.path.isdir(file_path), f"Input file path {file_path} not found"
-        self.token_type_vocab = token_type_vocab
-        self.file_path = file_path
+    if 'px_' in file_path:
+        return 2048
+    elif 'dx,prx_' in file_path:
+        return 768
+    else:
+        return None
+
+def iter_samples(db):
+    """
+    Yields the samples of a raw db (field -> per-sample sequence) as dicts of their fields.
+    """
+    keys = list(db)
+    for values in zip(*[db[k] for k in keys]):
+        yield dict(zip(keys, values))
+
+class LiteralTable:
+    """
+    Token ids of every unique KG node literal (``init`` knowmix), tokenized once for the whole split. Samples only keep
+    the row of each of their nodes (``kg_langinit_index``), which ``expand`` turns back into ``kg_langinit_input_ids``
+    and ``kg_langinit_attention_mask``.
+    """
+    def __init__(self, max_length: int = 64):
+        self.max_length = max_length
+        self.rows = dict()
+        self.input_ids = None
+        self.attention_mask = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        # Spare capacity is not worth pickling
+        state = self.__dict__.copy()
+        if self.input_ids is not None:
+            state['input_ids'] = self.input_ids[:len(self)].copy()
+            state['attention_mask'] = self.attention_mask[:len(self)].copy()
+        return state
+
+    def _reserve(self, size, dtype):
+        capacity = 0 if self.input_ids is None else len(self.input_ids)
+        if size <= capacity:
+            return
+        capacity = max(size, 2*capacity, 1024)
+        input_ids = np.zeros((capacity, self.max_length), dtype=dtype if self.input_ids is None else self.input_ids.dtype)
+        attention_mask = np.zeros((capacity, self.max_length), dtype=np.uint8)
+        if self.input_ids is not None:
+            input_ids[:len(self)] = self.input_ids[:len(self)]
+            attention_mask[:len(self)] = self.attention_mask[:len(self)]
+        self.input_ids, self.attention_mask = input_ids, attention_mask
+
+    def add(self, literals: Iterable[str], tokenizer: PreTrainedTokenizer):
+        """
+        Tokenizes the literals which are not in the table yet, in a single call of the tokenizer.
+        """
+        new_literals = list(dict.fromkeys(literal for literal in literals if literal not in self.rows))
+        if not new_literals:
+            return
+        encoding = tokenizer(new_literals, add_special_tokens=False, padding='max_length', max_length=self.max_length, return_token_type_ids=False)
+        overflows = sum(len(input_ids) > self.max_length for input_ids in encoding['input_ids'])
+        if overflows:
+            notifier.warning(f"Truncating {overflows} node literals longer than {self.max_length} tokens")
+        start = len(self)
+        self._reserve(start + len(new_literals), narrowest_int_dtype(0, len(tokenizer)))
+        self.input_ids[start:start+len(new_literals)] = [input_ids[:self.max_length] for input_ids in encoding['input_ids']]
+        self.attention_mask[start:start+len(new_literals)] = [attention_mask[:self.max_length] for attention_mask in encoding['attention_mask']]
+        self.rows.update({literal:start+idx for idx, literal in enumerate(new_literals)})
+
+    def save(self, prefix: str):
+        """
+        Writes the token ids to ``{prefix}.input_ids.npy`` and ``{prefix}.attention_mask.npy``, and the literals (in
+        row order) to ``{prefix}.json``.
+        """
+        np.save(prefix + ".input_ids.npy", self.input_ids[:len(self)] if self.input_ids is not None else np.zeros((0, self.max_length), dtype=np.int64))
+        np.save(prefix + ".attention_mask.npy", self.attention_mask[:len(self)] if self.attention_mask is not None else np.zeros((0, self.max_length), dtype=np.uint8))
+        with open(prefix + ".json", 'w') as f:
+            json.dump({'max_length': self.max_length, 'literals': sorted(self.rows, key=self.rows.get)}, f)
+
+    @classmethod
+    def load(cls, prefix: str, mmap_mode: Optional[str] = 'r'):
+        with open(prefix + ".json") as f:
+            meta = json.load(f)
+        table = cls(meta['max_length'])
+        table.rows = {literal:idx for idx, literal in enumerate(meta['literals'])}
+        table.input_ids = np.load(prefix + ".input_ids.npy", mmap_mode=mmap_mode)
+        table.attention_mask = np.load(prefix + ".attention_mask.npy", mmap_mode=mmap_mode)
+        return table
+
+    def lookup(self, literals: Iterable[str]) -> np.ndarray:
+        return np.array([self.rows[literal] for literal in literals], dtype=np.int64)
+
+    def expand(self, features: Dict[str, Any]) -> Dict[str, Any]:
+        expanded = dict()
+        for k, v in features.items():
+            if k == 'kg_langinit_index':
+                expanded['kg_langinit_input_ids'] = self.input_ids[np.asarray(v)]
+                expanded['kg_langinit_attention_mask'] = self.attention_mask[np.asarray(v)]
+            else:
+                expanded[k] = v
+        return expanded
+
+class Featurizer:
+    """
+    Turns samples of a raw db into the inputs of ``InputFeatures``. The notes and knowledge of a batch of samples are
+    tokenized by a single call of the (fast) tokenizer in ``tokenize_batch``, then merged with the graph fields of each
+    sample in ``assemble``.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizer, block_size: int, token_type_vocab: dict = None, knowmix: str = "", gcn: bool = None, ext_max_len: int = None):
         self.tokenizer = tokenizer
-        self.task = task
+        self.block_size = block_size
+        self.token_type_vocab = token_type_vocab
         self.knowmix = knowmix
-        self.features = list()
-        notifier.warning("Creating features from dataset file at %s", file_path)
-        # Loading preprocessed data
-        self.batch_encoding = torch.load(os.path.join(file_path,'db'))
-        if not gcn:
-            self.batch_encoding.pop("mask")
+        self.gcn = gcn
+        self.ext_max_len = ext_max_len
+        self.literal_table = LiteralTable(max_length=64) if ("init" in knowmix) and ("linearize" not in knowmix) else None
+
+    def required_fields(self, fields):
+        """
+        Fields of the raw db which are read for the features.
+        """
+        return [k for k in fields if not ((k in ('mask', 'mask' + EDGES_SUFFIX)) and not self.gcn) and not ((k == 'knowledge') and not self.knowmix)]
+
+    def log_options(self):
+        if not self.gcn:
             notifier.critical("Turn off GAT")
         else:
             notifier.critical("Turn on GAT")
-        if not knowmix:
-            self.batch_encoding.pop("knowledge")
+        if not self.knowmix:
             notifier.critical("Turn off fusion & initialization")
         else:
-            if "init" in knowmix:
+            if "init" in self.knowmix:
                 notifier.critical("Turn on word initialization of KG embedding")
-            if "summary" in knowmix:
+            if "summary" in self.knowmix:
                 notifier.critical("Turn on the admission level fusion")
-            if "abs" in knowmix:
+            if "abs" in self.knowmix:
                 notifier.critical("Turn on the abstract level fusion")
-        # # Only for debug
-        # self.batch_encoding  = {k:v[:10] for k,v in self.batch_encoding.items()}
-        # # Only for debug
-        self.batch_encoding['lang'] = dict()
-        for text in tqdm(self.batch_encoding['text']):
-            sections, notes = list(text.keys()), list(text.values())
-            sample = tokenizer(f' {tokenizer.sep_token} '.join([x.strip() for x in notes]) , add_special_tokens=True, padding='max_length', truncation=True, max_length=block_size, return_token_type_ids=False)
-            if token_type_vocab:
-                sample['token_type_ids'] = self.generate_type_ids(sections, sample['input_ids'])
-            for k, v in sample.items():
-                if k not in self.batch_encoding['lang']:
-                    self.batch_encoding['lang'][k] = list()
-                self.batch_encoding['lang'][k].append(v)
-
-        self.batch2feature()
-
-        del self.batch_encoding
-        gc.collect()
 
     def generate_type_ids(self, sections, tokens):
-        idx = 0
-        type_ids = list()
-        for token in tokens:
-            type_ids.append(self.token_type_vocab[sections[idx]])
-            if token == self.tokenizer.sep_token_id:
-                idx += 1
-                if idx >= len(sections):
-                    idx = len(sections)-1
-        return type_ids
-
-    def batch2feature(self): 
+        # Tokens up to each [SEP] belong to the next section, the ones after the last section keep its type
+        tokens = np.asarray(tokens)
+        is_sep = (tokens == self.tokenizer.sep_token_id)
+        section_idx = np.minimum(np.cumsum(is_sep) - is_sep, len(sections)-1)
+        return np.array([self.token_type_vocab[section] for section in sections])[section_idx].tolist()
+
+    def _tokenize_grouped(self, groups, **kwargs):
+        """
+        Tokenizes the texts of every group in one call and splits the encodings back per group.
+        """
+        flat = [text for group in groups for text in group]
+        encoding = self.tokenizer(flat, **kwargs) if flat else {'input_ids':[], 'attention_mask':[]}
+        bounds = np.cumsum([0] + [len(group) for group in groups])
+        return [{k:v[start:end] for k, v in encoding.items()} for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def tokenizer_inputs(self, sample: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Fields of a sample needed by ``tokenize_batch`` (the only ones shipped to tokenization workers).
+        """
+        return {k:sample[k] for k in ('text', 'knowledge', 'mask') if (k in sample) and ((k != 'mask') or ("abs" in self.knowmix))}
+
+    def tokenize_batch(self, samples: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        tokenizer = self.tokenizer
+        tokenized = [dict() for _ in samples]
+
+        notes = [f' {tokenizer.sep_token} '.join([x.strip() for x in sample['text'].values()]) for sample in samples]
+        lang = tokenizer(notes, add_special_tokens=True, padding='max_length', truncation=True, max_length=self.block_size, return_token_type_ids=False)
+        for k, v in lang.items():
+            for t, x in zip(tokenized, v):
+                t['lang_'+k] = x
+        if self.token_type_vocab:
+            for t, sample in zip(tokenized, samples):
+                t['token_type_ids'] = self.generate_type_ids(list(sample['text'].keys()), t['lang_input_ids'])
+
+        if (not samples) or ('knowledge' not in samples[0]):
+            return tokenized
         # Set External Token Length
-        if 'knowledge' in self.batch_encoding:
-            if 'px_' in self.file_path:
-                ext_max_len = 2048
-            elif 'dx,prx_' in self.file_path:
-                ext_max_len = 768
-            else:
-                raise ValueError ("Cannot find DB type in file path")
-        for idx in tqdm(range(len(self.batch_encoding['input']))):
-        # for idx in tqdm(range(128)):
-            inputs = dict([('lang_'+k,self.batch_encoding['lang'][k][idx]) if 'token_type' not in k else (k, self.batch_encoding['lang'][k][idx]) for k in self.batch_encoding['lang']])
-            inputs['kg_input_ids'] = self.batch_encoding['input'][idx]
-            if 'mask' in self.batch_encoding:
-                inputs['kg_attention_mask'] = self.batch_encoding['mask'][idx]
-            if 'label' in self.batch_encoding:
-                if 'label_mask' in self.batch_encoding:
-                    inputs['kg_label'] = self.batch_encoding['label'][idx]
-                    inputs['kg_label_mask'] = self.batch_encoding['label_mask'][idx]
-                else:  
-                    inputs['label'] = self.batch_encoding['label'][idx]
-            if 'rc_index' in self.batch_encoding:
-                inputs['rc_indeces'] = self.batch_encoding['rc_index'][idx]
-            if 'knowledge' in self.batch_encoding:
-                if "abs" in self.knowmix:
-                    abs_indices = [x for _idx, x in enumerate(self.batch_encoding['knowledge'][idx]) if (_idx>1) and not x]
-                    processed_knowledge = list()
-                    for node_idx in range(len(self.batch_encoding['knowledge'][idx])):
-                        if node_idx in abs_indices:
-                            processed_knowledge.append(" ".join([_s for _idx, _mask, _s in enumerate(zip(inputs['kg_attention_mask'][node_idx],self.batch_encoding['knowledge'][idx])) if (_idx>1) and (_mask!=0)]).strip())
-                        else:
-                            processed_knowledge.append("")
-                    tokenized_knowledge = self.tokenizer(processed_knowledge, add_special_tokens=False, padding='max_length', max_length=64, return_token_type_ids=False)
-                    inputs['kg_ext_input_ids'] = tokenized_knowledge['input_ids']
-                    inputs['kg_ext_attention_mask'] = tokenized_knowledge['attention_mask']
-                if "init" in self.knowmix:
-                    if "linearize" in self.knowmix:
-                        tokenized_init = self.tokenizer((" ".join(self.batch_encoding['knowledge'][idx])).strip(), add_special_tokens=True, padding='max_length', max_length=ext_max_len, return_token_type_ids=False)
-                        inputs['kg_input_ids'] = tokenized_init['input_ids']
-                        inputs['kg_attention_mask'] = tokenized_init['attention_mask']
-                        if 'rc_indeces' in inputs:
-                            inputs.pop('rc_indeces')
-                        if 'kg_label' in inputs:
-                            inputs.pop('kg_label')
-                        if 'kg_label_mask' in inputs:
-                            inputs.pop('kg_label_mask')
+        if self.ext_max_len is None:
+            raise ValueError ("Cannot find DB type in file path")
+        ext_max_len = self.ext_max_len
+        knowledges = [list(sample['knowledge']) for sample in samples]
+        if "abs" in self.knowmix:
+            processed_knowledges = list()
+            for sample, knowledge in zip(samples, knowledges):
+                abs_indices = [x for _idx, x in enumerate(knowledge) if (_idx>1) and not x]
+                processed_knowledge = list()
+                for node_idx in range(len(knowledge)):
+                    if node_idx in abs_indices:
+                        processed_knowledge.append(" ".join([_s for _idx, _mask, _s in enumerate(zip(sample['mask'][node_idx],knowledge)) if (_idx>1) and (_mask!=0)]).strip())
                     else:
-                        tokenized_init = self.tokenizer(self.batch_encoding['knowledge'][idx], add_special_tokens=False, padding='max_length', max_length=64, return_token_type_ids=False)
-                        inputs['kg_langinit_input_ids'] = tokenized_init['input_ids']
-                        inputs['kg_langinit_attention_mask'] = tokenized_init['attention_mask']
-                if "summary" in self.knowmix:
-                    summarized_knowledge = self.tokenizer((" ".join(self.batch_encoding['knowledge'][idx])).strip(), add_special_tokens=False, padding='max_length', max_length=ext_max_len, return_token_type_ids=False)
-                    inputs['kg_ext_sum_input_ids'] = summarized_knowledge['input_ids']
-                    inputs['kg_ext_sum_attention_mask'] = summarized_knowledge['attention_mask']
-                    
-            feature = InputFeatures(**inputs)
-            self.features.append(feature)
+                        processed_knowledge.append("")
+                processed_knowledges.append(processed_knowledge)
+            for t, encoding in zip(tokenized, self._tokenize_grouped(processed_knowledges, add_special_tokens=False, padding='max_length', max_length=64, return_token_type_ids=False)):
+                t['kg_ext_input_ids'] = encoding['input_ids']
+                t['kg_ext_attention_mask'] = encoding['attention_mask']
+        if "init" in self.knowmix:
+            if "linearize" in self.knowmix:
+                linearized = tokenizer([(" ".join(knowledge)).strip() for knowledge in knowledges], add_special_tokens=True, padding='max_length', max_length=ext_max_len, return_token_type_ids=False)
+                for t, input_ids, attention_mask in zip(tokenized, linearized['input_ids'], linearized['attention_mask']):
+                    t['kg_linearized_input_ids'] = input_ids
+                    t['kg_linearized_attention_mask'] = attention_mask
+        if "summary" in self.knowmix:
+            summarized = tokenizer([(" ".join(knowledge)).strip() for knowledge in knowledges], add_special_tokens=False, padding='max_length', max_length=ext_max_len, return_token_type_ids=False)
+            for t, input_ids, attention_mask in zip(tokenized, summarized['input_ids'], summarized['attention_mask']):
+                t['kg_ext_sum_input_ids'] = input_ids
+                t['kg_ext_sum_attention_mask'] = attention_mask
+        return tokenized
+
+    def assemble(self, sample: Dict[str, Any], tokenized: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = {k:v for k,v in tokenized.items() if k.startswith('lang_') or (k == 'token_type_ids')}
+        inputs['kg_input_ids'] = sample['input']
+        if 'mask' + EDGES_SUFFIX in sample:
+            # Edge lists of sharded dbs, as they are stored
+            inputs['kg_adjacency'] = sample['mask' + EDGES_SUFFIX]
+        elif 'mask' in sample:
+            # Binary adjacency masks are kept as edge lists, the collators build the dense mask of each batch
+            edges = adjacency_edges(sample['mask'])
+            if edges is not None:
+                inputs['kg_adjacency'] = edges
+            else:
+                inputs['kg_attention_mask'] = sample['mask']
+        if 'label' in sample:
+            if 'label_mask' in sample:
+                inputs['kg_label'] = sample['label']
+                inputs['kg_label_mask'] = sample['label_mask']
+            else:
+                inputs['label'] = sample['label']
+        if 'rc_index' in sample:
+            inputs['rc_indeces'] = sample['rc_index']
+        if 'kg_ext_input_ids' in tokenized:
+            inputs['kg_ext_input_ids'] = tokenized['kg_ext_input_ids']
+            inputs['kg_ext_attention_mask'] = tokenized['kg_ext_attention_mask']
+        if 'kg_linearized_input_ids' in tokenized:
+            inputs['kg_input_ids'] = tokenized['kg_linearized_input_ids']
+            inputs['kg_attention_mask'] = tokenized['kg_linearized_attention_mask']
+            for k in ('rc_indeces', 'kg_label', 'kg_label_mask', 'kg_adjacency'):
+                if k in inputs:
+                    inputs.pop(k)
+        if 'kg_langinit_index' in tokenized:
+            inputs['kg_langinit_index'] = tokenized['kg_langinit_index']
+        if 'kg_ext_sum_input_ids' in tokenized:
+            inputs['kg_ext_sum_input_ids'] = tokenized['kg_ext_sum_input_ids']
+            inputs['kg_ext_sum_attention_mask'] = tokenized['kg_ext_sum_attention_mask']
+        return inputs
+
+    def index_literals(self, samples: List[Dict[str, Any]], tokenized: List[Dict[str, Any]]):
+        """
+        Refers the node literals of each sample to rows of the literal table, tokenizing the unseen ones. Runs in the
+        main process so that a single table is shared by every batch.
+        """
+        if (self.literal_table is None) or (not samples) or ('knowledge' not in samples[0]):
+            return
+        self.literal_table.add(itertools.chain.from_iterable(sample['knowledge'] for sample in samples), self.tokenizer)
+        for sample, t in zip(samples, tokenized):
+            t['kg_langinit_index'] = self.literal_table.lookup(sample['knowledge'])
+
+    def featurize_batch(self, samples: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Features of ``samples``, referring to the literal table (see ``expand``).
+        """
+        samples = [{k:sample[k] for k in self.required_fields(sample)} for sample in samples]
+        tokenized = self.tokenize_batch([self.tokenizer_inputs(sample) for sample in samples])
+        self.index_literals(samples, tokenized)
+        return [self.assemble(sample, t) for sample, t in zip(samples, tokenized)]
+
+    def expand(self, features: Dict[str, Any]) -> Dict[str, Any]:
+        return self.literal_table.expand(features) if self.literal_table is not None else features
+
+    def __call__(self, sample: Dict[str, Any]) -> Dict[str, Any]:
+        return self.expand(self.featurize_batch([sample])[0])
+
+def _init_featurize_worker(featurizer):
+    global _worker_featurizer
+    _worker_featurizer = featurizer
+
+def _tokenize_in_worker(samples):
+    return _worker_featurizer.tokenize_batch(samples)
+
+def featurize(featurizer: Featurizer, samples: Iterable[Dict[str, Any]], batch_size: int = 1000, num_proc: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Featurizes ``samples`` in batches of ``batch_size``. With ``num_proc`` > 1, batches are tokenized by a pool of
+    processes (only their text and knowledge fields are sent over), while the graph fields stay in this process.
+    Features are yielded in the order of ``samples``.
+    """
+    samples = iter(samples)
+    batches = iter(lambda: [{k:sample[k] for k in featurizer.required_fields(sample)} for sample in itertools.islice(samples, batch_size)], [])
+    if (num_proc is None) or (num_proc <= 1):
+        for batch in batches:
+            yield from featurizer.featurize_batch(batch)
+        return
+    with multiprocessing.Pool(num_proc, initializer=_init_featurize_worker, initargs=(featurizer,)) as pool:
+        while True:
+            window = list(itertools.islice(batches, 2*num_proc))
+            if not window:
+                break
+            tokenized = pool.map(_tokenize_in_worker, [[featurizer.tokenizer_inputs(sample) for sample in batch] for batch in window])
+            for batch, batch_tokenized in zip(window, tokenized):
+                featurizer.index_literals(batch, batch_tokenized)
+                yield from (featurizer.assemble(sample, t) for sample, t in zip(batch, batch_tokenized))
+
+class HeadOnlyDataset(Dataset):
+    """
+    This will be superseded by a framework-agnostic approach soon.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizer, file_path: str, block_size: int, token_type_vocab: dict = None, knowmix: str = "", gcn: bool = None, task: int=None, overwrite_cache: bool = False, tokenization_batch_size: int = 1000, preprocessing_num_workers: Optional[int] = None):
+        assert os.path.isdir(file_path), f"Input file path {file_path} not found"
+        self.token_type_vocab = token_type_vocab
+        self.file_path = file_path
+        self.tokenizer = tokenizer
+        self.task = task
+        self.knowmix = knowmix
+        self.featurizer = Featurizer(tokenizer, block_size, token_type_vocab, knowmix, gcn, self.ext_max_len)
+        self.tokenization_batch_size = tokenization_batch_size
+        self.preprocessing_num_workers = preprocessing_num_workers
+        self.features = None
+
+        # Features are cached next to the `db` file, keyed by everything that changes the featurization. The cache is
+        # a directory of arrays which is memory-mapped, so DataLoader workers share its pages instead of copying them.
+        cache_key = feature_cache_key(db_source_path(file_path), tokenizer, block_size, token_type_vocab, knowmix, gcn, self.ext_max_len)
+        cached_features_dir = os.path.join(file_path, f"cached_features_{cache_key}")
+        lock_path = cached_features_dir + ".lock"
+        with FileLock(lock_path):
+            if not is_feature_store(cached_features_dir) or overwrite_cache:
+                notifier.warning("Creating features from dataset file at %s", file_path)
+                self.create_features()
+                start = time.time()
+                self.save_features(cached_features_dir)
+                notifier.warning(f"Saving features into cached directory {cached_features_dir} [took {time.time() - start:.3f} s]")
+                # Drop the in-memory copy for the memory-mapped one
+                self.features = None
+                gc.collect()
+            start = time.time()
+            self.load_features(cached_features_dir)
+            notifier.warning(f"Loading features from cached directory {cached_features_dir} [took {time.time() - start:.3f} s]")
+
+    def save_features(self, path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        # The index of the store is written last, so that an interrupted save is not mistaken for a cache
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        if self.featurizer.literal_table is not None:
+            self.featurizer.literal_table.save(os.path.join(tmp_path, 'literal_table'))
+        self.features.save(tmp_path)
+        os.rename(tmp_path, path)
+
+    def load_features(self, path):
+        self.features = FeatureStore.load(path)
+        if self.featurizer.literal_table is not None:
+            self.featurizer.literal_table = LiteralTable.load(os.path.join(path, 'literal_table'))
+
+    @property
+    def ext_max_len(self):
+        return ext_max_len_of(self.file_path)
+
+    def create_features(self):
+        # Loading preprocessed data
+        db = load_db(self.file_path)
+        self.featurizer.log_options()
+        db = {k:db[k] for k in self.featurizer.required_fields(db)}
+        samples = tqdm(iter_samples(db), total=len(db['input']))
+        self.features = FeatureStore.from_records(featurize(self.featurizer, samples, batch_size=self.tokenization_batch_size, num_proc=self.preprocessing_num_workers))
+        if self.featurizer.literal_table is not None:
+            num_nodes = len(self.features) * self.features.columns['kg_langinit_index'].values.shape[-1]
+            notifier.warning(f"Tokenized {len(self.featurizer.literal_table)} unique node literals for {num_nodes} nodes")
+        del db
+        gc.collect()
 
     def __len__(self):
         return len(self.features)
 
-    def __getitem__(self, i) -> InputFeatures:
-        return self.features[i]
+    def __getitem__(self, i) -> Dict[str, np.ndarray]:
+        return self.featurizer.expand(self.features[i])
+
+    def lengths(self, kg_pad_id: int = 0) -> np.ndarray:
+        """
+        ``(num_samples, 3)`` unpadded text length, graph size (tokens of the linearized graph) and summary length of
+        every sample, read from the feature columns without featurizing them.
+        """
+        columns = self.features.columns
+        lang = trailing_lengths(columns['lang_attention_mask'].values)
+        if 'linearize' in self.knowmix:
+            # Linearized graphs are padded with the text tokenizer's pad token
+            kg = trailing_lengths(columns['kg_attention_mask'].values)
+        else:
+            kg = trailing_lengths(columns['kg_input_ids'].values, pad_value=kg_pad_id)
+        summary = trailing_lengths(columns['kg_ext_sum_attention_mask'].values) if 'kg_ext_sum_attention_mask' in columns else np.zeros_like(lang)
+        return np.stack([lang, kg, summary], axis=1)
+
+class StreamingDataset(IterableDataset):
+    """
+    Streams features out of the memory-mapped shards (see ``utils.sharded_db``) of several splits without
+    materializing them. The shards of an epoch are read in a (shuffled) order whose samples are split evenly into
+    contiguous ranges, one per DDP rank and then one per DataLoader worker, so that every rank runs the same number
+    of steps. Samples are shuffled within a buffer of ``shuffle_buffer_size``, and ``load_state_dict`` resumes an
+    epoch after the batches already consumed.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizer, file_paths: List[str], block_size: int, token_type_vocab: dict = None, knowmix: str = "", gcn: bool = None, shuffle: bool = True, shuffle_buffer_size: int = 10000, seed: int = 42):
+        self.dbs = list()
+        self.featurizers = list()
+        for file_path in file_paths:
+            sharded_path = os.path.join(file_path, SHARDED_DB_DIR)
+            if not is_sharded_db(sharded_path):
+                raise ValueError(f"Streaming requires sharded dbs, convert {file_path} first with `python -m utils.sharded_db {file_path}`")
+            self.dbs.append(ShardedDB(sharded_path))
+            self.featurizers.append(Featurizer(tokenizer, block_size, token_type_vocab, knowmix, gcn, ext_max_len_of(file_path)))
+        self.featurizers[0].log_options()
+        self.units = [(db_idx, shard_idx) for db_idx, db in enumerate(self.dbs) for shard_idx in range(db.num_shards)]
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        # Batches of `epoch` already consumed before resuming
+        self.batches_consumed = 0
+        self.batch_size = None
+        notifier.warning(f"Streaming {sum(len(db) for db in self.dbs)} samples from {len(self.units)} shards of {len(file_paths)} splits")
+
+    @staticmethod
+    def _rank():
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def _num_samples(self, units):
+        return sum(self.dbs[db_idx].index['shards'][shard_idx]['num_samples'] for db_idx, shard_idx in units)
+
+    def _epoch_units(self):
+        units = list(self.units)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(units)
+        return units
+
+    def _rank_range(self):
+        """
+        Range of the samples of the epoch (shards in ``_epoch_units`` order) read by this rank. Ranks read as many
+        samples each, the remainder of the division by the world size is dropped (as by a ``DistributedSampler``
+        with ``drop_last``), since DDP ranks running different numbers of steps hang in their collectives.
+        """
+        rank, world_size = self._rank()
+        num_samples = self._num_samples(self.units) // world_size
+        return rank * num_samples, (rank + 1) * num_samples
+
+    @staticmethod
+    def _worker_sizes(num_samples, num_workers):
+        # Same sizes on every rank, so that their DataLoaders yield as many batches
+        return [num_samples // num_workers + int(w < num_samples % num_workers) for w in range(num_workers)]
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.batches_consumed = 0
+        self.epoch = epoch
+
+    def state_dict(self, batches_consumed: int, batch_size: int):
+        return {'epoch': self.epoch, 'batches_consumed': batches_consumed, 'batch_size': batch_size}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.batches_consumed = state_dict['batches_consumed']
+        self.batch_size = state_dict['batch_size']
+        notifier.warning(f"Resuming streaming dataset at epoch {self.epoch} after {self.batches_consumed} batches")
+
+    def __len__(self):
+        # Samples left to this rank in the current epoch (batches are full but for the last one of each worker)
+        start, stop = self._rank_range()
+        consumed = self.batches_consumed * self.batch_size if self.batches_consumed else 0
+        return max(stop - start - consumed, 0)
+
+    def _samples_to_skip(self, worker_sizes, worker_id):
+        """
+        Samples of this worker already consumed. DataLoader takes batches from its workers in turn, skipping the
+        exhausted ones, which is replayed here over the batch count of each worker.
+        """
+        if not self.batches_consumed:
+            return 0
+        num_batches = [math.ceil(size / self.batch_size) for size in worker_sizes]
+        taken = [0] * len(worker_sizes)
+        worker, remaining = 0, self.batches_consumed
+        while (remaining > 0) and any(t < n for t, n in zip(taken, num_batches)):
+            if taken[worker] < num_batches[worker]:
+                taken[worker] += 1
+                remaining -= 1
+            worker = (worker + 1) % len(worker_sizes)
+        return min(taken[worker_id] * self.batch_size, worker_sizes[worker_id])
+
+    def _iter_indices(self, units, start, stop):
+        # Samples `start` to `stop` of the shards `units`, read in order
+        offset = 0
+        for db_idx, shard_idx in units:
+            num_samples = self.dbs[db_idx].index['shards'][shard_idx]['num_samples']
+            for local_idx in range(max(start - offset, 0), min(stop - offset, num_samples)):
+                yield db_idx, shard_idx, local_idx
+            offset += num_samples
+            if offset >= stop:
+                break
+
+    def _shuffle(self, indices, rng):
+        buffer = list()
+        for index in indices:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(index)
+                continue
+            pick = rng.randrange(len(buffer))
+            yield buffer[pick]
+            buffer[pick] = index
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        rank, world_size = self._rank()
+        if len(self.units) < world_size * num_workers:
+            raise ValueError(f"{len(self.units)} shards for {world_size} ranks x {num_workers} DataLoader workers, use fewer workers or convert the dbs into smaller shards (`--shard_size`)")
+        start, stop = self._rank_range()
+        worker_sizes = self._worker_sizes(stop - start, num_workers)
+        start += sum(worker_sizes[:worker_id])
+        skip = self._samples_to_skip(worker_sizes, worker_id)
+
+        # Order only depends on (seed, epoch, rank, worker), so skipped samples are never featurized
+        rng = random.Random(f"{self.seed}-{self.epoch}-{rank}-{worker_id}")
+        indices = self._iter_indices(self._epoch_units(), start, start + worker_sizes[worker_id])
+        if self.shuffle:
+            indices = self._shuffle(indices, rng)
+        for db_idx, shard_idx, local_idx in itertools.islice(indices, skip, None):
+            db, featurizer = self.dbs[db_idx], self.featurizers[db_idx]
+            sample = db.sample(shard_idx, local_idx, featurizer.required_fields(db.keys()), edges=True)
+            yield featurizer(sample)
 
 def get_dataset(
     args: DataTrainingArguments,
@@ -195,14 +694,16 @@ def get_dataset(
     token_type_vocab: dict = None
 ):
     def _dataset(file_path):
-        return HeadOnlyDataset(tokenizer=tokenizer, file_path=file_path, block_size=args.block_size, token_type_vocab=token_type_vocab, knowmix=args.knowmix, gcn=args.gcn, task = args.task)
+        return HeadOnlyDataset(tokenizer=tokenizer, file_path=file_path, block_size=args.block_size, token_type_vocab=token_type_vocab, knowmix=args.knowmix, gcn=args.gcn, task = args.task, overwrite_cache=args.overwrite_cache, tokenization_batch_size=args.tokenization_batch_size, preprocessing_num_workers=args.preprocessing_num_workers)
 
     if evaluate:
         return _dataset(args.eval_data_file)
     elif test:
         return _dataset(args.test_data_file)
+    elif args.streaming:
+        file_paths = sorted(glob(args.train_data_files)) if args.train_data_files else [args.train_data_file]
+        return StreamingDataset(tokenizer=tokenizer, file_paths=file_paths, block_size=args.block_size, token_type_vocab=token_type_vocab, knowmix=args.knowmix, gcn=args.gcn, shuffle_buffer_size=args.shuffle_buffer_size, seed=args.seed)
     elif args.train_data_files:
         return ConcatDataset([_dataset(f) for f in glob(args.train_data_files)])
     else:
         return _dataset(args.train_data_file)
-
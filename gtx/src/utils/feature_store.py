@@ -0,0 +1,229 @@
+import os
+import json
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+
+from utils.notifier import logging, log_formatter
+notifier = logging.getLogger(__name__)
+notifier.addHandler(log_formatter())
+
+"""
+Columnar Feature Store
+"""
+# Written last by ``FeatureStore.save``, marks a complete store
+STORE_INDEX_FILE = 'index.json'
+
+# Candidate dtypes for integer fields, from the narrowest one
+INTEGER_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64)
+
+def narrowest_int_dtype(min_value, max_value):
+    for dtype in INTEGER_DTYPES:
+        info = np.iinfo(dtype)
+        if (info.min <= min_value) and (max_value <= info.max):
+            return dtype
+    raise ValueError(f"Values out of int64 range [{min_value}, {max_value}]")
+
+def compact_array(value):
+    """
+    Converts a (nested) list of numbers into an array of the narrowest dtype holding it, so building a store never
+    keeps more than one int64 copy of a sample alive.
+    """
+    array = np.asarray(value)
+    if array.dtype == np.bool_:
+        return array.astype(np.uint8)
+    if np.issubdtype(array.dtype, np.integer) and (array.size > 0):
+        return array.astype(narrowest_int_dtype(int(array.min()), int(array.max())), copy=False)
+    if np.issubdtype(array.dtype, np.floating):
+        return array.astype(np.float32, copy=False)
+    return array
+
+def adjacency_edges(mask) -> Optional[np.ndarray]:
+    """
+    ``(num_edges, 2)`` (row, column) positions of the non-zero entries of a binary ``N x N`` adjacency mask, in
+    row-major order, or None if ``mask`` is not a binary square matrix (it is then kept dense).
+    """
+    mask = np.asarray(mask)
+    if (mask.ndim != 2) or (mask.shape[0] != mask.shape[1]) or ((mask != 0) & (mask != 1)).any():
+        return None
+    return np.argwhere(mask).astype(narrowest_int_dtype(0, max(mask.shape[0]-1, 0)))
+
+def densify_edges(edges: np.ndarray, num_nodes: int, dtype=np.uint8) -> np.ndarray:
+    """
+    Inverse of ``adjacency_edges``.
+    """
+    mask = np.zeros((num_nodes, num_nodes), dtype=dtype)
+    edges = np.asarray(edges).reshape(-1, 2)
+    mask[edges[:, 0], edges[:, 1]] = 1
+    return mask
+
+class Column:
+    """
+    A single field of every sample, stored as one contiguous array.
+    Args:
+        values: Fixed-shape fields are stored as ``(num_samples, *shape)``; ragged fields (e.g. ``rc_indeces``) are
+            concatenated along their first axis.
+        offsets: (Optional) ``num_samples + 1`` boundaries of each sample in ``values`` for ragged fields.
+        packed_size: (Optional) Original size of the last axis if ``values`` are bit-packed along it.
+        dtype: dtype the field is handed out with (only differs from ``values.dtype`` when bit-packed).
+    """
+    def __init__(self, values: np.ndarray, offsets: Optional[np.ndarray] = None, packed_size: Optional[int] = None, dtype=None):
+        self.values = values
+        self.offsets = offsets
+        self.packed_size = packed_size
+        self.dtype = np.dtype(dtype) if dtype is not None else values.dtype
+
+    @property
+    def ragged(self):
+        return self.offsets is not None
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (self.offsets.nbytes if self.ragged else 0)
+
+    def __getitem__(self, i):
+        if self.ragged:
+            return self.values[self.offsets[i]:self.offsets[i+1]]
+        if self.packed_size is not None:
+            return np.unpackbits(self.values[i], axis=-1, count=self.packed_size).astype(self.dtype, copy=False)
+        return self.values[i]
+
+    def save(self, prefix: str) -> Dict[str, Any]:
+        """
+        Writes the arrays to ``{prefix}.npy`` (and ``{prefix}.offsets.npy``) and returns what ``load`` needs besides them.
+        """
+        np.save(prefix + ".npy", self.values)
+        if self.ragged:
+            np.save(prefix + ".offsets.npy", self.offsets)
+        return {'ragged': self.ragged, 'packed_size': self.packed_size, 'dtype': self.dtype.name}
+
+    @classmethod
+    def load(cls, prefix: str, meta: Dict[str, Any], mmap_mode: Optional[str] = 'r'):
+        """
+        Opens a column written by ``save``. With ``mmap_mode`` set, nothing is read until a sample is accessed.
+        """
+        values = np.load(prefix + ".npy", mmap_mode=mmap_mode)
+        offsets = np.load(prefix + ".offsets.npy", mmap_mode=mmap_mode) if meta['ragged'] else None
+        return cls(values, offsets=offsets, packed_size=meta['packed_size'], dtype=meta['dtype'])
+
+    @classmethod
+    def from_arrays(cls, name: str, arrays: List[np.ndarray], pack_bits: bool = True):
+        shapes = set(a.shape for a in arrays)
+        ragged = len(shapes) > 1
+        if ragged:
+            # Empty samples (e.g. no relation to classify) carry no trailing shape, take it from the others
+            trailing = set(a.shape[1:] for a in arrays if a.size > 0)
+            if len(trailing) > 1:
+                raise ValueError(f"Field {name} is ragged beyond its first axis: {sorted(shapes)}")
+            trailing = trailing.pop() if trailing else ()
+            arrays = [a.reshape((len(a),) + trailing) if a.size == 0 else a for a in arrays]
+        dtype = cls._storage_dtype([a for a in arrays if a.size > 0])
+        if ragged:
+            lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+            offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            values = np.concatenate(arrays).astype(dtype, copy=False) if len(arrays) else np.zeros((0,), dtype=dtype)
+            return cls(values, offsets=offsets)
+        values = np.stack(arrays).astype(dtype, copy=False)
+        # Only quadratic (node x node) masks are worth unpacking on every access
+        if pack_bits and (values.ndim >= 3) and np.issubdtype(dtype, np.integer) and (values.size > 0) and (values.max() <= 1) and (values.min() >= 0):
+            return cls(np.packbits(values, axis=-1), packed_size=values.shape[-1], dtype=dtype)
+        return cls(values)
+
+    @staticmethod
+    def _storage_dtype(arrays: List[np.ndarray]):
+        if not arrays:
+            return np.uint8
+        if any(np.issubdtype(a.dtype, np.floating) for a in arrays):
+            return np.float32
+        if all(np.issubdtype(a.dtype, np.integer) for a in arrays):
+            return narrowest_int_dtype(min(int(a.min()) for a in arrays), max(int(a.max()) for a in arrays))
+        raise TypeError(f"Unsupported dtype {arrays[0].dtype} for a feature store column")
+
+def is_feature_store(path):
+    return os.path.isfile(os.path.join(path, STORE_INDEX_FILE))
+
+class FeatureStore:
+    """
+    Array-backed replacement for a list of ``InputFeatures``. Each field is stored as one contiguous NumPy array with
+    the narrowest dtype that holds its values (binary ``N x N`` masks are bit-packed), and ``__getitem__`` returns a
+    dict of views into these arrays instead of nested Python lists.
+    A store written by ``save`` and opened by ``load`` is memory-mapped: its pages live in the page cache, which is
+    shared by the DataLoader workers and the ranks of a host instead of being copied into each of them.
+    """
+    def __init__(self, columns: Dict[str, Column], num_samples: int, path: Optional[str] = None, mmap_mode: Optional[str] = None):
+        self.columns = columns
+        self.num_samples = num_samples
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def __getstate__(self):
+        # Memory-mapped stores are reopened by each process (e.g. spawned workers) instead of being pickled with their contents
+        state = self.__dict__.copy()
+        if (self.path is not None) and (self.mmap_mode is not None):
+            state['columns'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.columns is None:
+            self.columns = self.load(self.path, self.mmap_mode).columns
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], pack_bits: bool = True):
+        """
+        Builds a store from feature dicts (as fed to ``InputFeatures``). Every record must have the same keys; fields
+        which are None in every record are dropped.
+        """
+        fields = None
+        num_samples = 0
+        for record in records:
+            record = {k:v for k,v in record.items() if v is not None}
+            if fields is None:
+                fields = {k:list() for k in record}
+            elif set(record) != set(fields):
+                raise ValueError(f"Inconsistent fields in sample {num_samples}: {sorted(record)} vs {sorted(fields)}")
+            for k, v in record.items():
+                fields[k].append(compact_array(v))
+            num_samples += 1
+        columns = dict()
+        for k in list(fields or {}):
+            columns[k] = Column.from_arrays(k, fields.pop(k), pack_bits=pack_bits)
+        store = cls(columns, num_samples)
+        notifier.warning(f"Stored {num_samples} samples in {store.nbytes/2**20:.1f} MiB ({store.describe()})")
+        return store
+
+    def save(self, path: str):
+        """
+        Writes every column to ``path/{field}.npy`` (see ``Column.save``), then the index.
+        """
+        os.makedirs(path, exist_ok=True)
+        columns = {k:c.save(os.path.join(path, k)) for k,c in self.columns.items()}
+        with open(os.path.join(path, STORE_INDEX_FILE), 'w') as f:
+            json.dump({'num_samples': self.num_samples, 'columns': columns}, f, indent=1)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = 'r'):
+        """
+        Opens a store written by ``save``, memory-mapped unless ``mmap_mode`` is None.
+        """
+        with open(os.path.join(path, STORE_INDEX_FILE)) as f:
+            index = json.load(f)
+        columns = {k:Column.load(os.path.join(path, k), meta, mmap_mode=mmap_mode) for k, meta in index['columns'].items()}
+        return cls(columns, index['num_samples'], path=path, mmap_mode=mmap_mode)
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.columns.values())
+
+    def describe(self):
+        return ", ".join(f"{k}:{c.values.dtype}{'[packed]' if c.packed_size else ''}{'[ragged]' if c.ragged else ''}" for k,c in self.columns.items())
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, i) -> Dict[str, np.ndarray]:
+        if (i < -self.num_samples) or (i >= self.num_samples):
+            raise IndexError(f"Sample index {i} out of range for {self.num_samples} samples")
+        if i < 0:
+            i += self.num_samples
+        return {k:c[i] for k,c in self.columns.items()}
@@ -84,5 +84,21 @@ class DataTrainingArguments:
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
+    tokenization_batch_size: int = field(
+        default=1000, metadata={"help": "Number of samples tokenized together when creating features"}
+    )
+    preprocessing_num_workers: Optional[int] = field(
+        default=None, metadata={"help": "Number of processes tokenizing batches when creating features"}
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": "Stream the training set from the sharded dbs of `train_data_files` (or `train_data_file`) instead of materializing it. "
+            "Convert the splits first with `python -m utils.sharded_db`"
+        },
+    )
+    shuffle_buffer_size: int = field(
+        default=10000, metadata={"help": "Number of samples shuffled together when streaming the training set"}
+    )
 
 parser = HfArgumentParser((ModelArguments, DataTrainingArguments, TrainingArguments))
\ No newline at end of file
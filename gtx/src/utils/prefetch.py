@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+from typing import Dict, Optional
+from torch.utils.data import DataLoader
+
+from utils.notifier import logging, log_formatter
+notifier = logging.getLogger(__name__)
+notifier.addHandler(log_formatter())
+
+"""
+Background prefetching of batches
+"""
+class PrefetchMetrics:
+    """
+    Counters of the input pipeline since the last ``reset``: batches ready in the queue when the training loop asked
+    for the next one, and time it waited for it. A run whose queue is mostly empty is input-bound.
+    Shared by the re-instantiations of a ``PrefetchDataLoader`` (e.g. by the Trainer to inject a sampler).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.queue_depth = 0
+        self.empty = 0
+        self.wait_time = 0.0
+
+    def record(self, queue_depth: int, wait_time: float):
+        self.batches += 1
+        self.queue_depth += queue_depth
+        self.empty += int(queue_depth == 0)
+        self.wait_time += wait_time
+
+    def summary(self, prefix: str = "") -> Dict[str, float]:
+        batches = max(self.batches, 1)
+        return {
+            f"{prefix}prefetch_queue_depth": self.queue_depth / batches,
+            f"{prefix}prefetch_empty_ratio": self.empty / batches,
+            f"{prefix}data_wait_ms": 1000 * self.wait_time / batches,
+        }
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+_END = object()
+
+class _PrefetchIterator:
+    """
+    Consumer side of the queue filled by a background thread. The thread only holds the queue and the stop event, so
+    an iterator left before its end (e.g. ``limit_val_batches``) is collected and stops the thread.
+    """
+    def __init__(self, iterator, prefetch_batches: int, metrics: PrefetchMetrics):
+        self.queue = queue.Queue(maxsize=prefetch_batches)
+        self.stop = threading.Event()
+        self.metrics = metrics
+        self.thread = threading.Thread(target=self._produce, args=(iterator, self.queue, self.stop), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _produce(iterator, batches: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        try:
+            for batch in iterator:
+                if not put(batch):
+                    return
+            put(_END)
+        except BaseException as exception:
+            put(_Failure(exception))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        queue_depth = self.queue.qsize()
+        start = time.perf_counter()
+        item = self.queue.get()
+        if item is _END:
+            self.thread.join()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            raise item.exception
+        self.metrics.record(queue_depth, time.perf_counter() - start)
+        return item
+
+    def close(self):
+        self.stop.set()
+
+    def __del__(self):
+        self.close()
+
+class PrefetchDataLoader(DataLoader):
+    """
+    DataLoader keeping up to ``prefetch_batches`` batches ready, collated ahead by a background thread. With
+    ``num_workers=0`` collation then overlaps the forward / backward passes (NumPy and torch kernels release the
+    GIL) instead of running between steps; with workers, the thread takes the batches off the worker queues (and the
+    pin memory thread) ahead of the step.
+    Args:
+        prefetch_batches: Size of the queue of ready batches, 0 iterates as a plain DataLoader.
+        metrics: Where queue depths and wait times are counted.
+    """
+    def __init__(self, *args, prefetch_batches: int = 2, metrics: Optional[PrefetchMetrics] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefetch_batches = prefetch_batches
+        self.metrics = metrics if metrics is not None else PrefetchMetrics()
+
+    def __iter__(self):
+        iterator = super().__iter__()
+        if self.prefetch_batches < 1:
+            return iterator
+        return _PrefetchIterator(iterator, self.prefetch_batches, self.metrics)
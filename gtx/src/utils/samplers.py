@@ -0,0 +1,183 @@
+import abc
+import math
+from typing import Iterator, List
+import numpy as np
+import torch
+from torch.utils.data import ConcatDataset, Sampler
+
+from utils.notifier import logging, log_formatter
+notifier = logging.getLogger(__name__)
+notifier.addHandler(log_formatter())
+
+"""
+Batch Samplers
+"""
+def trailing_lengths(values: np.ndarray, pad_value: int = 0, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Length of each row of a ``(num_samples, max_length, ...)`` array once its trailing padding is cut, i.e. the
+    position of its last entry different from ``pad_value`` plus one.
+    """
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for start in range(0, len(values), chunk_size):
+        chunk = np.asarray(values[start:start+chunk_size])
+        nonpad = (chunk.reshape(chunk.shape[0], chunk.shape[1], -1) != pad_value).any(-1)
+        lengths[start:start+len(chunk)] = np.where(nonpad.any(1), nonpad.shape[1] - np.argmax(nonpad[:, ::-1], axis=1), 0)
+    return lengths
+
+def dataset_lengths(dataset, kg_pad_id: int = 0) -> np.ndarray:
+    """
+    ``(num_samples, num_fields)`` lengths of a (concatenated) dataset exposing ``lengths()``.
+    """
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([dataset_lengths(d, kg_pad_id) for d in dataset.datasets])
+    if not hasattr(dataset, 'lengths'):
+        raise ValueError(f"{type(dataset).__name__} does not expose sample lengths to group batches by")
+    return dataset.lengths(kg_pad_id)
+
+def distributed_rank():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+class MegaBatchSampler(Sampler, abc.ABC):
+    """
+    Base of the batch samplers grouping samples of similar lengths.
+    Samples are shuffled and split into mega-batches of ``mega_batch_size`` samples; each mega-batch is sorted by
+    length and cut into batches by ``split``, and the order of the batches is shuffled again, so that consecutive
+    steps do not walk from the shortest to the longest samples.
+    Under DDP every rank draws the same batches with the same seed and keeps its own share of them, hence the
+    Trainer must not wrap it into a ``DistributedSampler``.
+    Args:
+        lengths: ``(num_samples, num_fields)`` sample lengths, e.g. text length and graph size.
+        shuffle: If False (evaluation), the whole dataset is sorted at once and batches are returned in order.
+    """
+    def __init__(self, lengths: np.ndarray, shuffle: bool = True, mega_batch_size: int = 1000, seed: int = 42):
+        self.lengths = np.asarray(lengths).reshape(len(lengths), -1)
+        self.shuffle = shuffle
+        self.mega_batch_size = mega_batch_size
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self._batches = None
+        self.epoch = epoch
+
+    def sort(self, indices: np.ndarray) -> np.ndarray:
+        # np.lexsort sorts by its last key first
+        return indices[np.lexsort(self.lengths[indices].T[::-1])]
+
+    @abc.abstractmethod
+    def split(self, indices: np.ndarray) -> List[np.ndarray]:
+        """
+        Batches of a mega-batch of ``indices`` sorted by ``sort``.
+        """
+
+    def batches(self) -> List[np.ndarray]:
+        """
+        Batches of the current epoch, over all ranks.
+        """
+        if self._batches is not None:
+            return self._batches
+        num_samples = len(self.lengths)
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            order = rng.permutation(num_samples)
+            mega_batch_size = self.mega_batch_size
+        else:
+            order = np.arange(num_samples)
+            mega_batch_size = max(num_samples, 1)
+
+        batches = list()
+        for start in range(0, num_samples, mega_batch_size):
+            batches.extend(self.split(self.sort(order[start:start+mega_batch_size])))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+
+    def rank_batches(self) -> List[np.ndarray]:
+        """
+        Batches of the current epoch for this rank. Ranks must run the same number of steps: in training, the
+        batches left over by the division by the world size are dropped; in evaluation, the first batches are
+        repeated to complete the last round instead (as by ``DistributedSampler``), so that no sample is left out.
+        """
+        batches = self.batches()
+        rank, world_size = distributed_rank()
+        if self.shuffle:
+            batches = batches[:len(batches) // world_size * world_size]
+        elif batches:
+            num_batches = math.ceil(len(batches) / world_size) * world_size
+            batches = (batches * math.ceil(num_batches / len(batches)))[:num_batches]
+        return batches[rank::world_size]
+
+    def __len__(self):
+        return len(self.rank_batches())
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for batch in self.rank_batches():
+            yield batch.tolist()
+
+    def padded_size(self, batch: np.ndarray) -> int:
+        """
+        Positions of ``batch`` once every field is trimmed to its longest sample.
+        """
+        return int(self.lengths[batch].max(0).sum()) * len(batch)
+
+    def padding_ratio(self) -> float:
+        """
+        Share of padded positions left after trimming every batch to its longest sample, over all length columns.
+        """
+        padded = sum(self.padded_size(batch) for batch in self.batches())
+        return 1.0 - int(self.lengths.sum()) / max(padded, 1)
+
+class LengthGroupedBatchSampler(MegaBatchSampler):
+    """
+    Batches of ``batch_size`` samples of similar lengths, so that trimming each batch to its longest sample
+    (``dynamic_padding`` of the data collators) leaves little padding. Mega-batches of ``mega_batch_mult`` batches
+    are sorted by their length columns, the first one as the primary key.
+    """
+    def __init__(self, lengths: np.ndarray, batch_size: int, drop_last: bool = False, shuffle: bool = True, mega_batch_mult: int = 50, seed: int = 42):
+        super().__init__(lengths, shuffle=shuffle, mega_batch_size=batch_size*mega_batch_mult, seed=seed)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def split(self, indices: np.ndarray) -> List[np.ndarray]:
+        batches = [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        # Mega-batches are whole batches, only the last one of the epoch can be incomplete
+        if self.drop_last and batches and (len(batches[-1]) < self.batch_size):
+            batches.pop()
+        return batches
+
+class TokenBudgetBatchSampler(MegaBatchSampler):
+    """
+    Batches packed up to ``max_tokens`` positions (text tokens + KG nodes + summary tokens, counted after
+    ``dynamic_padding`` trims every field to its longest sample) instead of a fixed number of samples, so that
+    batches of short samples grow and batches of large graphs shrink. Mega-batches are sorted by total length
+    before packing. A sample over the budget on its own makes a batch by itself.
+    """
+    def __init__(self, lengths: np.ndarray, max_tokens: int, shuffle: bool = True, mega_batch_size: int = 1000, seed: int = 42):
+        super().__init__(lengths, shuffle=shuffle, mega_batch_size=mega_batch_size, seed=seed)
+        self.max_tokens = max_tokens
+        oversized = int((self.lengths.sum(1) > max_tokens).sum())
+        if oversized:
+            notifier.warning(f"{oversized} samples exceed the budget of {max_tokens} tokens per batch and are batched alone")
+
+    def sort(self, indices: np.ndarray) -> np.ndarray:
+        return indices[np.argsort(self.lengths[indices].sum(1), kind='stable')]
+
+    def split(self, indices: np.ndarray) -> List[np.ndarray]:
+        batches = list()
+        start = 0
+        widths = np.zeros(self.lengths.shape[1], dtype=np.int64)
+        for pos, idx in enumerate(indices):
+            grown = np.maximum(widths, self.lengths[idx])
+            if (pos > start) and ((pos - start + 1) * int(grown.sum()) > self.max_tokens):
+                batches.append(indices[start:pos])
+                start = pos
+                grown = self.lengths[idx]
+            widths = grown
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
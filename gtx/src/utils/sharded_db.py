@@ -0,0 +1,281 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from collections.abc import Sequence
+from typing import Any, Dict, List, Optional
+from tqdm import tqdm
+import numpy as np
+import torch
+
+from .feature_store import Column, adjacency_edges, compact_array, densify_edges
+
+from utils.notifier import logging, log_formatter
+notifier = logging.getLogger(__name__)
+notifier.addHandler(log_formatter())
+
+"""
+Sharded, memory-mapped db layout
+
+    db.shards/
+        index.json              # written last, marks a complete conversion
+        00000/input.npy         # fixed-width field: (num_samples, *shape)
+        00000/rc_index.npy      # ragged field: values concatenated along the first axis
+        00000/rc_index.offsets.npy
+        00000/text.npy          # non-numeric field: utf-8 JSON of each sample, with offsets
+        00000/mask.npy          # binary N x N adjacency: (row, column) of its edges, with offsets
+        ...
+"""
+# Version 2 stores adjacency masks as edge lists
+SHARDED_DB_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+SHARDED_DB_DIR = 'db.shards'
+INDEX_FILE = 'index.json'
+# Adjacency fields read as edge lists are named `<field>_edges`
+EDGES_SUFFIX = '_edges'
+
+class JsonColumn(Column):
+    """
+    Column of JSON-serializable values (notes, node descriptions) stored as utf-8 bytes with offsets.
+    """
+    def __getitem__(self, i):
+        return json.loads(super().__getitem__(i).tobytes().decode('utf-8'))
+
+    @classmethod
+    def from_values(cls, values: List[Any]):
+        blobs = [np.frombuffer(json.dumps(v).encode('utf-8'), dtype=np.uint8) for v in values]
+        offsets = np.zeros(len(blobs)+1, dtype=np.int64)
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        return cls(np.concatenate(blobs) if blobs else np.zeros((0,), dtype=np.uint8), offsets=offsets)
+
+class AdjacencyColumn(Column):
+    """
+    Column of binary ``num_nodes x num_nodes`` adjacency masks (``mask`` of the GAT) stored as edge lists, which are
+    densified on access, or read as they are by ``edges``.
+    """
+    def __init__(self, values: np.ndarray, offsets: np.ndarray, num_nodes: int):
+        super().__init__(values, offsets=offsets)
+        self.num_nodes = num_nodes
+
+    def __getitem__(self, i):
+        return densify_edges(self.edges(i), self.num_nodes)
+
+    def edges(self, i) -> np.ndarray:
+        # (num_edges, 2) stored edge list of sample `i`
+        return super().__getitem__(i)
+
+    def save(self, prefix: str) -> Dict[str, Any]:
+        meta = super().save(prefix)
+        meta['num_nodes'] = self.num_nodes
+        return meta
+
+    @classmethod
+    def load(cls, prefix: str, meta: Dict[str, Any], mmap_mode: Optional[str] = 'r'):
+        column = Column.load(prefix, meta, mmap_mode=mmap_mode)
+        return cls(column.values, column.offsets, meta['num_nodes'])
+
+    @classmethod
+    def from_masks(cls, name: str, masks: List[Any]):
+        num_nodes = set(np.shape(m)[0] for m in masks)
+        if len(num_nodes) != 1:
+            raise ValueError(f"Field {name} holds adjacency masks of different sizes: {sorted(num_nodes)}")
+        edges = [adjacency_edges(m) for m in masks]
+        if any(e is None for e in edges):
+            raise ValueError(f"Field {name} is not a binary adjacency mask in every sample")
+        column = Column.from_arrays(name, edges, pack_bits=False)
+        values = column.values.reshape(-1, 2)
+        # Edge lists all of the same length are stacked by `from_arrays`, they are read by offsets all the same
+        offsets = column.offsets if column.ragged else np.arange(len(edges) + 1, dtype=np.int64) * (len(values) // max(len(edges), 1))
+        return cls(values, offsets, num_nodes.pop())
+
+COLUMN_CLASSES = {'json': JsonColumn, 'adjacency': AdjacencyColumn, 'array': Column}
+
+def is_sharded_db(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+def _build_column(name, values, kind):
+    if kind == 'json':
+        return JsonColumn.from_values(values)
+    if kind == 'adjacency':
+        return AdjacencyColumn.from_masks(name, values)
+    return Column.from_arrays(name, [compact_array(v) for v in values])
+
+def _infer_kind(values):
+    """
+    Storage of a field, decided from every sample so that writing the shards never fails partway: binary square
+    masks of a single size are stored as edge lists, numeric values stacked or concatenated along their first axis,
+    anything else (or numeric values ragged beyond their first axis) as JSON.
+    """
+    adjacency, num_nodes, shapes, trailing_shapes = True, set(), set(), set()
+    for v in values:
+        try:
+            a = np.asarray(v)
+        except ValueError:
+            # Nested lists of uneven length
+            return 'json'
+        if a.dtype.kind not in 'biuf':
+            return 'json'
+        shapes.add(a.shape)
+        if a.size > 0:
+            trailing_shapes.add(a.shape[1:])
+        if adjacency:
+            adjacency = (a.ndim == 2) and (a.shape[0] == a.shape[1]) and (a.size > 0) and not ((a != 0) & (a != 1)).any()
+            if adjacency:
+                num_nodes.add(a.shape[0])
+    if adjacency and (len(num_nodes) == 1):
+        return 'adjacency'
+    if (len(shapes) > 1) and ((len(trailing_shapes) > 1) or (() in shapes)):
+        return 'json'
+    return 'array'
+
+def convert_db(db_path: str, output_dir: Optional[str] = None, shard_size: int = 4096, overwrite: bool = False):
+    """
+    Converts a pickled ``db`` dict (field -> list with one entry per sample) into memory-mapped shards of
+    ``shard_size`` samples next to it. Binary square masks become edge lists, other numeric fields fixed-width or
+    ragged arrays of the narrowest dtype, everything else is stored as JSON.
+    """
+    output_dir = output_dir or os.path.join(os.path.dirname(db_path), SHARDED_DB_DIR)
+    if is_sharded_db(output_dir) and not overwrite:
+        notifier.warning(f"Sharded db already exists at {output_dir}")
+        return output_dir
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    sha1 = hashlib.sha1()
+    with open(db_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<24), b''):
+            sha1.update(chunk)
+    db = torch.load(db_path)
+    num_samples = set(len(v) for v in db.values())
+    if len(num_samples) != 1:
+        raise ValueError(f"Fields of {db_path} have different lengths: { {k:len(v) for k,v in db.items()} }")
+    num_samples = num_samples.pop()
+    fields = {k:_infer_kind(v) for k,v in db.items()}
+
+    shards = list()
+    for shard_idx, start in enumerate(tqdm(range(0, num_samples, shard_size), desc="Writing shards")):
+        name = f"{shard_idx:05d}"
+        os.makedirs(os.path.join(output_dir, name))
+        columns = dict()
+        for k, kind in fields.items():
+            column = _build_column(k, db[k][start:start+shard_size], kind)
+            columns[k] = column.save(os.path.join(output_dir, name, k))
+        shards.append({'name': name, 'num_samples': min(shard_size, num_samples-start), 'columns': columns})
+
+    index = {'version': SHARDED_DB_VERSION, 'source_sha1': sha1.hexdigest(), 'num_samples': num_samples, 'fields': fields, 'shards': shards}
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    notifier.warning(f"Converted {num_samples} samples of {db_path} into {len(shards)} shards at {output_dir}")
+    return output_dir
+
+class ShardedDB:
+    """
+    Read-only view of a db converted by ``convert_db``. Opening only reads ``index.json``; shard files are memory-mapped
+    on first access, so samples are paged in when touched and the page cache is shared between processes.
+    """
+    def __init__(self, path: str, mmap_mode: Optional[str] = 'r'):
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index['version'] not in SUPPORTED_VERSIONS:
+            raise ValueError(f"Unsupported sharded db version {self.index['version']} at {path}")
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.starts = np.cumsum([0] + [shard['num_samples'] for shard in self.index['shards']])
+        self._columns = dict()
+
+    def __getstate__(self):
+        # Memory maps are reopened by each process instead of being pickled with their contents
+        state = self.__dict__.copy()
+        state['_columns'] = dict()
+        return state
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def num_shards(self):
+        return len(self.index['shards'])
+
+    def keys(self):
+        return list(self.index['fields'])
+
+    def column(self, shard_idx: int, field: str) -> Column:
+        if (shard_idx, field) not in self._columns:
+            shard = self.index['shards'][shard_idx]
+            column_cls = COLUMN_CLASSES[self.index['fields'][field]]
+            self._columns[(shard_idx, field)] = column_cls.load(os.path.join(self.path, shard['name'], field), shard['columns'][field], mmap_mode=self.mmap_mode)
+        return self._columns[(shard_idx, field)]
+
+    def locate(self, i: int):
+        if (i < 0) or (i >= len(self)):
+            raise IndexError(f"Sample index {i} out of range for {len(self)} samples")
+        shard_idx = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return shard_idx, i - int(self.starts[shard_idx])
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        return self.sample(*self.locate(i))
+
+    def is_adjacency(self, field: str) -> bool:
+        return self.index['fields'][field] == 'adjacency'
+
+    def sample(self, shard_idx: int, local_idx: int, fields: Optional[List[str]] = None, edges: bool = False) -> Dict[str, Any]:
+        """
+        ``fields`` (all by default) of a sample. With ``edges``, adjacency masks are read as their stored edge lists,
+        under ``<field>_edges``, instead of being densified.
+        """
+        sample = dict()
+        for k in (self.keys() if fields is None else fields):
+            if edges and self.is_adjacency(k):
+                sample[k + EDGES_SUFFIX] = self.column(shard_idx, k).edges(local_idx)
+            else:
+                sample[k] = self.column(shard_idx, k)[local_idx]
+        return sample
+
+    def field(self, name: str, edges: bool = False) -> "ShardedField":
+        return ShardedField(self, name, edges=edges)
+
+    def as_dict(self, edges: bool = False) -> Dict[str, "ShardedField"]:
+        """
+        Drop-in for the unpickled ``db`` dict: one lazy sequence per field. With ``edges``, adjacency masks are
+        sequences of edge lists named ``<field>_edges`` instead.
+        """
+        return {(k + EDGES_SUFFIX if edges and self.is_adjacency(k) else k):self.field(k, edges=edges and self.is_adjacency(k)) for k in self.keys()}
+
+class ShardedField(Sequence):
+    def __init__(self, db: ShardedDB, name: str, edges: bool = False):
+        self.db = db
+        self.name = name
+        self.edges = edges
+
+    def _read(self, column, local_idx):
+        return column.edges(local_idx) if self.edges else column[local_idx]
+
+    def __len__(self):
+        return len(self.db)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        shard_idx, local_idx = self.db.locate(i)
+        return self._read(self.db.column(shard_idx, self.name), local_idx)
+
+    def __iter__(self):
+        for shard_idx in range(self.db.num_shards):
+            column = self.db.column(shard_idx, self.name)
+            for local_idx in range(self.db.index['shards'][shard_idx]['num_samples']):
+                yield self._read(column, local_idx)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a pickled db into memory-mapped shards")
+    parser.add_argument("db_paths", nargs="+", help="`db` files (or split directories holding them)")
+    parser.add_argument("--shard_size", type=int, default=4096)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+    for db_path in args.db_paths:
+        if os.path.isdir(db_path):
+            db_path = os.path.join(db_path, 'db')
+        convert_db(db_path, shard_size=args.shard_size, overwrite=args.overwrite)
@@ -106,10 +106,14 @@ class TrainingArguments:
         save_total_limit (:obj:`int`, `optional`):
             If a value is passed, will limit the total amount of checkpoints. Deletes the older checkpoints in
             :obj:`output_dir`.
+        resume_from_checkpoint (:obj:`str`, `optional`):
+            Path to a Lightning checkpoint to resume training from. A streaming training set saved partway through an
+            epoch resumes after the samples its ranks already consumed.
         no_cuda (:obj:`bool`, `optional`, defaults to :obj:`False`):
             Whether to not use CUDA even when it is available or not.
         seed (:obj:`int`, `optional`, defaults to 42):
-            Random seed for initialization.
+            Random seed for initialization, and of the generators the data collators re-seed for every batch from
+            (seed, epoch, rank, batch index).
         fp16 (:obj:`bool`, `optional`, defaults to :obj:`False`):
             Whether to use 16-bit (mixed) precision training (through NVIDIA apex) instead of 32-bit training.
         fp16_opt_level (:obj:`str`, `optional`, defaults to 'O1'):
@@ -130,6 +134,36 @@ class TrainingArguments:
         dataloader_num_workers (:obj:`int`, `optional`, defaults to 0):
             Number of subprocesses to use for data loading (PyTorch only). 0 means that the data will be loaded in the
             main process.
+        dataloader_prefetch_batches (:obj:`int`, `optional`, defaults to 0):
+            Number of batches collated ahead by a background thread, so that collation overlaps the training step
+            (mostly useful with :obj:`dataloader_num_workers=0`). The queue depth and the time steps wait for their
+            batch are logged to tell whether a run is input-bound. 0 disables prefetching.
+        group_by_length (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to batch samples of similar text length and graph size together, so that less padding is left
+            once ``dynamic_padding`` trims each batch. Batch order is still shuffled.
+        length_grouping_mult (:obj:`int`, `optional`, defaults to 50):
+            Number of batches drawn at random and sorted by length at once when ``group_by_length`` or
+            ``max_tokens_per_batch`` is set.
+        dynamic_padding (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether the data collator trims every padded field to the longest sample of the batch.
+        max_tokens_per_batch (:obj:`int`, `optional`):
+            If set, batches are packed up to this many positions (text tokens + KG nodes + summary tokens, once trimmed
+            by ``dynamic_padding``, which it turns on) instead of :obj:`train_batch_size` / :obj:`eval_batch_size`
+            samples, which then only size the pools of samples sorted together.
+        virtual_negatives (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether the negative pairs of the alignment loss (``align`` / ``Re`` task) are given to the model as
+            indices into the batch instead of ``n_negatives`` copies of it, so that texts and graphs go through the
+            single-modality layers once and only the cross-modality layers run on every pair.
+        device_masking (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether the masked LM / LP corruption (and negative sampling) of the ``Pre`` and ``Gen`` tasks is left to
+            the LightningModule once batches are on the device, with the same per batch generators, instead of being
+            done by the DataLoader workers. The workers then only move raw ids; on CPU the masking runs with the
+            intra-op threads of the main process.
+        corruption_table (:obj:`str`, `optional`):
+            Path to a saved ``CorruptionTable`` from which the ``ErrDetect`` collator corrupts the graphs of samples
+            without precomputed labels (clean dbs) on the fly, so that every epoch sees fresh corruptions.
+        corruption_probability (:obj:`float`, `optional`, defaults to 0.25):
+            Share of the corruptible nodes of each graph replaced on the fly (at least one).
         past_index (:obj:`int`, `optional`, defaults to -1):
             Some models like :doc:`TransformerXL <../model_doc/transformerxl>` or :doc`XLNet <../model_doc/xlnet>` can
             make use of the past hidden states for their predictions. If this argument is set to a positive int, the
@@ -265,6 +299,18 @@ class TrainingArguments:
     n_negatives: int = field(
         default=1, metadata={"help": "Number of negative samples"}
     )
+    virtual_negatives: bool = field(
+        default=False, metadata={"help": "Encode every text and graph once and only repeat the cross-modality layers for the negative pairs."}
+    )
+    device_masking: bool = field(
+        default=False, metadata={"help": "Mask tokens and nodes on the model device after the batch transfer instead of in the DataLoader workers."}
+    )
+    corruption_table: Optional[str] = field(
+        default=None, metadata={"help": "Path to the corruption table of ErrDetect, to corrupt clean graphs on the fly."}
+    )
+    corruption_probability: float = field(
+        default=0.25, metadata={"help": "Share of the corruptible nodes of each graph corrupted on the fly."}
+    )
     num_log_per_epoch: int = field(default=100, metadata={"help": "Log every X updates steps."})
     save_per_run: int = field(default=1, metadata={"help": "Save checkpoint every X updates steps."})
     save_total_limit: Optional[int] = field(
@@ -276,6 +322,9 @@ class TrainingArguments:
             )
         },
     )
+    resume_from_checkpoint: Optional[str] = field(
+        default=None, metadata={"help": "Path to a Lightning checkpoint to resume training from."}
+    )
     no_cuda: bool = field(default=False, metadata={"help": "Do not use CUDA even when it is available"})
     seed: int = field(default=42, metadata={"help": "random seed for initialization"})
 
@@ -313,10 +362,26 @@ class TrainingArguments:
             "help": "Number of subprocesses to use for data loading (PyTorch only). 0 means that the data will be loaded in the main process."
         },
     )
+    dataloader_prefetch_batches: int = field(
+        default=0, metadata={"help": "Number of batches collated ahead by a background thread (0 disables prefetching)."}
+    )
     optimizer: str = field(default="Adam", metadata={"help": "Whether or not to replace AdamW by Adafactor."})
     dataloader_pin_memory: bool = field(
         default=True, metadata={"help": "Whether or not to pin memory for DataLoader."}
     )
+    group_by_length: bool = field(
+        default=False, metadata={"help": "Batch samples of similar text length and graph size together (map-style datasets only)."}
+    )
+    length_grouping_mult: int = field(
+        default=50, metadata={"help": "Number of batches per shuffled mega-batch sorted by length when `group_by_length` is set."}
+    )
+    dynamic_padding: bool = field(
+        default=False, metadata={"help": "Trim every padded field of a batch to the longest sample in it."}
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "Pack batches up to this many text tokens + KG nodes + summary tokens (after dynamic padding) instead of a fixed number of samples."},
+    )
     past_index: int = field(
         default=-1,
         metadata={"help": "If >=0, uses the corresponding part of the output as the past state for next step."},